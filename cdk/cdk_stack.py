@@ -1,4 +1,4 @@
-from aws_cdk import core, aws_lambda as lambda_, aws_apigateway as apigw
+from aws_cdk import core, aws_lambda as lambda_, aws_apigateway as apigw, aws_s3 as s3, aws_dynamodb as dynamodb
 
 
 
@@ -7,8 +7,23 @@ class CdkStack(core.Stack):
     def __init__(self, scope: core.Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        history_bucket = s3.Bucket(self, "History",
+                                   block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                                   removal_policy=core.RemovalPolicy.RETAIN)
+        metadata_table = dynamodb.Table(self, "SymbolMetadata",
+                                        partition_key=dynamodb.Attribute(name="symbol",
+                                                                         type=dynamodb.AttributeType.STRING),
+                                        sort_key=dynamodb.Attribute(name="dataset",
+                                                                    type=dynamodb.AttributeType.STRING),
+                                        billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                        removal_policy=core.RemovalPolicy.RETAIN)
+
         hello_lambda = lambda_.Function(self, "HelloHandler",
                                         runtime=lambda_.Runtime.PYTHON_3_8,
                                         code=lambda_.Code.asset('lmbda'),
-                                        handler="hello.handler")
+                                        handler="hello.handler",
+                                        environment={"TRAITOR_DATA_BUCKET": history_bucket.bucket_name,
+                                                     "TRAITOR_METADATA_TABLE": metadata_table.table_name})
+        history_bucket.grant_read_write(hello_lambda)
+        metadata_table.grant_read_write_data(hello_lambda)
         apigw.LambdaRestApi(self, 'test', handler=hello_lambda)
@@ -0,0 +1,253 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import abc
+import datetime
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import info, warning
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple, Type
+
+import numpy as np
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.BarsDataStore import init_worker, worker_store
+from lmbda.store.compact import to_epoch_ns
+
+
+class Bar(NamedTuple):
+	"""A single bar, ordered by timestamp (epoch nanoseconds) and then symbol"""
+	timestamp: int
+	symbol: str
+	open: float
+	high: float
+	low: float
+	close: float
+	volume: float
+
+
+class Portfolio:
+	"""Simulated account. Market orders fill at the next open of their symbol, adjusted for slippage against the
+	trader and charged a commission per share, so strategies never trade on the bar that triggered them. Equity and
+	drawdown are marked to the latest close of every holding in O(1) per bar."""
+
+	def __init__(self, cash: float = 100_000.0, commission: float = 0.0, slippage_bps: float = 0.0):
+		self.initial_cash = cash
+		self.cash = cash
+		self.commission = commission
+		self.slippage_bps = slippage_bps
+		self.positions: Dict[str, float] = {}
+		self.trades: List[Tuple[int, str, float, float]] = []
+		self.commissions = 0.0
+		self.bars = 0
+		self._pending: Dict[str, float] = {}
+		self._prices: Dict[str, float] = {}
+		self._holdings = 0.0
+		self._peak = cash
+		self._max_drawdown = 0.0
+
+	def position(self, symbol: str) -> float:
+		return self.positions.get(symbol, 0.0)
+
+	def equity(self) -> float:
+		return self.cash + self._holdings
+
+	def order(self, symbol: str, quantity: float) -> None:
+		"""Place a market order, positive to buy and negative to sell, filled at the symbol's next open"""
+		self._pending[symbol] = self._pending.get(symbol, 0.0) + quantity
+
+	def order_target(self, symbol: str, quantity: float) -> None:
+		"""Order whatever it takes to end up holding the given quantity, accounting for orders still pending"""
+		self.order(symbol, quantity - self.position(symbol) - self._pending.get(symbol, 0.0))
+
+	def summary(self) -> Dict[str, float]:
+		equity = self.equity()
+		return {
+			"final_equity": equity,
+			"pnl": equity - self.initial_cash,
+			"return_pct": 100.0 * (equity - self.initial_cash) / self.initial_cash,
+			"max_drawdown_pct": 100.0 * self._max_drawdown,
+			"trades": len(self.trades),
+			"commissions": self.commissions,
+			"bars": self.bars
+		}
+
+	def _on_bar(self, bar: Bar) -> None:
+		"""Fill any pending order for the bar's symbol at its open, then mark the holding to its close"""
+		self.bars += 1
+		quantity = self._pending.pop(bar.symbol, 0.0)
+		position = self.positions.get(bar.symbol, 0.0)
+		if quantity != 0.0:
+			price = bar.open * (1.0 + (self.slippage_bps if quantity > 0 else -self.slippage_bps) / 10_000.0)
+			commission = abs(quantity) * self.commission
+			self.cash -= quantity * price + commission
+			self.commissions += commission
+			self.trades.append((bar.timestamp, bar.symbol, quantity, price))
+			# The new shares are held at their fill price until marked to the close below
+			self._holdings += position * (price - self._prices.get(bar.symbol, price)) + quantity * price
+			self._prices[bar.symbol] = price
+			position += quantity
+			self.positions[bar.symbol] = position
+		if position != 0.0:
+			self._holdings += position * (bar.close - self._prices.get(bar.symbol, bar.close))
+		self._prices[bar.symbol] = bar.close
+
+		equity = self.cash + self._holdings
+		if equity > self._peak:
+			self._peak = equity
+		elif self._peak > 0:
+			self._max_drawdown = max(self._max_drawdown, (self._peak - equity) / self._peak)
+
+
+class Strategy(metaclass=abc.ABCMeta):
+	"""Callbacks driven by a backtest, which trade by placing orders on the portfolio"""
+
+	def on_start(self, portfolio: Portfolio) -> None:
+		pass
+
+	@abc.abstractmethod
+	def on_bar(self, bar: Bar, portfolio: Portfolio) -> None:
+		raise NotImplementedError
+
+	def on_finish(self, portfolio: Portfolio) -> None:
+		pass
+
+
+class Backtest:
+	"""Replays a chronological stream of bars through a strategy and a simulated portfolio"""
+
+	def __init__(self, strategy: Strategy, cash: float = 100_000.0, commission: float = 0.0,
+	             slippage_bps: float = 0.0):
+		self.strategy = strategy
+		self.portfolio = Portfolio(cash, commission, slippage_bps)
+
+	@metrics.timed("backtest.run")
+	def run(self, bars: Iterable[Bar]) -> Dict[str, float]:
+		portfolio, strategy = self.portfolio, self.strategy
+		strategy.on_start(portfolio)
+		for bar in bars:
+			portfolio._on_bar(bar)
+			strategy.on_bar(bar, portfolio)
+		strategy.on_finish(portfolio)
+		metrics.incr("backtest.bars", portfolio.bars)
+		return portfolio.summary()
+
+
+def symbol_bars(store: BarsDataStore, symbol: str, start: datetime.date = None, end: datetime.date = None,
+                chunk: datetime.timedelta = datetime.timedelta(days=365)) -> Iterator[Bar]:
+	"""Stream a symbol's bars in chronological order. With a start date, bars are read one chunk of dates at a time, so
+	only one chunk per symbol is in memory."""
+	symbol = symbol.upper()
+	if start is None:
+		ranges = [(None, end)]
+	else:
+		last = end or store.last_timestamp(symbol).date()
+		ranges = [(day, min(day + chunk - datetime.timedelta(days=1), last))
+		          for day in (start + i * chunk for i in range((last - start) // chunk + 1))]
+	for chunk_start, chunk_end in ranges:
+		df = store.bars(symbol, chunk_start, chunk_end, columns=["open", "high", "low", "close", "volume"])
+		if len(df) == 0:
+			continue
+		columns = [df[column].to_numpy(np.float64).tolist() for column in ["open", "high", "low", "close", "volume"]]
+		yield from map(Bar._make, zip(to_epoch_ns(df.index).tolist(), itertools.repeat(symbol), *columns))
+
+
+def merge_bars(store: BarsDataStore, symbols: Iterable[str], start: datetime.date = None,
+               end: datetime.date = None) -> Iterator[Bar]:
+	"""Stream bars for many symbols in a single chronological order, by a k-way merge of each symbol's stream"""
+	return heapq.merge(*(symbol_bars(store, symbol, start, end) for symbol in symbols))
+
+
+def backtest(store: BarsDataStore, strategy: Strategy, symbols: Iterable[str], start: datetime.date = None,
+             end: datetime.date = None, **kwargs) -> Dict[str, float]:
+	"""Backtest a strategy trading many symbols from one portfolio, replaying their bars from a store"""
+	return Backtest(strategy, **kwargs).run(merge_bars(store, symbols, start, end))
+
+
+def sweep(store: BarsDataStore,
+          strategy: Type[Strategy],
+          grid: Dict[str, List],
+          symbols: Iterable[str],
+          start: datetime.date = None,
+          end: datetime.date = None,
+          workers: int = None,
+          batch_size: int = 16,
+          **kwargs) -> List[Tuple[Dict, Dict[str, float]]]:
+	"""
+	Sweep a strategy over every combination of parameters in a grid, trading each symbol independently with its own
+	portfolio. Symbols are sharded in batches across a pool of processes; each symbol's bars are read once and replayed
+	for every parameter combination.
+	:param store: BarsDataStore to replay bars from
+	:param strategy: Strategy class, constructed with each parameter combination as keyword arguments
+	:param grid: Parameter names mapped to the values to sweep
+	:param symbols: Symbols to trade
+	:param start: First date to replay, if any
+	:param end: Last date to replay, if any
+	:param workers: Number of worker processes, defaulting to the number of CPUs
+	:param batch_size: Number of symbols per task
+	:param kwargs: Portfolio settings passed on to each Backtest
+	:return: Each parameter combination along with its results summed across symbols, in grid order"""
+	names = list(grid)
+	params = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+	symbols = sorted(symbol.upper() for symbol in symbols)
+	totals = [_empty_totals() for _ in params]
+	info(f"Sweeping {len(params)} parameter combinations over {len(symbols)} symbols")
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(store,)) as executor:
+		futures = {executor.submit(_sweep_symbols, symbols[i:i + batch_size], strategy, params, start, end, kwargs): i
+		           for i in range(0, len(symbols), batch_size)}
+		for done, future in enumerate(as_completed(futures)):
+			try:
+				for total, results in zip(totals, future.result()):
+					_accumulate(total, results)
+			except Exception as e:
+				warning(f"Failed to backtest symbols {symbols[futures[future]:futures[future] + batch_size]}: {e}")
+			info(f"Backtested {min((done + 1) * batch_size, len(symbols))}/{len(symbols)} symbols")
+
+	for total in totals:
+		total["return_pct"] = 100.0 * total["pnl"] / total["capital"] if total["capital"] > 0 else 0.0
+	return list(zip(params, totals))
+
+
+def _sweep_symbols(symbols: List[str], strategy: Type[Strategy], params: List[Dict], start: datetime.date,
+                   end: datetime.date, kwargs: Dict) -> List[Dict[str, float]]:
+	"""Backtest a batch of symbols within a worker process, returning totals for each parameter combination"""
+	totals = [_empty_totals() for _ in params]
+	for symbol in symbols:
+		bars = list(symbol_bars(worker_store(), symbol, start, end))
+		for total, combination in zip(totals, params):
+			_accumulate(total, Backtest(strategy(**combination), **kwargs).run(bars))
+	return totals
+
+
+def _empty_totals() -> Dict[str, float]:
+	return {"symbols": 0, "capital": 0.0, "pnl": 0.0, "trades": 0, "commissions": 0.0, "bars": 0,
+	        "worst_drawdown_pct": 0.0}
+
+
+def _accumulate(total: Dict[str, float], results: Dict[str, float]) -> None:
+	"""Add one symbol's or batch's results into a running total"""
+	if "symbols" in results:
+		total["symbols"] += results["symbols"]
+		total["capital"] += results["capital"]
+	else:
+		total["symbols"] += 1
+		total["capital"] += results["final_equity"] - results["pnl"]
+	for key in ["pnl", "trades", "commissions", "bars"]:
+		total[key] += results[key]
+	total["worst_drawdown_pct"] = max(total["worst_drawdown_pct"],
+	                                  results.get("worst_drawdown_pct", results.get("max_drawdown_pct", 0.0)))
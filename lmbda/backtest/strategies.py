@@ -0,0 +1,57 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+from datetime import timedelta
+
+from lmbda.backtest.engine import Bar, Portfolio, Strategy
+from lmbda.labellers.streaming import StreamingCfdLabeller
+
+
+class BuyAndHoldStrategy(Strategy):
+	"""Buys a fixed notional of every symbol on its first bar and holds it, as a baseline"""
+
+	def __init__(self, notional: float = 10_000.0):
+		self.notional = notional
+
+	def on_bar(self, bar: Bar, portfolio: Portfolio) -> None:
+		if portfolio.position(bar.symbol) == 0.0 and bar.close > 0:
+			portfolio.order_target(bar.symbol, self.notional / bar.close)
+
+
+class CfdSignalStrategy(Strategy):
+	"""Trades the edges found by constant fraction discrimination: goes long a fixed notional on a rising edge and
+	flattens (or goes short) on a falling one. Edges come from the streaming labeller, so each is only acted on once it
+	could actually have been detected."""
+
+	def __init__(self,
+	             edge_width: timedelta,
+	             back_history: int = 0,
+	             pct_change_threshold=0.05,
+	             outlier_zscore_threshold=3.0,
+	             notional: float = 10_000.0,
+	             allow_short: bool = False):
+		self.labeller = StreamingCfdLabeller(edge_width, back_history, pct_change_threshold, outlier_zscore_threshold)
+		self.notional = notional
+		self.allow_short = allow_short
+
+	def on_bar(self, bar: Bar, portfolio: Portfolio) -> None:
+		event = self.labeller.push(bar.symbol, bar.timestamp, bar.close)
+		if event is None or bar.close <= 0:
+			return
+		# Percent changes are measured from the start of the edge, so a rise is negative
+		if event[1] < 0:
+			portfolio.order_target(bar.symbol, self.notional / bar.close)
+		else:
+			portfolio.order_target(bar.symbol, -self.notional / bar.close if self.allow_short else 0.0)
@@ -0,0 +1,152 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import hashlib
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import info, warning
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import pandas as pd
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda import metrics
+from lmbda.features.indicators import Feature, compute_features
+from lmbda.store import BarsDataStore
+from lmbda.store.BarsDataStore import init_worker, worker_store
+
+# Rough number of bars per calendar day, for guessing how far back a lookback of some number of bars reaches
+BARS_PER_DAY = {
+	TimeFrame.Minute.value: 390,
+	TimeFrame.Hour.value: 7,
+	TimeFrame.Day.value: 1
+}
+
+
+class FeatureStore:
+	"""
+	Computes declared features over a store's bars and persists them, one row per bar, as derived partitions in a
+	target store under root/[VERSION], where the version is a hash of every feature's spec. Changing a feature, or its
+	implementation's version, starts a fresh version alongside the old one. Once a symbol's features exist they're
+	extended with only the bars after the last computed row, read along with just enough earlier bars to cover every
+	feature's lookback, so keeping features current costs time in proportion to new data rather than total history.
+	:param source: BarsDataStore to read bars from
+	:param features: Features to compute, which must have unique names
+	:param root: Directory to keep versions of the computed features in
+	:param store: Factory for the target store given a timeframe and directory, defaulting to a Parquet store"""
+
+	def __init__(self, source: BarsDataStore, features: Iterable[Feature], root: str, store=None):
+		self.source = source
+		self.features: List[Feature] = list(features)
+		names = [feature.name for feature in self.features]
+		if len(set(names)) != len(names):
+			raise ValueError(f"Feature names must be unique, got {', '.join(names)}")
+		self.columns = sorted({column for feature in self.features for column in feature.columns})
+		self.lookback = max([feature.lookback for feature in self.features], default=0)
+		self.lookback_time = max([feature.lookback_time for feature in self.features], default=pd.Timedelta(0))
+
+		specs = [feature.spec() for feature in self.features]
+		self.version = hashlib.sha1(json.dumps(specs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+		self.path = Path(root).resolve() / self.version
+		self.path.mkdir(parents=True, exist_ok=True)
+		specs_path = self.path / "features.json"
+		if not specs_path.exists():
+			with open(specs_path, "w") as file:
+				json.dump(specs, file, sort_keys=True, indent=1, default=str)
+		if store is None:
+			from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+			store = ParquetBarsDataStore
+		self.target: BarsDataStore = store(source.timeframe, str(self.path / "data"))
+		# Last source timestamp that each symbol's features were computed through, in this process
+		self._watermarks: Dict[str, pd.Timestamp] = {}
+
+	def __contains__(self, symbol: str) -> bool:
+		return symbol in self.target
+
+	def get(self, symbol: str, start: datetime.date = None, end: datetime.date = None,
+	        columns: List[str] = None) -> pd.DataFrame:
+		"""Get a symbol's features, bringing them up to date with its bars first"""
+		self.refresh(symbol)
+		return self.target.bars(symbol, start, end, columns)
+
+	def panel(self, name: str, symbols: Iterable[str], start: datetime.date = None, end: datetime.date = None,
+	          **kwargs) -> pd.DataFrame:
+		"""Get one feature for many symbols as a single wide frame, as BarsDataStore.panel does for a bar field"""
+		symbols = list(symbols)
+		for symbol in symbols:
+			self.refresh(symbol)
+		return self.target.panel(symbols, start, end, field=name, **kwargs)
+
+	@metrics.timed("features.refresh")
+	def refresh(self, symbol: str) -> None:
+		"""Bring a symbol's features up to date with its bars"""
+		symbol = symbol.upper()
+		last = self.source.last_timestamp(symbol)
+		if self._watermarks.get(symbol) == last:
+			return
+
+		if symbol not in self.target:
+			info(f"Computing {len(self.features)} features for {symbol}")
+			df = compute_features(self.source.bars(symbol, columns=self.columns), self.features)
+			self.target.put(symbol, df)
+		else:
+			since = self.target.last_timestamp(symbol)
+			if since < last:
+				df = compute_features(self._bars_since(symbol, since), self.features)
+				df = df[df.index > since]
+				info("Extending features for %s by %d rows from %s", symbol, len(df), since)
+				if len(df) > 0:
+					self.target.update(symbol, df)
+				metrics.incr("features.rows_computed", len(df))
+		self._watermarks[symbol] = last
+
+	def refresh_many(self, symbols: Iterable[str], workers: int = None) -> Dict[str, Exception]:
+		"""Bring many symbols' features up to date across a pool of processes, returning the symbols that failed"""
+		symbols = sorted(symbol.upper() for symbol in symbols)
+		failures: Dict[str, Exception] = {}
+		with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self,)) as executor:
+			futures = {executor.submit(_refresh_symbol, symbol): symbol for symbol in symbols}
+			for i, future in enumerate(as_completed(futures)):
+				try:
+					future.result()
+				except Exception as e:
+					warning(f"Failed to compute features for {futures[future]}: {e}")
+					failures[futures[future]] = e
+				if i % 100 == 0:
+					info(f"Computed features for {i + 1}/{len(symbols)} symbols")
+		return failures
+
+	def _bars_since(self, symbol: str, since: pd.Timestamp) -> pd.DataFrame:
+		"""Read the bars after since, along with enough bars before it to cover every feature's lookback. How far back
+		that is in days isn't known up front, so the window doubles until it holds enough bars or the whole history."""
+		days = math.ceil(1.5 * self.lookback / BARS_PER_DAY.get(self.source.timeframe.value, 1)) + 3
+		earlier = -1
+		while True:
+			start = (since - self.lookback_time).date() - datetime.timedelta(days=days)
+			df = self.source.bars(symbol, start=start, columns=self.columns)
+			before = int((df.index <= since - self.lookback_time).sum())
+			if before > self.lookback or before == earlier:
+				metrics.incr("features.lookback_rows", before)
+				return df
+			earlier = before
+			days *= 2
+
+
+def _refresh_symbol(symbol: str) -> str:
+	worker_store().refresh(symbol)
+	return symbol
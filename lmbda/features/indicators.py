@@ -0,0 +1,159 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import abc
+from datetime import timedelta
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+
+def _duration(delta: timedelta) -> str:
+	"""Short name for a duration, such as 1d or 30min"""
+	seconds = int(pd.Timedelta(delta).total_seconds())
+	if seconds % 86400 == 0:
+		return f"{seconds // 86400}d"
+	if seconds % 3600 == 0:
+		return f"{seconds // 3600}h"
+	return f"{seconds // 60}min"
+
+
+class Feature(metaclass=abc.ABCMeta):
+	"""A declared indicator, computed over a symbol's bars in a single vectorized pass. Each value may only depend on
+	the bar it's computed for, the lookback bars before it and the bars within lookback_time before it, which is what
+	lets features be extended from new bars alone. Subclasses bump version whenever their output changes, which gives
+	everything computed with them a new version."""
+
+	version = 1
+
+	def __init__(self, name: str, columns: List[str], **params):
+		self.name = name
+		self.columns = columns
+		self.params = params
+
+	def __repr__(self) -> str:
+		return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in self.params.items())})"
+
+	@property
+	def lookback(self) -> int:
+		"""Number of earlier bars each value depends on"""
+		return 0
+
+	@property
+	def lookback_time(self) -> pd.Timedelta:
+		"""Length of time before each bar that its value depends on"""
+		return pd.Timedelta(0)
+
+	def spec(self) -> Dict:
+		"""Everything that determines this feature's output, for versioning stored results"""
+		return {"feature": type(self).__name__, "version": self.version, "name": self.name, **self.params}
+
+	@abc.abstractmethod
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		"""Compute the feature for every bar in a chronological frame"""
+		raise NotImplementedError
+
+
+class RollingMean(Feature):
+	"""Simple moving average of a column over a window of bars"""
+
+	def __init__(self, window: int, column: str = "close", name: str = None):
+		super().__init__(name or f"{column}_mean_{window}", [column], window=window, column=column)
+		self.window = window
+		self.column = column
+
+	@property
+	def lookback(self) -> int:
+		return self.window - 1
+
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		return df[self.column].rolling(self.window).mean()
+
+
+class Return(Feature):
+	"""Percent or log return of the close over a number of bars"""
+
+	def __init__(self, periods: int = 1, log: bool = False, name: str = None):
+		super().__init__(name or f"{'log_' if log else ''}return_{periods}", ["close"], periods=periods, log=log)
+		self.periods = periods
+		self.log = log
+
+	@property
+	def lookback(self) -> int:
+		return self.periods
+
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		close = df["close"]
+		if self.log:
+			return np.log(close / close.shift(self.periods))
+		return close / close.shift(self.periods) - 1.0
+
+
+class Volatility(Feature):
+	"""Standard deviation of one-bar log returns over a window of bars"""
+
+	def __init__(self, window: int, name: str = None):
+		super().__init__(name or f"volatility_{window}", ["close"], window=window)
+		self.window = window
+
+	@property
+	def lookback(self) -> int:
+		return self.window
+
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		return np.log(df["close"] / df["close"].shift(1)).rolling(self.window).std()
+
+
+class ZScore(Feature):
+	"""How many standard deviations a column sits from its mean over a window of bars"""
+
+	def __init__(self, window: int, column: str = "close", name: str = None):
+		super().__init__(name or f"{column}_zscore_{window}", [column], window=window, column=column)
+		self.window = window
+		self.column = column
+
+	@property
+	def lookback(self) -> int:
+		return self.window - 1
+
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		rolling = df[self.column].rolling(self.window)
+		std = rolling.std()
+		return (df[self.column] - rolling.mean()) / std.where(std > 0)
+
+
+class CfdSignal(Feature):
+	"""The constant fraction discrimination signal that cfd_events finds edges in: the close exactly edge_width
+	earlier, less the current close. Missing wherever there was no bar exactly edge_width earlier, and edges are where
+	its sign changes."""
+
+	def __init__(self, edge_width: timedelta, name: str = None):
+		super().__init__(name or f"cfd_{_duration(edge_width)}", ["close"], edge_width=pd.Timedelta(edge_width))
+		self.edge_width = pd.Timedelta(edge_width)
+
+	@property
+	def lookback_time(self) -> pd.Timedelta:
+		return self.edge_width
+
+	def compute(self, df: pd.DataFrame) -> pd.Series:
+		close = df["close"].astype(np.float64)
+		return close.shift(freq=self.edge_width).reindex(close.index) - close
+
+
+def compute_features(df: pd.DataFrame, features: Iterable[Feature]) -> pd.DataFrame:
+	"""Compute every feature for a symbol's bars, as one column per feature"""
+	return pd.DataFrame({feature.name: feature.compute(df).astype(np.float64) for feature in features},
+	                    index=df.index)
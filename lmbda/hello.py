@@ -24,5 +24,5 @@ def handler(event, context):
 		"headers": {
 			"Content-Type": "text/plain"
 		},
-		"body": "Hello, world! This is {}".format(event[path])
+		"body": "Hello, world! This is {}".format(event["path"])
 	}
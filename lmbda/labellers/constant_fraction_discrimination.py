@@ -14,27 +14,32 @@
 #  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
 #
 from datetime import timedelta
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
 
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.stats import zscore
 
+from lmbda import metrics
 
-def perform_cfd(df: pd.DataFrame,
-                edge_width: timedelta,
-                back_history: int=0,
-                pct_change_threshold=0.05,
-                outlier_zscore_threshold=3.0
-                ) -> List[Tuple[float, List[float]]]:
+
+@metrics.timed("labeller.cfd")
+def cfd_events(df: pd.DataFrame,
+               edge_width: timedelta,
+               back_history: int=0,
+               pct_change_threshold=0.05,
+               outlier_zscore_threshold=3.0
+               ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Perform constant fraction discrimination to find rising & falling edges
+    Perform constant fraction discrimination to find rising & falling edges, returning compact arrays
     :param df: Dataframe of stock closing prices
     :param edge_width: Edge width to consider when doing constant fraction discrimination
-    :param back_history: Days of back-history to include in the returned datafraem
+    :param back_history: Days of back-history to include with each edge
     :param pct_change_threshold: Absolute percent change required to be considered a viable edge
     :param outlier_zscore_threshold: Z-score threshold for filtering outliers
-    :return: A dataframe mapping percent changes to days of history leading up to them."""
+    :return: A tuple of edge timestamps, edge percent changes, and an (n_events, back_history + 2) array of the
+    closing prices leading up to each edge."""
 
     cfd = df["close"]\
         .to_frame()\
@@ -45,28 +50,82 @@ def perform_cfd(df: pd.DataFrame,
               .rename({"close": "inverse"}, axis=1), on="timestamp", how="inner")\
         .dropna(axis=0)
 
-    cfd_results = cfd["delayed"] + cfd["inverse"]
-    crossings = np.asarray(np.where(np.diff(np.sign(cfd_results))))[0]
+    # Crossings are located in the bars by their timestamps, since the CFD series skips every bar without one exactly
+    # edge_width earlier and its positions drift further from the bars' with each one skipped
+    cfd_results = (cfd["delayed"] + cfd["inverse"]).to_numpy()
+    crossings = df.index.get_indexer(cfd.index[np.flatnonzero(np.diff(np.sign(cfd_results)))])
     del cfd
     del cfd_results
 
-    df_deltas = pd.DataFrame({
-        "idx": crossings,
-        "start": df.iloc[crossings]["close"].array,
-        "end": df.iloc[crossings + 1]["close"].array
-    }, index=df.iloc[crossings].index).dropna().iloc[1:]
-    del crossings
+    # Edges with a missing price on either side are dropped, as is the first edge
+    close = df["close"].to_numpy(dtype=np.float64)
+    start = close[crossings]
+    end = close[crossings + 1]
+    valid = ~(np.isnan(start) | np.isnan(end))
+    crossings, start, end = crossings[valid][1:], start[valid][1:], end[valid][1:]
+
+    pct_diff = 100.0 * (start - end) / start
+    keep = (np.abs(zscore(pct_diff)) < outlier_zscore_threshold) & (np.abs(pct_diff) >= pct_change_threshold)
+    crossings, pct_diff = crossings[keep], pct_diff[keep]
+
+    # Every edge's back-history is a view into the same sliding window over the closing prices
+    width = back_history + 2
+    keep = (crossings - 1 - back_history >= 0) & (crossings + 1 <= len(close))
+    crossings, pct_diff = crossings[keep], pct_diff[keep]
+    if len(crossings) == 0 or len(close) < width:
+        return df.index.values[:0], np.empty(0), np.empty((0, width))
+    windows = sliding_window_view(close, width)[crossings - 1 - back_history]
+
+    keep = ~np.isnan(windows).any(axis=1)
+    metrics.incr("labeller.cfd.events", int(keep.sum()))
+    return df.index.values[crossings[keep]], pct_diff[keep], np.ascontiguousarray(windows[keep])
 
-    df_deltas["diff"] = df_deltas.start - df_deltas.end
-    df_deltas["pct_diff"] = 100.0 * df_deltas["diff"] / df_deltas.start
-    df_deltas = df_deltas[(np.abs(zscore(df_deltas.pct_diff)) < outlier_zscore_threshold)
-                          & (df_deltas.pct_diff.abs() >= pct_change_threshold)]
 
-    trailing_histories: List[Tuple[float, List[float]]] = []
-    for index, row in df_deltas.iterrows():
-        if row.idx - 1 - back_history < 0 or row.idx + 1 > len(df):
-            continue
-        slice_start = int(row.idx - 1 - back_history)
-        slice_end = int(row.idx) + 1
-        trailing_histories.append((row.pct_diff, list(df.iloc[slice_start:slice_end]["close"].array)))
-    return list(filter(lambda history: float('NaN') not in history[1], trailing_histories))
+def perform_cfd(df: pd.DataFrame,
+                edge_width: timedelta,
+                back_history: int=0,
+                pct_change_threshold=0.05,
+                outlier_zscore_threshold=3.0
+                ) -> List[Tuple[float, List[float]]]:
+    """
+    Perform constant fraction discrimination to find rising & falling edges
+    :param df: Dataframe of stock closing prices
+    :param edge_width: Edge width to consider when doing constant fraction discrimination
+    :param back_history: Days of back-history to include in the returned datafraem
+    :param pct_change_threshold: Absolute percent change required to be considered a viable edge
+    :param outlier_zscore_threshold: Z-score threshold for filtering outliers
+    :return: A dataframe mapping percent changes to days of history leading up to them."""
+    _, pct_diffs, windows = cfd_events(df, edge_width, back_history, pct_change_threshold, outlier_zscore_threshold)
+    return [(pct_diff, window) for pct_diff, window in zip(pct_diffs.tolist(), windows.tolist())]
+
+
+def perform_cfd_many(store,
+                     symbols: Iterable[str],
+                     edge_width: timedelta,
+                     back_history: int=0,
+                     pct_change_threshold=0.05,
+                     outlier_zscore_threshold=3.0
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Perform constant fraction discrimination over many symbols in a store, batching the results together
+    :param store: BarsDataStore to read closing prices from
+    :param symbols: Symbols to label
+    :param edge_width: Edge width to consider when doing constant fraction discrimination
+    :param back_history: Days of back-history to include with each edge
+    :param pct_change_threshold: Absolute percent change required to be considered a viable edge
+    :param outlier_zscore_threshold: Z-score threshold for filtering outliers
+    :return: A tuple of symbol ids (positions in symbols), edge timestamps, edge percent changes, and an
+    (n_events, back_history + 2) array of the closing prices leading up to each edge, across all symbols."""
+    symbol_ids, timestamps, pct_diffs, windows = [], [], [], []
+    for i, symbol in enumerate(symbols):
+        events = cfd_events(store.bars(symbol, columns=["close"]), edge_width, back_history, pct_change_threshold,
+                            outlier_zscore_threshold)
+        symbol_ids.append(np.full(len(events[1]), i, dtype=np.int32))
+        timestamps.append(events[0])
+        pct_diffs.append(events[1])
+        windows.append(events[2])
+    if len(symbol_ids) == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype="datetime64[ns]"), np.empty(0), \
+               np.empty((0, back_history + 2))
+    return np.concatenate(symbol_ids), np.concatenate(timestamps), np.concatenate(pct_diffs), \
+           np.concatenate(windows)
@@ -0,0 +1,233 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import itertools
+import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import info
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from lmbda.labellers.pipeline import LabelCache, label_symbols
+from lmbda.store import BarsDataStore
+
+try:
+	from keras.utils import Sequence
+except ImportError:
+	# keras is only needed to train, so the dataset still works as a plain iterable without it
+	Sequence = object
+
+Batch = Tuple[np.ndarray, np.ndarray]
+
+
+class CfdWindowSequence(Sequence):
+	"""
+	keras Sequence streaming (features, targets) batches of CFD-labelled windows, one symbol's labels at a time, so
+	only the shuffle buffer, a few prefetched batches and the symbols being loaded are ever in memory. A background
+	thread loads and decodes up to one symbol per worker thread ahead of training, mixes their windows through a
+	shuffle buffer and queues up finished batches.
+	Batches are streamed, so they come in stream order whatever index keras asks for: fit with shuffle=False, and let
+	the shuffle buffer and the per-epoch symbol order do the shuffling. Features and targets are float32, as in
+	exported training tensors.
+	:param cache: LabelCache holding each symbol's labels
+	:param symbols: Symbols to train on, defaulting to every symbol in the cache
+	:param batch_size: Windows per batch. The last batch of an epoch may be smaller.
+	:param store: BarsDataStore to label symbols from that are missing or stale in the cache, if any
+	:param shard: This shard's index and the number of shards, splitting the symbols between workers or hosts
+	:param shuffle: Whether to shuffle the symbol order each epoch and mix windows through a shuffle buffer
+	:param shuffle_buffer: Number of windows in the shuffle buffer. Larger buffers mix more symbols together.
+	:param prefetch: Number of batches to queue up ahead of training
+	:param workers: Number of threads loading symbols
+	:param seed: Seed for shuffling, varied by epoch"""
+
+	def __init__(self,
+	             cache: LabelCache,
+	             symbols: Iterable[str] = None,
+	             batch_size: int = 256,
+	             store: BarsDataStore = None,
+	             shard: Tuple[int, int] = (0, 1),
+	             shuffle: bool = True,
+	             shuffle_buffer: int = 16384,
+	             prefetch: int = 8,
+	             workers: int = 4,
+	             seed: int = None):
+		symbols = sorted(symbol.upper() for symbol in (cache.symbols() if symbols is None else symbols))
+		self.symbols: List[str] = symbols[shard[0]::shard[1]]
+		if store is not None:
+			params = {key: value for key, value in cache.params.items() if key != "labeller"}
+			label_symbols(store, self.symbols, str(cache.path.parent), workers=workers, **params)
+		self.cache = cache
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.shuffle_buffer = shuffle_buffer if shuffle else 0
+		self.prefetch = prefetch
+		self.workers = workers
+		self.seed = seed
+		self.epoch = 0
+
+		# Only the labels' lengths are read to size the epoch, not their windows
+		self.symbols = [symbol for symbol in self.symbols if symbol in cache]
+		self.count = sum(self._length(symbol) for symbol in self.symbols)
+		info(f"Streaming {self.count} windows from {len(self.symbols)} symbols in shard {shard[0] + 1}/{shard[1]}")
+		self._queue: Optional[queue.Queue] = None
+		self._stop: Optional[threading.Event] = None
+		self._thread: Optional[threading.Thread] = None
+		self._served = 0
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		# keras may copy the sequence into worker processes, which each start streaming afresh
+		state = self.__dict__.copy()
+		state.update(_queue=None, _stop=None, _thread=None, _served=0, _lock=None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return math.ceil(self.count / self.batch_size)
+
+	def __getitem__(self, index: int) -> Batch:
+		if index >= len(self):
+			raise IndexError(index)
+		with self._lock:
+			if self._thread is None or self._served == len(self):
+				self._start()
+			self._served += 1
+			source = self._queue
+		batch = source.get()
+		if isinstance(batch, Exception):
+			raise batch
+		return batch
+
+	def __iter__(self) -> Iterator[Batch]:
+		"""Stream one epoch of batches, then move on to the next epoch"""
+		for index in range(len(self)):
+			yield self[index]
+		self.on_epoch_end()
+
+	def on_epoch_end(self) -> None:
+		"""Called by keras between epochs, so the next epoch streams a fresh shuffle"""
+		self.close()
+		self.epoch += 1
+
+	def close(self) -> None:
+		"""Stop prefetching"""
+		with self._lock:
+			self._halt()
+			self._served = 0
+
+	def _length(self, symbol: str) -> int:
+		with np.load(self.cache._symbol_path(symbol)) as events:
+			return len(events["pct_diffs"])
+
+	def _start(self) -> None:
+		"""Start streaming an epoch in the background, stopping any epoch already streaming"""
+		self._halt()
+		self._queue = queue.Queue(maxsize=self.prefetch)
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._produce, args=(self._queue, self._stop), daemon=True)
+		self._thread.start()
+
+	def _halt(self) -> None:
+		if self._thread is not None:
+			self._stop.set()
+			self._thread.join()
+			self._thread = None
+
+	def _load(self, symbol: str) -> Batch:
+		_, pct_diffs, windows = self.cache[symbol]
+		return windows.astype(np.float32), pct_diffs.astype(np.float32)
+
+	def _produce(self, batches: queue.Queue, stop: threading.Event) -> None:
+		"""Load symbols, mix their windows through the shuffle buffer and queue up batches until the epoch ends"""
+		rng = np.random.default_rng(None if self.seed is None else self.seed + self.epoch)
+		symbols = list(self.symbols)
+		if self.shuffle:
+			rng.shuffle(symbols)
+		remaining = iter(symbols)
+
+		def put(batch) -> bool:
+			while not stop.is_set():
+				try:
+					batches.put(batch, timeout=0.1)
+					return True
+				except queue.Full:
+					pass
+			return False
+
+		# Windows are copied into one preallocated buffer as they arrive, and batches are taken out of it in place
+		capacity = self.shuffle_buffer + self.batch_size
+		features: Optional[np.ndarray] = None
+		targets = np.empty(capacity, dtype=np.float32)
+		buffered = 0
+		pending: Deque[Future] = deque()
+		try:
+			with ThreadPoolExecutor(max_workers=self.workers) as executor:
+				# Only as many symbols as there are workers are loaded ahead, in the (shuffled) symbol order
+				for symbol in itertools.islice(remaining, self.workers):
+					pending.append(executor.submit(self._load, symbol))
+				try:
+					while len(pending) > 0:
+						symbol_features, symbol_targets = pending.popleft().result()
+						for symbol in itertools.islice(remaining, 1):
+							pending.append(executor.submit(self._load, symbol))
+						if features is None and len(symbol_targets) > 0:
+							features = np.empty((capacity,) + symbol_features.shape[1:], dtype=np.float32)
+
+						position = 0
+						while position < len(symbol_targets):
+							if stop.is_set():
+								return
+							count = min(capacity - buffered, len(symbol_targets) - position)
+							features[buffered:buffered + count] = symbol_features[position:position + count]
+							targets[buffered:buffered + count] = symbol_targets[position:position + count]
+							buffered += count
+							position += count
+							if buffered == capacity:
+								buffered, batch = self._take(features, targets, buffered, rng)
+								if not put(batch):
+									return
+				finally:
+					# Symbols not yet loading when streaming stops are never loaded
+					for future in pending:
+						future.cancel()
+
+			while buffered > 0:
+				buffered, batch = self._take(features, targets, buffered, rng)
+				if not put(batch):
+					return
+		except Exception as e:
+			put(e)
+
+	def _take(self, features: np.ndarray, targets: np.ndarray, buffered: int,
+	          rng: np.random.Generator) -> Tuple[int, Batch]:
+		"""Take a batch out of the first buffered rows of the buffer, at random when shuffling and from the front
+		otherwise, returning how many rows remain buffered along with the batch. The rows taken are filled in from the
+		end of the buffer, so nothing else is copied."""
+		size = min(self.batch_size, buffered)
+		chosen = rng.choice(buffered, size, replace=False) if self.shuffle else np.arange(size)
+		batch = features[chosen], targets[chosen]
+		remaining = buffered - size
+		holes = chosen[chosen < remaining]
+		movers = np.setdiff1d(np.arange(remaining, buffered), chosen, assume_unique=True)
+		features[holes] = features[movers]
+		targets[holes] = targets[movers]
+		return remaining, batch
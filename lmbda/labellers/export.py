@@ -0,0 +1,148 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+from logging import info
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from lmbda.labellers.pipeline import LabelCache
+
+ARRAYS = [
+	("features", np.float32),
+	("targets", np.float32),
+	("symbol_ids", np.int32),
+	("timestamps", np.int64)
+]
+
+
+class TrainingTensorWriter:
+	"""Writes labelled windows straight into preallocated, memory-mapped .npy arrays (features, targets, symbol ids and
+	epoch-ns timestamps) under a directory, growing them as needed. The number of valid rows and the symbol id table
+	are kept in meta.json, so an existing dataset can be reopened and appended to."""
+
+	def __init__(self, path: str, window: int, capacity: int = 65536):
+		self.path = Path(path).resolve()
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.count = 0
+		self.symbols: List[str] = []
+		self.capacity = capacity
+		self.window = window
+		self._arrays: Dict[str, np.memmap] = {}
+
+		meta_path = self.path / "meta.json"
+		if meta_path.exists():
+			with open(meta_path, "r") as file:
+				meta = json.load(file)
+			if meta["window"] != window:
+				raise ValueError(f"Dataset at {path} holds windows of {meta['window']}, not {window}")
+			self.count, self.symbols, self.capacity = meta["count"], meta["symbols"], meta["capacity"]
+			info(f"Appending to existing dataset of {self.count} windows at {path}")
+			for name, _ in ARRAYS:
+				self._arrays[name] = np.load(self.path / f"{name}.npy", mmap_mode="r+")
+		else:
+			for name, dtype in ARRAYS:
+				self._arrays[name] = open_memmap(self.path / f"{name}.npy", mode="w+", dtype=dtype,
+				                                 shape=self._shape(name, self.capacity))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.flush()
+
+	def append(self, symbol: str, timestamps: np.ndarray, pct_diffs: np.ndarray, windows: np.ndarray) -> None:
+		"""Append a symbol's labelled windows, as returned by cfd_events"""
+		n = len(pct_diffs)
+		if n == 0:
+			return
+		if windows.shape[1] != self.window:
+			raise ValueError(f"Expected windows of {self.window} prices, got {windows.shape[1]}")
+		if self.count + n > self.capacity:
+			self._grow(max(2 * self.capacity, self.count + n))
+
+		symbol = symbol.upper()
+		if symbol not in self.symbols:
+			self.symbols.append(symbol)
+		rows = slice(self.count, self.count + n)
+		self._arrays["features"][rows] = windows
+		self._arrays["targets"][rows] = pct_diffs
+		self._arrays["symbol_ids"][rows] = self.symbols.index(symbol)
+		self._arrays["timestamps"][rows] = np.asarray(timestamps).astype("datetime64[ns]").astype(np.int64)
+		self.count += n
+
+	def flush(self) -> None:
+		"""Flush written windows to disk, then record them as valid in meta.json"""
+		for array in self._arrays.values():
+			array.flush()
+		meta_path = self.path / "meta.json"
+		tmp_path = meta_path.with_name("meta.json.tmp")
+		with open(tmp_path, "w") as file:
+			json.dump({"count": self.count, "capacity": self.capacity, "window": self.window,
+			           "symbols": self.symbols}, file)
+		os.replace(tmp_path, meta_path)
+
+	def _grow(self, capacity: int) -> None:
+		"""Reallocate every array with a larger capacity, copying over the rows written so far"""
+		info(f"Growing dataset at {self.path} from {self.capacity} to {capacity} windows")
+		for name, dtype in ARRAYS:
+			path = self.path / f"{name}.npy"
+			tmp_path = self.path / f"{name}.tmp.npy"
+			grown = open_memmap(tmp_path, mode="w+", dtype=dtype, shape=self._shape(name, capacity))
+			grown[:self.count] = self._arrays[name][:self.count]
+			grown.flush()
+			del grown
+			del self._arrays[name]
+			os.replace(tmp_path, path)
+			self._arrays[name] = np.load(path, mmap_mode="r+")
+		self.capacity = capacity
+
+	def _shape(self, name: str, rows: int) -> Tuple[int, ...]:
+		return (rows, self.window) if name == "features" else (rows,)
+
+
+def export_label_cache(cache: LabelCache, path: str, capacity: int = 65536) -> None:
+	"""Export every symbol in a label cache into a memory-mapped training dataset, one symbol at a time"""
+	window = cache.params["back_history"] + 2
+	with TrainingTensorWriter(path, window, capacity) as writer:
+		for symbol, events in cache.items():
+			writer.append(symbol, *events)
+
+
+def load_training_tensors(path: str) -> Dict[str, np.ndarray]:
+	"""Memory-map an exported dataset without reading it into RAM. Returns read-only views of the valid rows of each
+	array, keyed by array name, plus the symbol id table under "symbols"."""
+	path = Path(path)
+	with open(path / "meta.json", "r") as file:
+		meta = json.load(file)
+	tensors = {name: np.load(path / f"{name}.npy", mmap_mode="r")[:meta["count"]] for name, _ in ARRAYS}
+	tensors["symbols"] = np.asarray(meta["symbols"])
+	return tensors
+
+
+def iter_minibatches(tensors: Dict[str, np.ndarray], batch_size: int, shuffle: bool = False,
+                     seed: int = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+	"""Stream (features, targets) minibatches from memory-mapped tensors. Shuffling permutes the order of contiguous
+	batches rather than individual rows, so every batch is still a single sequential read."""
+	starts = np.arange(0, len(tensors["targets"]), batch_size)
+	if shuffle:
+		np.random.default_rng(seed).shuffle(starts)
+	for start in starts:
+		yield np.asarray(tensors["features"][start:start + batch_size]), \
+		      np.asarray(tensors["targets"][start:start + batch_size])
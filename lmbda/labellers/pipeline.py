@@ -0,0 +1,145 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from logging import info, warning
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lmbda.labellers.constant_fraction_discrimination import cfd_events
+from lmbda.store import BarsDataStore
+from lmbda.store.BarsDataStore import init_worker, worker_store
+from lmbda.store.locking import atomic_path
+
+CfdEvents = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+class LabelCache:
+	"""On-disk cache of CFD labels, stored as one cache_dir/[PARAMS HASH]/[SYMBOL].npz file per symbol. Each file
+	records the timestamp of the last bar it was computed from, and symbols are only loaded when accessed."""
+
+	def __init__(self, cache_dir: str, params: Dict):
+		self.params = params
+		key = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+		self.path = Path(cache_dir).resolve() / key
+		self.path.mkdir(parents=True, exist_ok=True)
+		params_path = self.path / "params.json"
+		if not params_path.exists():
+			with open(params_path, "w") as file:
+				json.dump(params, file, sort_keys=True, default=str)
+
+	def __contains__(self, symbol: str) -> bool:
+		return self._symbol_path(symbol).exists()
+
+	def __getitem__(self, symbol: str) -> CfdEvents:
+		"""Load the cached edge timestamps, percent changes and back-history windows for a symbol"""
+		if symbol not in self:
+			raise KeyError(symbol)
+		with np.load(self._symbol_path(symbol)) as events:
+			return events["timestamps"], events["pct_diffs"], events["windows"]
+
+	def __len__(self) -> int:
+		return len(self.symbols())
+
+	def symbols(self) -> Set[str]:
+		return {path.name.split(".")[0] for path in self.path.glob("*.npz")}
+
+	def items(self) -> Iterator[Tuple[str, CfdEvents]]:
+		"""Lazily iterate over every cached symbol's labels, loading one symbol at a time"""
+		for symbol in sorted(self.symbols()):
+			yield symbol, self[symbol]
+
+	def last(self, symbol: str) -> pd.Timestamp:
+		"""Get the timestamp of the last bar a symbol's labels were computed from"""
+		with np.load(self._symbol_path(symbol)) as events:
+			return pd.Timestamp(int(events["last"]), tz="UTC")
+
+	def is_fresh(self, symbol: str, last: pd.Timestamp) -> bool:
+		return symbol in self and self.last(symbol) == last
+
+	def put(self, symbol: str, last: pd.Timestamp, events: CfdEvents) -> None:
+		"""Atomically write a symbol's labels, along with the timestamp of the last bar they were computed from"""
+		# The temporary file is hidden and ends in .tmp, so it's never mistaken for a cached symbol. It's written through
+		# a file object, since np.savez appends .npz to any path not already ending in it.
+		with atomic_path(self._symbol_path(symbol)) as tmp_path, open(tmp_path, "wb") as file:
+			np.savez(file, last=np.int64(last.value), timestamps=events[0].astype("datetime64[ns]"),
+			         pct_diffs=events[1], windows=events[2])
+
+	def _symbol_path(self, symbol: str) -> Path:
+		return self.path / f"{symbol.upper()}.npz"
+
+
+def label_symbols(store: BarsDataStore,
+                  symbols: Iterable[str],
+                  cache_dir: str,
+                  edge_width: timedelta,
+                  back_history: int=0,
+                  pct_change_threshold=0.05,
+                  outlier_zscore_threshold=3.0,
+                  workers: int = None
+                  ) -> LabelCache:
+	"""
+	Label many symbols with constant fraction discrimination across a pool of processes, caching results on disk.
+	Symbols whose cached labels were computed from the same parameters and last bar are skipped.
+	:param store: BarsDataStore to read closing prices from
+	:param symbols: Symbols to label
+	:param cache_dir: Directory to cache labels in
+	:param edge_width: Edge width to consider when doing constant fraction discrimination
+	:param back_history: Days of back-history to include with each edge
+	:param pct_change_threshold: Absolute percent change required to be considered a viable edge
+	:param outlier_zscore_threshold: Z-score threshold for filtering outliers
+	:param workers: Number of worker processes, defaulting to the number of CPUs
+	:return: The label cache holding every requested symbol's labels"""
+	params = {
+		"labeller": "cfd",
+		# Bumped whenever cfd_events labels the same bars differently, so labels cached before are recomputed
+		"version": 2,
+		"edge_width": edge_width,
+		"back_history": back_history,
+		"pct_change_threshold": pct_change_threshold,
+		"outlier_zscore_threshold": outlier_zscore_threshold
+	}
+	cache = LabelCache(cache_dir, params)
+	stale = [symbol.upper() for symbol in symbols if not cache.is_fresh(symbol, store.last_timestamp(symbol))]
+	info(f"Labelling {len(stale)} symbols, the rest are already cached in {cache.path}")
+	if len(stale) == 0:
+		return cache
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(store,)) as executor:
+		futures = {executor.submit(_label_symbol, symbol, cache_dir, params): symbol for symbol in stale}
+		for i, future in enumerate(as_completed(futures)):
+			try:
+				future.result()
+			except Exception as e:
+				warning(f"Failed to label {futures[future]}: {e}")
+			if i % 100 == 0:
+				info(f"Labelled {i + 1}/{len(stale)} symbols ({100 * (i + 1) / len(stale):.2f}% complete)")
+	return cache
+
+
+def _label_symbol(symbol: str, cache_dir: str, params: Dict) -> str:
+	"""Label a single symbol within a worker process and write the result to the cache"""
+	cache = LabelCache(cache_dir, params)
+	df = worker_store().bars(symbol, columns=["close"])
+	events = cfd_events(df, params["edge_width"], params["back_history"], params["pct_change_threshold"],
+	                    params["outlier_zscore_threshold"])
+	cache.put(symbol, df.index[-1], events)
+	return symbol
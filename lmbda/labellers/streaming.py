@@ -0,0 +1,168 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import math
+from collections import deque
+from datetime import timedelta
+from itertools import islice
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from lmbda import metrics
+from lmbda.store.compact import to_epoch_ns
+
+CfdEvent = Tuple[np.datetime64, float, np.ndarray]
+
+
+class _SymbolState:
+	"""Rolling CFD state for a single symbol"""
+
+	def __init__(self):
+		# Bars seen so far, positions counting from the first, and the sign of the last CFD value
+		self.bars = 0
+		self.last_sign: Optional[float] = None
+		# Position of the latest bar with a partner exactly edge_width earlier, where the next edge would start
+		self.last_cfd: Optional[int] = None
+		# (timestamp, close) of recent bars, searched for each new bar's partner exactly edge_width earlier
+		self.partners: deque = deque()
+		# Closes and timestamps from position offset onwards: the next edge's back-history window and every bar since
+		self.closes: deque = deque()
+		self.timestamps: deque = deque()
+		self.offset = 0
+		self.seen_first_edge = False
+		# Running count, mean and sum of squared deviations of edge percent changes, for the z-score filter
+		self.edges = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+
+class StreamingCfdLabeller:
+	"""Incremental constant fraction discrimination, labelling bars as they arrive in O(1) time per bar. Keeps, per
+	symbol, the bars within edge_width of the latest one (to pair each bar with its delayed partner), the last CFD sign,
+	the closes from the start of the next edge's back-history window onwards, and running statistics for the z-score
+	filter. Both buffers are bounded by the bars in an edge_width plus back_history + 2, however long the stream.
+
+	Replaying a symbol's stored history produces exactly the events of cfd_events with the outlier filter disabled
+	(outlier_zscore_threshold=None here, infinity there). With the filter enabled, each edge's z-score is taken against
+	the edges seen so far rather than the whole history, since the stream can't see the future."""
+
+	def __init__(self,
+	             edge_width: timedelta,
+	             back_history: int = 0,
+	             pct_change_threshold=0.05,
+	             outlier_zscore_threshold: Optional[float] = 3.0):
+		self.edge_width = int(pd.Timedelta(edge_width).value)
+		self.back_history = back_history
+		self.pct_change_threshold = pct_change_threshold
+		self.outlier_zscore_threshold = outlier_zscore_threshold
+		self._states: Dict[str, _SymbolState] = {}
+
+	def reset(self, symbol: str = None) -> None:
+		"""Forget the rolling state of a symbol, or of every symbol"""
+		if symbol is None:
+			self._states = {}
+		else:
+			self._states.pop(symbol.upper(), None)
+
+	def push(self, symbol: str, timestamp: Union[pd.Timestamp, int], close: float) -> Optional[CfdEvent]:
+		"""Feed a single bar, returning the edge it completes, if any. Timestamps may also be given as epoch
+		nanoseconds."""
+		if not isinstance(timestamp, int):
+			timestamp = int(to_epoch_ns(pd.DatetimeIndex([timestamp]))[0])
+		return self._push(self._state(symbol), timestamp, float(close))
+
+	def update(self, symbol: str, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""Feed a chronological frame of new bars for a symbol, returning the edges completed in the same form as
+		cfd_events: edge timestamps, percent changes and an (n_events, back_history + 2) array of closing prices"""
+		state = self._state(symbol)
+		events = [event for event in map(lambda bar: self._push(state, *bar),
+		                                 zip(to_epoch_ns(df.index).tolist(), df["close"].to_numpy(np.float64).tolist()))
+		          if event is not None]
+		metrics.incr("labeller.streaming.bars", len(df))
+		metrics.incr("labeller.streaming.events", len(events))
+		if len(events) == 0:
+			return np.empty(0, dtype="datetime64[ns]"), np.empty(0), np.empty((0, self.back_history + 2))
+		timestamps, pct_diffs, windows = zip(*events)
+		return np.asarray(timestamps, dtype="datetime64[ns]"), np.asarray(pct_diffs), np.stack(windows)
+
+	def _state(self, symbol: str) -> _SymbolState:
+		symbol = symbol.upper()
+		if symbol not in self._states:
+			self._states[symbol] = _SymbolState()
+		return self._states[symbol]
+
+	def _push(self, state: _SymbolState, timestamp: int, close: float) -> Optional[CfdEvent]:
+		position = state.bars
+		state.bars += 1
+		state.closes.append(close)
+		state.timestamps.append(timestamp)
+
+		# Find the bar exactly edge_width earlier. Anything older can never be a partner again.
+		partner = timestamp - self.edge_width
+		while len(state.partners) > 0 and state.partners[0][0] < partner:
+			state.partners.popleft()
+		partner_close = state.partners[0][1] if len(state.partners) > 0 and state.partners[0][0] == partner else None
+		state.partners.append((timestamp, close))
+
+		event = None
+		if partner_close is not None and not math.isnan(partner_close) and not math.isnan(close):
+			sign = float(np.sign(partner_close - close))
+			previous_sign, state.last_sign = state.last_sign, sign
+			# A sign change puts an edge at the previous bar with a CFD value
+			if previous_sign is not None and sign != previous_sign:
+				event = self._edge(state, state.last_cfd)
+			state.last_cfd = position
+
+		# Only the latest bar with a CFD value, or a later one, can start the next edge, and its window reaches
+		# back_history + 1 bars further back
+		keep_from = (position + 1 if state.last_cfd is None else state.last_cfd) - 1 - self.back_history
+		while state.offset < keep_from:
+			state.closes.popleft()
+			state.timestamps.popleft()
+			state.offset += 1
+		return event
+
+	def _edge(self, state: _SymbolState, index: int) -> Optional[CfdEvent]:
+		"""Label the edge starting at the given position, applying the same filters as the batch labeller"""
+		start = state.closes[index - state.offset]
+		end = state.closes[index + 1 - state.offset]
+		if math.isnan(start) or math.isnan(end):
+			return None
+		if not state.seen_first_edge:
+			state.seen_first_edge = True
+			return None
+
+		pct_diff = 100.0 * (start - end) / start
+		# Welford's update, so the z-score includes this edge just as the batch z-score does
+		state.edges += 1
+		delta = pct_diff - state.mean
+		state.mean += delta / state.edges
+		state.m2 += delta * (pct_diff - state.mean)
+		if self.outlier_zscore_threshold is not None:
+			std = math.sqrt(state.m2 / state.edges)
+			if std == 0 or abs(pct_diff - state.mean) / std >= self.outlier_zscore_threshold:
+				return None
+		if abs(pct_diff) < self.pct_change_threshold:
+			return None
+
+		first = index - 1 - self.back_history
+		if first < 0:
+			return None
+		window = np.fromiter(islice(state.closes, first - state.offset, index + 1 - state.offset), np.float64)
+		if np.isnan(window).any():
+			return None
+		return np.datetime64(state.timestamps[index - state.offset], "ns"), pct_diff, window
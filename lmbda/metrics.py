@@ -0,0 +1,184 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import abc
+import functools
+import json
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# Units understood by CloudWatch; other sinks just carry them along
+COUNT = "Count"
+BYTES = "Bytes"
+SECONDS = "Seconds"
+
+# The active sink. Metrics are disabled while this is None, and every recording function returns immediately.
+_sink: Optional["MetricsSink"] = None
+
+
+class MetricsSink(metaclass=abc.ABCMeta):
+	"""Destination for recorded metrics"""
+
+	@abc.abstractmethod
+	def record(self, name: str, value: float, unit: str) -> None:
+		raise NotImplementedError
+
+	def flush(self) -> None:
+		"""Emit any buffered metrics"""
+		pass
+
+
+class RegistrySink(MetricsSink):
+	"""In-process registry aggregating each metric's count, sum, min and max, which can be dumped in the Prometheus
+	text exposition format"""
+
+	def __init__(self):
+		self._metrics: Dict[str, dict] = {}
+		self._lock = threading.Lock()
+
+	def record(self, name: str, value: float, unit: str) -> None:
+		with self._lock:
+			metric = self._metrics.get(name)
+			if metric is None:
+				self._metrics[name] = {"unit": unit, "count": 1, "sum": value, "min": value, "max": value}
+				return
+			metric["count"] += 1
+			metric["sum"] += value
+			metric["min"] = min(metric["min"], value)
+			metric["max"] = max(metric["max"], value)
+
+	def snapshot(self) -> Dict[str, dict]:
+		with self._lock:
+			return {name: dict(metric) for name, metric in self._metrics.items()}
+
+	def reset(self) -> None:
+		with self._lock:
+			self._metrics = {}
+
+	def prometheus(self) -> str:
+		"""Render the registry in the Prometheus text exposition format. Counts become counters, timings summaries."""
+		lines: List[str] = []
+		for name, metric in sorted(self.snapshot().items()):
+			name = "traitor_" + name.replace(".", "_")
+			if metric["unit"] == SECONDS:
+				lines += [f"# TYPE {name}_seconds summary",
+				          f"{name}_seconds_count {metric['count']}",
+				          f"{name}_seconds_sum {metric['sum']}"]
+			else:
+				suffix = "_bytes" if metric["unit"] == BYTES and not name.endswith("_bytes") else ""
+				lines += [f"# TYPE {name}{suffix}_total counter",
+				          f"{name}{suffix}_total {metric['sum']}"]
+		return "\n".join(lines) + "\n"
+
+
+class EmfSink(MetricsSink):
+	"""Buffers metrics and writes them to stdout in CloudWatch Embedded Metric Format on flush, which Lambda turns
+	into CloudWatch metrics without any API calls"""
+
+	def __init__(self, namespace: str = "traitor", stream=None):
+		self.namespace = namespace
+		self.stream = stream
+		self._values: Dict[str, List[float]] = {}
+		self._units: Dict[str, str] = {}
+		self._lock = threading.Lock()
+
+	def record(self, name: str, value: float, unit: str) -> None:
+		with self._lock:
+			self._values.setdefault(name, []).append(value)
+			self._units[name] = unit
+
+	def flush(self) -> None:
+		with self._lock:
+			values, self._values = self._values, {}
+		if len(values) == 0:
+			return
+		# EMF allows at most 100 metrics per document and 100 values per metric, so a metric's values are split into
+		# pages of 100 and each page goes out in its own round of documents. CloudWatch aggregates them all.
+		pages = {name: [values[name][i:i + 100] for i in range(0, len(values[name]), 100)] for name in values}
+		for page in range(max(len(metric) for metric in pages.values())):
+			names = sorted(name for name, metric in pages.items() if len(metric) > page)
+			for i in range(0, len(names), 100):
+				batch = names[i:i + 100]
+				document = {
+					"_aws": {
+						"Timestamp": int(time.time() * 1000),
+						"CloudWatchMetrics": [{
+							"Namespace": self.namespace,
+							"Dimensions": [[]],
+							"Metrics": [{"Name": name, "Unit": self._units[name]} for name in batch]
+						}]
+					}
+				}
+				for name in batch:
+					document[name] = pages[name][page]
+				print(json.dumps(document), file=self.stream or sys.stdout, flush=True)
+
+
+def set_sink(sink: Optional[MetricsSink]) -> None:
+	"""Start sending metrics to the given sink, or disable metrics entirely if it's None"""
+	global _sink
+	_sink = sink
+
+
+def get_sink() -> Optional[MetricsSink]:
+	return _sink
+
+
+def enabled() -> bool:
+	return _sink is not None
+
+
+def incr(name: str, value: float = 1, unit: str = COUNT) -> None:
+	"""Add to a counter"""
+	if _sink is not None:
+		_sink.record(name, value, unit)
+
+
+class timer:
+	"""Context manager recording the wall time of its block, in seconds"""
+	__slots__ = ("name", "start")
+
+	def __init__(self, name: str):
+		self.name = name
+
+	def __enter__(self):
+		if _sink is not None:
+			self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if _sink is not None and hasattr(self, "start"):
+			_sink.record(self.name, time.perf_counter() - self.start, SECONDS)
+
+
+def timed(name: str) -> Callable:
+	"""Annotation recording the wall time of every call to a function"""
+
+	def decorator(func: Callable) -> Callable:
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if _sink is None:
+				return func(*args, **kwargs)
+			start = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				_sink.record(name, time.perf_counter() - start, SECONDS)
+
+		return wrapper
+
+	return decorator
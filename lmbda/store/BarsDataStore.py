@@ -15,14 +15,26 @@
 #
 import abc
 import datetime
-from logging import info
-from typing import Dict, Set
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from logging import info, warning
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 
+import numpy as np
 import pandas as pd
-import pytz
 from alpaca_trade_api.rest import TimeFrame, REST
 
 from .api_client import uses_alpaca_client
+from .compact import to_epoch_ns
+
+# Date range covered by each request when streaming history, keyed by timeframe. Sized so that a single window of
+# bars stays comfortably small in memory. Timeframes without an entry, such as days, fetch the whole range at once.
+FETCH_WINDOWS = {
+	TimeFrame.Minute.value: datetime.timedelta(days=30),
+	TimeFrame.Hour.value: datetime.timedelta(days=365)
+}
+
+# Store shared by every task in a worker process, set once by the pool initializer
+_worker_store = None
 
 class BarsDataStore(metaclass=abc.ABCMeta):
 	"""Interface for a bars datastore that's capable of holding data in different backings"""
@@ -32,10 +44,57 @@ class BarsDataStore(metaclass=abc.ABCMeta):
 
 	@uses_alpaca_client
 	def _fetch_all_symbol_history(self, symbol: str, client: REST, delta=datetime.timedelta(days=(365 * 5))) -> pd.DataFrame:
+		chunks = list(self._stream_symbol_history(symbol, client=client, delta=delta))
+		return pd.concat(chunks) if len(chunks) > 0 else pd.DataFrame()
+
+	@uses_alpaca_client
+	def _stream_symbol_history(self, symbol: str, client: REST, delta=datetime.timedelta(days=(365 * 5)),
+	                           window: datetime.timedelta = None) -> Iterator[pd.DataFrame]:
+		"""Fetch history for a symbol one date window at a time, yielding each window's bars as it arrives"""
 		end = datetime.date.today() - datetime.timedelta(days=1)
 		start = end - delta
+		# The range includes both its start and end dates
+		window = window or FETCH_WINDOWS.get(self.timeframe.value, delta + datetime.timedelta(days=1))
 		info(f"Fetching all available history for symbol {symbol} from {start} to {end}")
-		return client.get_bars(symbol, self.timeframe, str(start), str(end)).df
+		while start <= end:
+			window_end = min(start + window - datetime.timedelta(days=1), end)
+			df = client.get_bars(symbol, self.timeframe, str(start), str(window_end)).df
+			if len(df) > 0:
+				yield df
+			start = window_end + datetime.timedelta(days=1)
+
+	@uses_alpaca_client
+	def _fetch_many_symbols_history(self, symbols: List[str], client: REST,
+	                                start: datetime.date) -> Dict[str, pd.DataFrame]:
+		"""Fetch history for many symbols from start until yesterday in one multi-symbol request, split by symbol"""
+		end = datetime.date.today() - datetime.timedelta(days=1)
+		info(f"Fetching history for {len(symbols)} symbols from {start} to {end}")
+		df = client.get_bars(symbols, self.timeframe, str(start), str(end)).df
+		if len(df) == 0:
+			return {}
+		return {symbol: data.drop(columns="symbol") for symbol, data in df.groupby("symbol")}
+
+	@staticmethod
+	def _empty_bars(columns: List[str] = None) -> pd.DataFrame:
+		"""Bars with no rows, for queries that no stored partition covers"""
+		return pd.DataFrame(columns=columns or [], index=pd.DatetimeIndex([], tz="UTC", name="timestamp"),
+		                    dtype=np.float64)
+
+	@staticmethod
+	def _complete_partitions(chunks: Iterable[pd.DataFrame],
+	                         key: Callable[[pd.DatetimeIndex], pd.Index]) -> Iterator[Tuple[int, pd.DataFrame]]:
+		"""Regroup a chronological stream of chunks into partitions, yielding each partition as soon as data for a
+		later one arrives. Only a single partition plus the current chunk are ever held in memory."""
+		current, buffer = None, []
+		for chunk in chunks:
+			for partition, df in chunk.groupby(key(chunk.index)):
+				if current is not None and partition != current:
+					yield current, pd.concat(buffer)
+					buffer = []
+				current = partition
+				buffer.append(df)
+		if len(buffer) > 0:
+			yield current, pd.concat(buffer)
 
 	@abc.abstractmethod
 	def __contains__(self, symbol: str) -> bool:
@@ -61,16 +120,68 @@ class BarsDataStore(metaclass=abc.ABCMeta):
 
 	@abc.abstractmethod
 	def bars(self, symbol: str, start: datetime.date = None,
-	         end: datetime.date = None) -> pd.DataFrame:
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
 		"""Retrieve bars from the given date range. Returns all data if no range is provided. Only queries locally
-		cached data. If start is provided but end is not, returns all data until start, and vice versa."""
+		cached data. If start is provided but end is not, returns all data until start, and vice versa. If columns
+		is provided, only those columns are returned. If compact is set, bars are returned in the compact schema
+		described in lmbda.store.compact."""
 		raise NotImplementedError
 
+	def panel(self, symbols: Iterable[str], start: datetime.date = None, end: datetime.date = None,
+	          field: str = "close", fill: Union[str, float] = None, limit: int = None, workers: int = 8,
+	          compact: bool = False) -> pd.DataFrame:
+		"""Get one field for many symbols as a single wide frame, with a column per symbol over the union of their
+		timestamps. Symbols are read in parallel and written straight into one contiguous float64 block, so
+		.to_numpy() on the result is free.
+		:param symbols: Symbols to include, in column order
+		:param start: First date to include, if any
+		:param end: Last date to include, if any
+		:param field: Bar column to read, e.g. close or volume
+		:param fill: How to fill bars missing for a symbol: None leaves NaN, "ffill" carries the last known value
+		forward (never backward, so there's no look-ahead), "drop" drops timestamps missing for any symbol, and a
+		number fills with that constant
+		:param limit: Maximum number of consecutive bars to forward fill
+		:param workers: Number of threads reading symbols
+		:param compact: Whether to return a float32 block indexed by int64 epoch-ns timestamps instead
+		:return: Wide frame indexed by timestamp, with a column per symbol"""
+		symbols = [symbol.upper() for symbol in symbols]
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			columns = list(executor.map(lambda symbol: self._panel_column(symbol, start, end, field), symbols))
+
+		timestamps = [column.index.values for column in columns if len(column) > 0]
+		index = pd.DatetimeIndex(np.unique(np.concatenate(timestamps)) if len(timestamps) > 0 else [],
+		                         name="timestamp").tz_localize("UTC")
+		dtype = np.float32 if compact else np.float64
+		values = np.full((len(index), len(symbols)), np.nan, dtype=dtype)
+		for i, column in enumerate(columns):
+			values[index.get_indexer(column.index), i] = column.to_numpy(dtype=dtype)
+		if compact:
+			index = pd.Index(to_epoch_ns(index), name="timestamp")
+		df = pd.DataFrame(values, index=index, columns=symbols, copy=False)
+
+		if fill == "ffill":
+			df = df.ffill(limit=limit)
+		elif fill == "drop":
+			df = df.dropna()
+		elif fill is not None:
+			df = df.fillna(fill)
+		return df
+
+	def _panel_column(self, symbol: str, start: datetime.date, end: datetime.date, field: str) -> pd.Series:
+		if symbol not in self:
+			warning(f"Symbol {symbol} not found in store, leaving its panel column empty")
+			return pd.Series([], index=pd.DatetimeIndex([], tz="UTC"), dtype=np.float64)
+		return self.bars(symbol, start, end, columns=[field])[field]
+
 	@abc.abstractmethod
 	def last(self, symbol: str) -> pd.DataFrame:
 		"""Get the last data point in the store for the given symbol"""
 		raise NotImplementedError
 
+	def last_timestamp(self, symbol: str) -> pd.Timestamp:
+		"""Get the timestamp of the last data point in the store for the given symbol"""
+		return self.last(symbol).index[0]
+
 	@abc.abstractmethod
 	def update(self, symbol: str, data: pd.DataFrame) -> None:
 		"""Update the store data for the given symbol with the provided data"""
@@ -81,6 +192,47 @@ class BarsDataStore(metaclass=abc.ABCMeta):
 		"""Delete all data for a symbol"""
 		raise NotImplementedError
 
+	def update_many(self, updates: Dict[str, pd.DataFrame], workers: int = 8,
+	                processes: bool = False) -> Dict[str, Exception]:
+		"""
+		Update many symbols in parallel, each under the store's own per-symbol locking, so updates to different symbols
+		proceed side by side while readers and other writers stay safe.
+		:param updates: New bars keyed by symbol
+		:param workers: Number of workers
+		:param processes: Whether to update on a pool of processes rather than threads, for when writes are bound by
+		compression or serialization rather than I/O
+		:return: The symbols that failed to update, mapped to the error raised"""
+		if processes:
+			executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self,))
+		else:
+			executor = ThreadPoolExecutor(max_workers=workers)
+		failures: Dict[str, Exception] = {}
+		with executor:
+			futures = {executor.submit(_update_worker if processes else self.update, symbol, df): symbol
+			           for symbol, df in updates.items()}
+			for future in as_completed(futures):
+				try:
+					future.result()
+				except Exception as e:
+					warning(f"Failed to update {futures[future]}: {e}")
+					failures[futures[future]] = e
+		info(f"Updated {len(updates) - len(failures)}/{len(updates)} symbols")
+		return failures
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		"""Get the name and row count of each partition stored for a symbol. Stores that don't partition their data
+		report it all as a single partition."""
+		return {"all": len(self.bars(symbol, columns=["close"]))}
+
+	def rows(self, symbol: str) -> int:
+		"""Get the number of bars stored for a symbol. Stores whose partitions overlap count each bar once."""
+		return sum(self.partitions(symbol).values())
+
+	def compact(self, symbol: str) -> None:
+		"""Fold any pending write segments for a symbol back into its base partitions. Stores that rewrite partitions
+		in place have nothing to do."""
+		pass
+
 	@abc.abstractmethod
 	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
 		str, datetime.timedelta]:
@@ -88,19 +240,52 @@ class BarsDataStore(metaclass=abc.ABCMeta):
 		time delta (default: 3 days)"""
 		raise NotImplementedError
 
-	def flush_updates(self, symbols: Set[str]) -> None:
-		"""Update the list of given symbols with the latest available data"""
+	def flush_updates(self, symbols: Set[str], batch_size: int = 100, workers: int = 8, client: REST = None) -> None:
+		"""Update the list of given symbols with the latest available data. Symbols needing data from the same date
+		are fetched together, batch_size at a time, and the results written to the store on a pool of workers."""
 		if any([symbol not in self for symbol in symbols]):
 			raise ValueError(f"Symbol list {symbols} contained symbol not already in store")
 
-		now = pd.Timestamp("now", tz=pytz.utc)
-		# For each symbol, calculate the time delta and get the most recent
-		for symbol in symbols:
-			delta: datetime.timedelta = now - self.last(symbol).index.to_series()[0]
-			data = self._fetch_all_symbol_history(symbol, delta=delta)
-			self.update(symbol, data)
+		# Group symbols by the date of their last bar, which is where their refresh has to start
+		starts: Dict[datetime.date, List[str]] = {}
+		for symbol in sorted(symbol.upper() for symbol in symbols):
+			starts.setdefault(self.last_timestamp(symbol).date(), []).append(symbol)
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = []
+			for start, group in sorted(starts.items()):
+				for i in range(0, len(group), batch_size):
+					data = self._fetch_many_symbols_history(group[i:i + batch_size], client=client, start=start)
+					futures += [executor.submit(self.update, symbol, df) for symbol, df in data.items()]
+			for future in futures:
+				future.result()
+
+	@abc.abstractmethod
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		"""Add a symbol to the store, streaming all available data for it into storage and returning the last bar
+		stored. An explicit Alpaca client may be provided, otherwise the shared one is used. History is written one
+		window at a time and never held in memory in full, so unlike earlier versions, the full history isn't returned;
+		read it back with bars() instead. If any window fails, whatever was written is removed, so a symbol is never
+		left in the store with only part of its history."""
+		raise NotImplementedError
 
 	@abc.abstractmethod
-	def add(self, symbol: str) -> pd.DataFrame:
-		"""Add a symbol to the store, querying all available data for it and returning the results."""
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		"""Add a symbol to the store from bars already in hand, rather than fetching its history"""
 		raise NotImplementedError
+
+
+def init_worker(store) -> None:
+	"""Process pool initializer handing every worker the store its tasks share, pickled once per worker rather than
+	once per task. Anything else the tasks share, such as a FeatureStore, may be handed over the same way."""
+	global _worker_store
+	_worker_store = store
+
+
+def worker_store():
+	"""Get the store handed to this worker process by init_worker"""
+	return _worker_store
+
+
+def _update_worker(symbol: str, data: pd.DataFrame) -> None:
+	_worker_store.update(symbol, data)
@@ -0,0 +1,187 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import threading
+from collections import OrderedDict
+from logging import debug
+from typing import Dict, List, Set
+
+import pandas as pd
+import pytz
+from alpaca_trade_api.rest import REST
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.compact import to_compact
+
+
+class CachedBarsDataStore(BarsDataStore):
+	"""Wraps any other data store, keeping each symbol's fully decoded bars in an LRU cache bounded by a byte budget.
+	Range and column queries are answered by slicing the cached bars. Writes through this store invalidate the
+	affected symbols."""
+
+	def __init__(self, store: BarsDataStore, max_bytes: int = 1 << 30):
+		super().__init__(store.timeframe)
+		self.store = store
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._bytes = 0
+		self._cache: OrderedDict = OrderedDict()
+		self._generations: Dict[str, int] = {}
+		self._lock = threading.RLock()
+
+	def __contains__(self, symbol: str) -> bool:
+		return symbol in self.store
+
+	def symbols(self) -> Set[str]:
+		return self.store.symbols()
+
+	def bars(self, symbol: str, start: datetime.date = None,
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
+		df = self._get(symbol)
+		if start is not None:
+			df = df.iloc[df.index.searchsorted(pd.Timestamp(start, tz=pytz.utc)):]
+		if end is not None:
+			df = df.iloc[:df.index.searchsorted(pd.Timestamp(end + datetime.timedelta(days=1), tz=pytz.utc))]
+		if columns is not None:
+			df = df[columns]
+
+		# Callers are free to modify what they get back, so they never receive the cached frame itself. Compacting
+		# already makes a copy.
+		return to_compact(df) if compact else df.copy()
+
+	def last(self, symbol: str) -> pd.DataFrame:
+		with self._lock:
+			if symbol.upper() in self._cache:
+				return self._cache[symbol.upper()][0].tail(n=1).copy()
+		return self.store.last(symbol)
+
+	def last_timestamp(self, symbol: str) -> pd.Timestamp:
+		return self.store.last_timestamp(symbol)
+
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		try:
+			self.store.update(symbol, data)
+		finally:
+			self.invalidate(symbol)
+
+	def remove(self, symbol: str) -> None:
+		try:
+			self.store.remove(symbol)
+		finally:
+			self.invalidate(symbol)
+
+	def update_many(self, updates: Dict[str, pd.DataFrame], workers: int = 8,
+	                processes: bool = False) -> Dict[str, Exception]:
+		try:
+			return self.store.update_many(updates, workers=workers, processes=processes)
+		finally:
+			for symbol in updates:
+				self.invalidate(symbol)
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		return self.store.partitions(symbol)
+
+	def rows(self, symbol: str) -> int:
+		return self.store.rows(symbol)
+
+	def compact(self, symbol: str) -> None:
+		self.store.compact(symbol)
+
+	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
+		str, datetime.timedelta]:
+		return self.store.get_out_of_date_symbols(threshold)
+
+	def flush_updates(self, symbols: Set[str], batch_size: int = 100, workers: int = 8, client: REST = None) -> None:
+		try:
+			self.store.flush_updates(symbols, batch_size=batch_size, workers=workers, client=client)
+		finally:
+			for symbol in symbols:
+				self.invalidate(symbol)
+
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		try:
+			return self.store.add(symbol, client=client)
+		finally:
+			self.invalidate(symbol)
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		try:
+			self.store.put(symbol, data)
+		finally:
+			self.invalidate(symbol)
+
+	def invalidate(self, symbol: str) -> None:
+		"""Drop a symbol's bars from the cache"""
+		with self._lock:
+			self._generations[symbol.upper()] = self._generations.get(symbol.upper(), 0) + 1
+			entry = self._cache.pop(symbol.upper(), None)
+			if entry is not None:
+				self._bytes -= entry[1]
+
+	def clear(self) -> None:
+		with self._lock:
+			self._cache.clear()
+			self._bytes = 0
+
+	def stats(self) -> Dict[str, int]:
+		"""Get hit, miss and eviction counts, along with the cache's current size"""
+		with self._lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"entries": len(self._cache),
+				"bytes": self._bytes
+			}
+
+	def _get(self, symbol: str) -> pd.DataFrame:
+		"""Get all bars for a symbol, from the cache if possible"""
+		symbol = symbol.upper()
+		with self._lock:
+			if symbol in self._cache:
+				self.hits += 1
+				metrics.incr("cache.hits")
+				self._cache.move_to_end(symbol)
+				return self._cache[symbol][0]
+			self.misses += 1
+			metrics.incr("cache.misses")
+			generation = self._generations.get(symbol, 0)
+
+		df = self.store.bars(symbol)
+		size = self._size(df)
+		if size > self.max_bytes:
+			debug(f"Bars for {symbol} ({size} bytes) exceed the cache budget, not caching")
+			return df
+
+		with self._lock:
+			# Bars loaded while the symbol was being written to may already be stale
+			if symbol not in self._cache and self._generations.get(symbol, 0) == generation:
+				self._cache[symbol] = (df, size)
+				self._bytes += size
+			while self._bytes > self.max_bytes:
+				evicted, (_, evicted_size) = self._cache.popitem(last=False)
+				self._bytes -= evicted_size
+				self.evictions += 1
+				metrics.incr("cache.evictions")
+				debug(f"Evicted {evicted} from bars cache")
+		return df
+
+	@staticmethod
+	def _size(df: pd.DataFrame) -> int:
+		return int(df.memory_usage(deep=True, index=True).sum())
@@ -0,0 +1,149 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import logging
+from logging import info
+from pathlib import Path
+from typing import Callable, Dict, List, Set
+
+import pandas as pd
+from alpaca_trade_api.rest import REST, TimeFrame
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.resample import RULES, resample_bars
+
+
+class DerivedBarsDataStore(BarsDataStore):
+	"""Serves bars of a coarser timeframe derived from a store of minute bars. Resampled bars are materialized into a
+	separate target store and brought up to date on read whenever new minute bars have arrived, recomputing only from
+	the start of the last materialized bin, which may have been partial. Minute data only ever needs to be fetched
+	from Alpaca once; every derived timeframe is built from it."""
+
+	def __init__(self, source: BarsDataStore, target: BarsDataStore, rule: str, regular_hours: bool = True):
+		super().__init__(target.timeframe)
+		if rule not in RULES:
+			raise ValueError(f"Unknown resampling rule {rule}, expected one of {', '.join(RULES)}")
+		self.source = source
+		self.target = target
+		self.rule = rule
+		self.regular_hours = regular_hours
+		# Last source timestamp that each symbol's derived bars were built from, in this process
+		self._watermarks: Dict[str, pd.Timestamp] = {}
+
+	def __contains__(self, symbol: str) -> bool:
+		return symbol in self.source
+
+	def symbols(self) -> Set[str]:
+		return self.source.symbols()
+
+	def bars(self, symbol: str, start: datetime.date = None,
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
+		self.refresh(symbol)
+		return self.target.bars(symbol, start, end, columns, compact)
+
+	def last(self, symbol: str) -> pd.DataFrame:
+		self.refresh(symbol)
+		return self.target.last(symbol)
+
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		"""Update the source store with new minute bars, then the derived bars built from them"""
+		self.source.update(symbol, data)
+		self.refresh(symbol)
+
+	def remove(self, symbol: str) -> None:
+		"""Delete the derived bars for a symbol. Its minute bars are kept, so it will be rebuilt if read again."""
+		symbol = symbol.upper()
+		if symbol in self.target:
+			self.target.remove(symbol)
+		self._watermarks.pop(symbol, None)
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		self.refresh(symbol)
+		return self.target.partitions(symbol)
+
+	def rows(self, symbol: str) -> int:
+		self.refresh(symbol)
+		return self.target.rows(symbol)
+
+	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
+		str, datetime.timedelta]:
+		return self.source.get_out_of_date_symbols(threshold)
+
+	def flush_updates(self, symbols: Set[str], batch_size: int = 100, workers: int = 8, client: REST = None) -> None:
+		self.source.flush_updates(symbols, batch_size=batch_size, workers=workers, client=client)
+		for symbol in symbols:
+			self.refresh(symbol)
+
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		"""Add a symbol's minute history to the source store if it isn't there already, then derive from it"""
+		if symbol not in self.source:
+			self.source.add(symbol, client=client)
+		self.refresh(symbol)
+		return self.target.last(symbol)
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		self.source.put(symbol, data)
+		self.refresh(symbol)
+
+	@metrics.timed("resample.refresh")
+	def refresh(self, symbol: str) -> None:
+		"""Bring a symbol's derived bars up to date with its minute bars"""
+		symbol = symbol.upper()
+		last = self.source.last_timestamp(symbol)
+		if self._watermarks.get(symbol) == last:
+			return
+
+		if symbol not in self.target:
+			info(f"Materializing {self.rule} bars for {symbol}")
+			self.target.put(symbol, resample_bars(self.source.bars(symbol), self.rule, self.regular_hours))
+		else:
+			# Everything from the last bin onwards is rebuilt, since that bin may have been built from a partial set of
+			# minutes. Bins never span sessions, so reading from the bin's date covers all of its minutes.
+			since = self.target.last_timestamp(symbol)
+			info("Updating %s bars for %s from %s", self.rule, symbol, since)
+			df = resample_bars(self.source.bars(symbol, start=since.date()), self.rule, self.regular_hours)
+			df = df[df.index >= since]
+			if len(df) > 0:
+				self.target.update(symbol, df)
+			metrics.incr("resample.rows_updated", len(df))
+		self._watermarks[symbol] = last
+
+
+def materialize(source: BarsDataStore, data_dir: str, rules: List[str] = None,
+                store: Callable[[TimeFrame, str], BarsDataStore] = None) -> Dict[str, DerivedBarsDataStore]:
+	"""Set up derived stores for each rule (every rule in RULES by default) under data_dir/[RULE], backed by Parquet
+	stores unless another store factory is provided"""
+	if store is None:
+		from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+		store = ParquetBarsDataStore
+	Path(data_dir).mkdir(parents=True, exist_ok=True)
+	timeframes = {"1Hour": TimeFrame.Hour, "1Day": TimeFrame.Day}
+	return {rule: DerivedBarsDataStore(source, store(timeframes.get(rule, TimeFrame.Minute), str(Path(data_dir) / rule)),
+	                                   rule)
+	        for rule in (rules or RULES)}
+
+
+if __name__ == '__main__':
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
+	from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+	derived = materialize(PandasBarsDataStore(TimeFrame.Minute, "data/history/minute"), "data/history/derived")
+
+	print("GME 15 minute bars for the last week:")
+	print(derived["15Min"].bars("gme", start=datetime.date.today() - datetime.timedelta(days=7)))
+
+	print("GME daily closes for the last month:")
+	print(derived["1Day"].bars("gme", start=datetime.date.today() - datetime.timedelta(days=30), columns=["close"]))
@@ -0,0 +1,134 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, warning
+from typing import Dict, Iterable, List, Set
+
+import pandas as pd
+from alpaca_trade_api.rest import REST
+
+from lmbda.store import BarsDataStore
+from lmbda.store.metadata import SymbolMetadataTable
+
+
+class MetadataBarsDataStore(BarsDataStore):
+	"""Wraps any other data store, writing each symbol's last bar, row count and partition list through to a DynamoDB
+	metadata table whenever the symbol is written. Last timestamps and staleness checks are then answered from the
+	table, without opening any data; everything else is read from the wrapped store.
+	Row counts are summed from partition row counts, which stores keep without reading any bars, so a write never
+	costs a read of the data it didn't touch. For stores with overlapping partitions, such as the delta segments of
+	PandasBarsDataStore, that counts bars replaced since the last compaction twice, and compact() records the exact
+	count."""
+
+	def __init__(self, store: BarsDataStore, table: SymbolMetadataTable):
+		super().__init__(store.timeframe)
+		self.store = store
+		self.table = table
+
+	def __contains__(self, symbol: str) -> bool:
+		return symbol in self.store
+
+	def symbols(self) -> Set[str]:
+		return self.store.symbols()
+
+	def bars(self, symbol: str, start: datetime.date = None,
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
+		return self.store.bars(symbol, start, end, columns=columns, compact=compact)
+
+	def last(self, symbol: str) -> pd.DataFrame:
+		return self.store.last(symbol)
+
+	def last_timestamp(self, symbol: str) -> pd.Timestamp:
+		metadata = self.table.get(symbol)
+		if metadata is None:
+			return self.store.last_timestamp(symbol)
+		return pd.Timestamp(metadata.last_timestamp)
+
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		self.store.update(symbol, data)
+		self.record(symbol)
+
+	def remove(self, symbol: str) -> None:
+		self.store.remove(symbol)
+		self.table.remove(symbol)
+
+	def update_many(self, updates: Dict[str, pd.DataFrame], workers: int = 8,
+	                processes: bool = False) -> Dict[str, Exception]:
+		failures = self.store.update_many(updates, workers=workers, processes=processes)
+		self.sync((symbol for symbol in updates if symbol not in failures), workers=workers)
+		return failures
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		return self.store.partitions(symbol)
+
+	def rows(self, symbol: str) -> int:
+		return self.store.rows(symbol)
+
+	def compact(self, symbol: str) -> None:
+		self.store.compact(symbol)
+		self.record(symbol, exact=True)
+
+	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
+		str, datetime.timedelta]:
+		symbols = self.symbols()
+		now = pd.Timestamp("now", tz="UTC")
+		found = self.table.batch_get(symbols)
+		ages = {symbol: metadata.age(now) for symbol, metadata in found.items()}
+
+		# Symbols written around this store have no metadata yet, so the wrapped store has to judge them
+		missing = symbols - set(found)
+		if len(missing) > 0:
+			warning(f"{len(missing)} symbols have no metadata, reading their last bars instead")
+			ages.update({symbol: now - self.store.last_timestamp(symbol) for symbol in missing})
+		return {symbol: age for symbol, age in ages.items() if age > threshold}
+
+	def flush_updates(self, symbols: Set[str], batch_size: int = 100, workers: int = 8, client: REST = None) -> None:
+		try:
+			self.store.flush_updates(symbols, batch_size=batch_size, workers=workers, client=client)
+		finally:
+			self.sync(symbols, workers=workers)
+
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		last = self.store.add(symbol, client=client)
+		self.record(symbol)
+		return last
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		self.store.put(symbol, data)
+		self.record(symbol)
+
+	def record(self, symbol: str, exact: bool = False) -> None:
+		"""Write a symbol's current metadata to the table, counting its rows exactly rather than summing its partitions
+		if exact is set"""
+		self.table.record(*self._metadata(symbol, exact))
+
+	def sync(self, symbols: Iterable[str] = None, workers: int = 8) -> None:
+		"""Write metadata for the given symbols, or every symbol in the store, as when first creating the table or
+		after writing to the wrapped store directly. Last bars are read on a pool of threads and the results written in
+		batches."""
+		symbols = sorted(self.symbols() if symbols is None else {symbol.upper() for symbol in symbols})
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			records = dict(zip(symbols, executor.map(
+				lambda symbol: self._metadata(symbol) if symbol in self.store else None, symbols)))
+		self.table.record_many([record for record in records.values() if record is not None],
+		                       removed=[symbol for symbol, record in records.items() if record is None])
+		info(f"Synced metadata for {len(symbols)} symbols")
+
+	def _metadata(self, symbol: str, exact: bool = False) -> tuple:
+		"""Arguments to SymbolMetadataTable.record describing a symbol as currently stored"""
+		rows = self.store.rows(symbol) if exact else None
+		return symbol, self.store.last(symbol), self.store.partitions(symbol), rows
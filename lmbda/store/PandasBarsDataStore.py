@@ -19,128 +19,291 @@ import shutil
 from abc import ABC
 from logging import info, warn
 from pathlib import Path
-from typing import Dict, Set
+from typing import Dict, List, Set, Tuple
 
 import pandas as pd
 import pytz
-from alpaca_trade_api.rest import TimeFrame
+from alpaca_trade_api.rest import REST, TimeFrame
 
+from lmbda import metrics
 from lmbda.store import BarsDataStore
+from lmbda.store.compact import to_compact
+from lmbda.store.locking import SymbolLocks, atomic_path
+from lmbda.store.symbol_index import SymbolIndex
+
+
+def segment_key(name: str) -> Tuple[int, int]:
+	"""Sort key for partition files: a year's base file ([YEAR].pkl.gz) comes first, followed by its delta segments
+	([YEAR].delta-[SEQ].pkl.gz) in the order they were written"""
+	parts = name.split(".")
+	return int(parts[0]), int(parts[1][len("delta-"):]) if parts[1].startswith("delta-") else 0
 
 
 class PandasBarsDataStore(BarsDataStore, ABC):
 	"""Data store that stores data in a provided folder, in the form of bz2 daily dataframes.
-	Dataframes are stored in a hierarchy of data_dir/symbol/[YEAR].pkl.gz """
+	Dataframes are stored in a hierarchy of data_dir/symbol/[YEAR].pkl.gz, with a manifest of every symbol's
+	partitions kept as one small data_dir/.index/[SYMBOL].json file per symbol. Updates are appended as small data_dir/symbol/[YEAR].delta-[SEQ].pkl.gz
+	segments which are merged on read, and folded back into the year files once max_segments accumulate.
+	Every file is written to a temporary path and renamed into place, and writers hold a per-symbol lock file under
+	data_dir/.locks, so several processes can write to one store while others read from it. """
 
-	def __init__(self, timeframe: TimeFrame, data_dir: str):
+	def __init__(self, timeframe: TimeFrame, data_dir: str, max_segments: int = 16):
 		super().__init__(timeframe)
+		self.max_segments = max_segments
 		info(f"Initializing new daily datastore on a {timeframe} timeframe at {data_dir}")
 		self.data_dir = Path(data_dir).resolve()
 		self.data_dir.mkdir(exist_ok=True)
+		self._index = SymbolIndex(self.data_dir / ".index")
+		self._locks = SymbolLocks(self.data_dir / ".locks")
+		if not self._index.loaded and next(self.data_dir.rglob("*.pkl.gz"), None) is not None:
+			warn(f"No index found for existing datastore at {data_dir}, rebuilding")
+			self.rebuild_index()
 
 	def __contains__(self, symbol: str) -> bool:
-		return len(list((self.data_dir / symbol.upper()).rglob("*.pkl.gz"))) > 0
+		self._index.refresh(symbol)
+		return symbol.upper() in self._index
 
 	def symbols(self) -> Set[str]:
-		return {str(path).split("/")[-2] for path in self.data_dir.rglob("*.pkl.gz")}
+		self._index.refresh()
+		return self._index.symbols()
 
+	@metrics.timed("store.bars")
 	def bars(self, symbol: str, start: datetime.date = None,
-	         end: datetime.date = None) -> pd.DataFrame:
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
 		symbol = symbol.upper()
-		info(f"Retrieving stored bars for {symbol} from {start} to {end}")
-		df_paths = list((self.data_dir / symbol.upper()).glob("*.pkl.gz"))
-		if start is None and end is not None:
-			# Get all data *except* after the current year
-			df_paths = list(filter(lambda path: int(path.name.split(".")[0]) <= end.year, df_paths))
-		elif start is not None and end is None:
-			df_paths = list(filter(lambda path: int(path.name.split(".")[0]) >= start.year, df_paths))
-		elif start is not None and end is not None:
-			df_paths = list(filter(lambda path: start.year <= int(path.name.split(".")[0]) <= end.year, df_paths))
-
-		df = pd.concat([pd.read_pickle(path) for path in df_paths])
+		info("Retrieving stored bars for %s from %s to %s", symbol, start, end)
+		self._index.refresh(symbol)
+		try:
+			df = self._read_years(symbol, start, end, columns)
+		except FileNotFoundError:
+			# A compaction in another process removed segments after this process last read the index
+			self._index.refresh(symbol)
+			df = self._read_years(symbol, start, end, columns)
 		if start is None and end is not None:
 			df = df[df.index.to_series().dt.date <= end]
 		elif start is not None and end is None:
 			df = df[df.index.to_series().dt.date >= start]
 		elif start is not None and end is not None:
 			df = df[(start <= df.index.to_series().dt.date) & (df.index.to_series().dt.date <= end)]
+		if columns is not None:
+			df = df[columns]
 		df.sort_index(inplace=True)
-		return df
+		metrics.incr("store.rows_returned", len(df))
+		return to_compact(df) if compact else df
 
 	def remove(self, symbol: str) -> None:
 		warn(f"Deleting all data for {symbol}")
 		symbol = symbol.upper()
-		if symbol not in self:
-			raise ValueError(f"Symbol {symbol} not found in store")
-		shutil.rmtree(self.data_dir / symbol)
+		with self._locks(symbol):
+			if symbol not in self:
+				raise ValueError(f"Symbol {symbol} not found in store")
+			# The symbol leaves the index first, so readers never look for files that are being deleted
+			self._index.discard(symbol)
+			self._index.save([symbol])
+			shutil.rmtree(self.data_dir / symbol)
 
 	def last(self, symbol: str) -> pd.DataFrame:
 		# Get the the most current year's dataframe, then get its last row
 		symbol = symbol.upper()
 		if symbol not in self:
 			raise ValueError(f"Symbol {symbol} not found in store")
-		df: pd.DataFrame = pd.read_pickle(
-			sorted((self.data_dir / symbol.upper()).glob("*.pkl.gz"), key=lambda path: str(path))[-1])
+		try:
+			df = self._read_last_partition(symbol)
+		except FileNotFoundError:
+			self._index.refresh(symbol)
+			df = self._read_last_partition(symbol)
 		df.sort_index(inplace=True)
 		return df.tail(n=1)
 
-	def update(self, symbol: str, data: pd.DataFrame) -> None:
+	def last_timestamp(self, symbol: str) -> pd.Timestamp:
 		symbol = symbol.upper()
-		info(f"Updating symbol {symbol} with {len(data)} potentially new rows")
 		if symbol not in self:
 			raise ValueError(f"Symbol {symbol} not found in store")
+		return self._index.last(symbol)
 
-		data.sort_index(inplace=True)
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		"""Row counts come from the index, without reading any files. Delta segments count the rows they override."""
+		self._index.refresh(symbol)
+		return {name: partition["rows"] for name, partition in self._index.partitions(symbol).items()}
 
-		# Get the first and last data points, then load in the dataframes for the corresponding years
-		start: pd.Timestamp = data.head(n=1).index.to_series()[0]
-		end: pd.Timestamp = data.tail(n=1).index.to_series()[0]
-		df_paths = list(filter(lambda path: start.year <= int(path.name.split(".")[0]) <= end.year,
-		                       list((self.data_dir / symbol.upper()).glob("*.pkl.gz"))))
-		df = pd.concat([pd.read_pickle(path) for path in df_paths])
+	def rows(self, symbol: str) -> int:
+		"""Years without delta segments are counted from the index. Years with them are read, so that rows a delta
+		segment overrides are only counted once."""
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			partitions = self.partitions(symbol)
+			years: Dict[int, List[str]] = {}
+			for name in sorted(partitions, key=segment_key):
+				years.setdefault(segment_key(name)[0], []).append(name)
+			return sum(partitions[names[0]] if len(names) == 1 else
+			           len(self._read_segments([self.data_dir / symbol / name for name in names]))
+			           for names in years.values())
 
-		# Add the new data and sort. This overrides duplicates.
-		if len(df) > 0:
-			df = pd.concat([df, data])
-			df = df[~df.index.duplicated(keep="last")]
-		else:
-			df = data
-		df.sort_index(inplace=True)
+	@metrics.timed("store.update")
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		info("Updating symbol %s with %d potentially new rows", symbol, len(data))
+		with self._locks(symbol):
+			if symbol not in self:
+				raise ValueError(f"Symbol {symbol} not found in store")
 
-		# Delete the old dataframes and save the new dataframes
-		for path in df_paths:
-			path.unlink()
-		self._save_in_year_chunks(symbol, df)
+			# New data is written as a delta segment per touched year rather than rewriting the year. Segments are
+			# merged on read with later segments overriding duplicates.
+			basepath = self.data_dir / symbol
+			segments: Dict[int, int] = {}
+			for year, seq in map(segment_key, self._index.partitions(symbol)):
+				segments[year] = max(segments.get(year, 0), seq)
+			data = data.sort_index()
+			for year, df in data.groupby(data.index.year):
+				segments[year] = segments.get(year, 0) + 1
+				path = basepath / f"{year}.delta-{segments[year]:06d}.pkl.gz"
+				self._write_pickle(df, path)
+				self._index.record(symbol, path.name, df)
+			self._index.save([symbol])
+
+			if any(seq >= self.max_segments for seq in segments.values()):
+				self.compact(symbol)
+
+	@metrics.timed("store.compact")
+	def compact(self, symbol: str) -> None:
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			if symbol not in self:
+				raise ValueError(f"Symbol {symbol} not found in store")
+
+			# The merged year file replaces the old one atomically, and segments are dropped from the index before
+			# they're deleted. An interrupted compaction only leaves behind segments that re-apply data already in the
+			# year file, and readers holding an older index retry once they find a segment missing.
+			years: Dict[int, List[Path]] = {}
+			for path in self._partition_paths(symbol):
+				years.setdefault(segment_key(path.name)[0], []).append(path)
+			deltas: List[Path] = []
+			for year, paths in years.items():
+				if len(paths) == 1 and segment_key(paths[0].name)[1] == 0:
+					continue
+				info(f"Compacting {len(paths)} segments of {symbol} for {year}")
+				df = self._read_segments(paths)
+				df.sort_index(inplace=True)
+				self._save_in_year_chunks(symbol, df)
+				deltas += [path for path in paths if segment_key(path.name)[1] > 0]
+			if len(deltas) == 0:
+				return
+			for path in deltas:
+				self._index.discard(symbol, path.name)
+			self._index.save([symbol])
+			for path in deltas:
+				path.unlink()
 
 	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
 		str, datetime.timedelta]:
-		# Get a list of all symbols and map it to a list of all the most recent data points
-		last_data_points: Dict[str, pd.DataFrame] = {symbol: self.last(symbol) for symbol in
-		                                             self.symbols()}
+		# Last timestamps all come from the index, so no data files need to be read
+		self._index.refresh()
 		out_of_date_symbols: Dict[str, datetime.timedelta] = {}
 		now = pd.Timestamp("now", tz=pytz.utc)
-		for symbol, data in last_data_points.items():
-			if now - data.index.to_series()[0] > threshold:
-				out_of_date_symbols[symbol] = now - data.index.to_series()[0]
+		for symbol in self.symbols():
+			last = self._index.last(symbol)
+			if now - last > threshold:
+				out_of_date_symbols[symbol] = now - last
 		return out_of_date_symbols
 
-	def add(self, symbol: str) -> pd.DataFrame:
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
 		symbol = symbol.upper()
-		if symbol in self:
-			raise ValueError(f"Attempting to add duplicate symbol {symbol}, use flush_updates or update_symbol data instead")
-		info(f"Adding {symbol} to store")
-		data = self._fetch_all_symbol_history(symbol)
-		self._save_in_year_chunks(symbol, data)
-		return data
+		with self._locks(symbol):
+			if symbol in self:
+				raise ValueError(f"Attempting to add duplicate symbol {symbol}, use flush_updates or update_symbol data instead")
+			info(f"Adding {symbol} to store")
+			data = pd.DataFrame()
+			chunks = self._stream_symbol_history(symbol, client=client)
+			try:
+				for year, data in self._complete_partitions(chunks, lambda index: index.year):
+					self._save_in_year_chunks(symbol, data)
+			except BaseException:
+				# The symbol only enters the index once all of its history is written, so dropping the partitions
+				# written so far leaves no trace of it
+				warn(f"Failed to add {symbol}, removing its partial history")
+				self._index.discard(symbol)
+				self._index.save([symbol])
+				shutil.rmtree(self.data_dir / symbol, ignore_errors=True)
+				raise
+			self._index.save([symbol])
+			return data.tail(n=1)
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			if symbol in self:
+				raise ValueError(f"Attempting to put duplicate symbol {symbol}, use update instead")
+			info(f"Putting {len(data)} rows for {symbol} into store")
+			self._save_in_year_chunks(symbol, data.sort_index())
+			self._index.save([symbol])
 
 	def _save_in_year_chunks(self, symbol: str, data: pd.DataFrame):
-		"""Save a dataframe under a given symbol in year-size chunks"""
+		"""Save a dataframe under a given symbol in year-size chunks. The partitions are recorded in the index, which
+		the caller saves once it's done writing."""
 		symbol = symbol.upper()
 		basepath = self.data_dir / symbol
 		basepath.mkdir(exist_ok=True)
 		for year, df in data.groupby(data.index.year):
 			path = basepath / f"{year}.pkl.gz"
-			df.to_pickle(str(path))
+			self._write_pickle(df, path)
+			self._index.record(symbol, path.name, df)
+
+	def _read_years(self, symbol: str, start: datetime.date = None, end: datetime.date = None,
+	                columns: List[str] = None) -> pd.DataFrame:
+		"""Read and merge the partitions covering the years from start to end"""
+		df_paths = self._partition_paths(symbol)
+		if start is None and end is not None:
+			# Get all data *except* after the current year
+			df_paths = list(filter(lambda path: int(path.name.split(".")[0]) <= end.year, df_paths))
+		elif start is not None and end is None:
+			df_paths = list(filter(lambda path: int(path.name.split(".")[0]) >= start.year, df_paths))
+		elif start is not None and end is not None:
+			df_paths = list(filter(lambda path: start.year <= int(path.name.split(".")[0]) <= end.year, df_paths))
+		return self._read_segments(df_paths) if len(df_paths) > 0 else self._empty_bars(columns)
+
+	def _read_last_partition(self, symbol: str) -> pd.DataFrame:
+		"""Read the partition holding a symbol's latest bar. Ties go to the most recently written segment, since it
+		overrides earlier ones."""
+		partitions = self._index.partitions(symbol)
+		name = max(partitions, key=lambda name: (pd.Timestamp(partitions[name]["last"]), segment_key(name)))
+		return self._read_pickle(self.data_dir / symbol / name)
+
+	def _partition_paths(self, symbol: str) -> List[Path]:
+		"""Get the paths of all partitions stored for a symbol, according to the index"""
+		basepath = self.data_dir / symbol.upper()
+		return [basepath / name for name in sorted(self._index.partitions(symbol), key=segment_key)]
+
+	@classmethod
+	def _read_segments(cls, paths: List[Path]) -> pd.DataFrame:
+		"""Read and merge partition files in order, letting later delta segments override earlier data"""
+		df = pd.concat([cls._read_pickle(path) for path in paths])
+		if any(segment_key(path.name)[1] > 0 for path in paths):
+			df = df[~df.index.duplicated(keep="last")]
+		return df
+
+	@staticmethod
+	def _read_pickle(path: Path) -> pd.DataFrame:
+		if metrics.enabled():
+			metrics.incr("store.partitions_read")
+			metrics.incr("store.read_bytes", path.stat().st_size, metrics.BYTES)
+		return pd.read_pickle(path)
+
+	@staticmethod
+	def _write_pickle(df: pd.DataFrame, path: Path) -> None:
+		# Temporary files don't end in .gz, so the compression is given rather than inferred
+		with atomic_path(path) as tmp_path:
+			df.to_pickle(str(tmp_path), compression="gzip")
+		if metrics.enabled():
+			metrics.incr("store.partitions_written")
+			metrics.incr("store.written_bytes", path.stat().st_size, metrics.BYTES)
+
+	def rebuild_index(self) -> None:
+		"""Rebuild the symbol index from scratch by reading every partition in the store"""
+		info(f"Rebuilding symbol index for {self.data_dir}")
+		self._index.clear()
+		for path in self.data_dir.glob("*/*.pkl.gz"):
+			self._index.record(path.parent.name, path.name, pd.read_pickle(path))
+		self._index.save()
 
 
 if __name__ == '__main__':
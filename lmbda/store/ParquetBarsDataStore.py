@@ -0,0 +1,208 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import logging
+import shutil
+from logging import info, warn
+from pathlib import Path
+from typing import Dict, List, Set
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytz
+from alpaca_trade_api.rest import REST, TimeFrame
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.compact import to_compact
+from lmbda.store.locking import SymbolLocks, atomic_path
+
+INDEX_NAME = "timestamp"
+ROW_GROUP_SIZE = 32768
+
+
+def partition_bounds(start: datetime.date = None, end: datetime.date = None) -> List[tuple]:
+	"""Build pyarrow filters selecting rows whose UTC date falls within [start, end]"""
+	filters = []
+	if start is not None:
+		filters.append((INDEX_NAME, ">=", pd.Timestamp(start, tz=pytz.utc)))
+	if end is not None:
+		filters.append((INDEX_NAME, "<", pd.Timestamp(end + datetime.timedelta(days=1), tz=pytz.utc)))
+	return filters
+
+
+def partition_in_range(year: int, month: int, start: datetime.date = None, end: datetime.date = None) -> bool:
+	"""Whether or not a year/month partition can contain data within [start, end]"""
+	if start is not None and (year, month) < (start.year, start.month):
+		return False
+	if end is not None and (year, month) > (end.year, end.month):
+		return False
+	return True
+
+
+class ParquetBarsDataStore(BarsDataStore):
+	"""Data store that stores data in a provided folder as columnar Parquet files, partitioned by month.
+	Files are stored in a hierarchy of data_dir/symbol/[YEAR]/[MONTH].parquet, and reads only touch the
+	partitions, row groups and columns needed to answer a query. Partitions are written to a temporary file and renamed
+	into place while holding a per-symbol lock file under data_dir/.locks, so readers never see a partial partition and
+	concurrent updates to a month never lose each other's rows."""
+
+	def __init__(self, timeframe: TimeFrame, data_dir: str):
+		super().__init__(timeframe)
+		info(f"Initializing new parquet datastore on a {timeframe} timeframe at {data_dir}")
+		self.data_dir = Path(data_dir).resolve()
+		self.data_dir.mkdir(exist_ok=True)
+		self._locks = SymbolLocks(self.data_dir / ".locks")
+
+	def __contains__(self, symbol: str) -> bool:
+		return len(list((self.data_dir / symbol.upper()).rglob("*.parquet"))) > 0
+
+	def symbols(self) -> Set[str]:
+		return {path.parent.parent.name for path in self.data_dir.rglob("*.parquet")}
+
+	@metrics.timed("store.bars")
+	def bars(self, symbol: str, start: datetime.date = None,
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
+		symbol = symbol.upper()
+		info("Retrieving stored bars for %s from %s to %s", symbol, start, end)
+		paths = [path for path in self._partitions(symbol)
+		         if partition_in_range(int(path.parent.name), int(path.stem), start, end)]
+		filters = partition_bounds(start, end) or None
+		df = pd.concat([self._read_partition(path, columns, filters) for path in paths]) if len(paths) > 0 \
+			else self._empty_bars(columns)
+		df.sort_index(inplace=True)
+		metrics.incr("store.rows_returned", len(df))
+		return to_compact(df) if compact else df
+
+	def remove(self, symbol: str) -> None:
+		warn(f"Deleting all data for {symbol}")
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			if symbol not in self:
+				raise ValueError(f"Symbol {symbol} not found in store")
+			shutil.rmtree(self.data_dir / symbol)
+
+	def last(self, symbol: str) -> pd.DataFrame:
+		# Only the most recent month's partition needs to be read to find the last row
+		symbol = symbol.upper()
+		if symbol not in self:
+			raise ValueError(f"Symbol {symbol} not found in store")
+		df = self._read_partition(self._partitions(symbol)[-1])
+		df.sort_index(inplace=True)
+		return df.tail(n=1)
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		"""Row counts are read from each partition's footer rather than its data"""
+		return {str(path.relative_to(self.data_dir / symbol.upper())): pq.read_metadata(str(path)).num_rows
+		        for path in self._partitions(symbol)}
+
+	@metrics.timed("store.update")
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		info("Updating symbol %s with %d potentially new rows", symbol, len(data))
+		with self._locks(symbol):
+			if symbol not in self:
+				raise ValueError(f"Symbol {symbol} not found in store")
+
+			# Only months touched by the new data are rewritten. Duplicates are overridden by the new data.
+			data = data.sort_index()
+			for (year, month), new in data.groupby([data.index.year, data.index.month]):
+				path = self._partition_path(symbol, year, month)
+				if path.exists():
+					new = pd.concat([self._read_partition(path), new])
+					new = new[~new.index.duplicated(keep="last")]
+					new.sort_index(inplace=True)
+				self._write_partition(path, new)
+
+	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
+		str, datetime.timedelta]:
+		out_of_date_symbols: Dict[str, datetime.timedelta] = {}
+		now = pd.Timestamp("now", tz=pytz.utc)
+		for symbol in self.symbols():
+			last = self.last_timestamp(symbol)
+			if now - last > threshold:
+				out_of_date_symbols[symbol] = now - last
+		return out_of_date_symbols
+
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			if symbol in self:
+				raise ValueError(f"Attempting to add duplicate symbol {symbol}, use flush_updates or update_symbol data instead")
+			info(f"Adding {symbol} to store")
+			data = pd.DataFrame()
+			chunks = self._stream_symbol_history(symbol, client=client)
+			try:
+				for month, data in self._complete_partitions(chunks, lambda index: index.year * 100 + index.month):
+					self._save_in_month_chunks(symbol, data)
+			except BaseException:
+				# Partial history would look complete to readers, so a failed add leaves nothing behind
+				warn(f"Failed to add {symbol}, removing its partial history")
+				shutil.rmtree(self.data_dir / symbol, ignore_errors=True)
+				raise
+			return data.tail(n=1)
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		with self._locks(symbol):
+			if symbol in self:
+				raise ValueError(f"Attempting to put duplicate symbol {symbol}, use update instead")
+			info(f"Putting {len(data)} rows for {symbol} into store")
+			self._save_in_month_chunks(symbol, data.sort_index())
+
+	def _partitions(self, symbol: str) -> List[Path]:
+		"""Get all partition paths for a symbol in chronological order"""
+		return sorted((self.data_dir / symbol.upper()).glob("*/*.parquet"),
+		              key=lambda path: (int(path.parent.name), int(path.stem)))
+
+	def _partition_path(self, symbol: str, year: int, month: int) -> Path:
+		return self.data_dir / symbol.upper() / str(year) / f"{month:02d}.parquet"
+
+	def _save_in_month_chunks(self, symbol: str, data: pd.DataFrame):
+		"""Save a dataframe under a given symbol in month-size chunks"""
+		for (year, month), df in data.groupby([data.index.year, data.index.month]):
+			self._write_partition(self._partition_path(symbol, year, month), df)
+
+	@staticmethod
+	def _read_partition(path: Path, columns: List[str] = None, filters: List[tuple] = None) -> pd.DataFrame:
+		"""Read a single partition, pushing column selection and timestamp filters down to the row groups"""
+		table = pq.read_table(str(path), columns=columns, filters=filters, use_pandas_metadata=True)
+		if metrics.enabled():
+			metrics.incr("store.partitions_read")
+			metrics.incr("store.read_bytes", path.stat().st_size, metrics.BYTES)
+		return table.to_pandas()
+
+	@staticmethod
+	def _write_partition(path: Path, df: pd.DataFrame):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with atomic_path(path) as tmp_path:
+			df.rename_axis(INDEX_NAME).to_parquet(str(tmp_path), engine="pyarrow", row_group_size=ROW_GROUP_SIZE)
+		if metrics.enabled():
+			metrics.incr("store.partitions_written")
+			metrics.incr("store.written_bytes", path.stat().st_size, metrics.BYTES)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
+	store = ParquetBarsDataStore(TimeFrame.Day, Path("data/history/daily-parquet"))
+
+	print(f"All stored symbols: {store.symbols()}")
+
+	print("Last GME data point:")
+	print(store.last("gme"))
+
+	print("GME closes for the last week:")
+	print(store.bars("gme", start=datetime.date.today() - datetime.timedelta(days=7), columns=["close"]))
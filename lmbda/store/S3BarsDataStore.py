@@ -0,0 +1,420 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import io
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from logging import debug, info, warn
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+import boto3
+import pandas as pd
+import pyarrow.parquet as pq
+import pytz
+from alpaca_trade_api.rest import REST, TimeFrame
+from boto3.s3.transfer import TransferConfig
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.compact import to_compact
+from lmbda.store.ParquetBarsDataStore import INDEX_NAME, ROW_GROUP_SIZE, partition_bounds, partition_in_range
+
+# Partitions larger than this are uploaded in parallel parts of this size
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class S3RangeFile(io.RawIOBase):
+	"""Read-only file over an S3 object, where every read is a ranged GET. Handing this to pyarrow means only the
+	Parquet footer and the column chunks a query needs are transferred."""
+
+	def __init__(self, client, bucket: str, key: str, size: int):
+		self.client = client
+		self.bucket = bucket
+		self.key = key
+		self.size = size
+		self.position = 0
+		self.bytes_read = 0
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def tell(self) -> int:
+		return self.position
+
+	def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+		if whence == io.SEEK_SET:
+			self.position = offset
+		elif whence == io.SEEK_CUR:
+			self.position += offset
+		elif whence == io.SEEK_END:
+			self.position = self.size + offset
+		else:
+			raise ValueError(f"Invalid whence {whence}")
+		return self.position
+
+	def read(self, size: int = -1) -> bytes:
+		end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+		if end <= self.position:
+			return b""
+		response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{end - 1}")
+		data = response["Body"].read()
+		self.position += len(data)
+		self.bytes_read += len(data)
+		if metrics.enabled():
+			metrics.incr("s3.range_gets")
+			metrics.incr("s3.read_bytes", len(data), metrics.BYTES)
+		return data
+
+	def readall(self) -> bytes:
+		return self.read(-1)
+
+	def readinto(self, buffer) -> int:
+		data = self.read(len(buffer))
+		buffer[:len(data)] = data
+		return len(data)
+
+
+class PartitionCache:
+	"""Local on-disk cache of S3 objects, stored as cache_dir/[KEY].[ETAG] so that a cached copy is only ever used
+	while its ETag matches the object in S3. Least recently used files are evicted once the cache grows past its byte
+	budget."""
+
+	def __init__(self, cache_dir: str, max_bytes: int):
+		self.path = Path(cache_dir).resolve()
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self._bytes = sum(path.stat().st_size for path in self._files())
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def open(self, key: str, etag: str) -> Optional[BinaryIO]:
+		"""Open the cached copy of an object if its ETag matches. An open file stays readable even if it is evicted
+		before the caller is done with it."""
+		path = self._path(key, etag)
+		try:
+			file = open(path, "rb")
+			# The modification time doubles as the last access time for eviction
+			os.utime(path)
+		except FileNotFoundError:
+			metrics.incr("s3.cache_misses")
+			return None
+		metrics.incr("s3.cache_hits")
+		return file
+
+	def staging_path(self) -> Path:
+		"""Get a temporary path on the cache's filesystem, which can later be moved into the cache with insert"""
+		staging = self.path / ".staging"
+		staging.mkdir(exist_ok=True)
+		return staging / uuid.uuid4().hex
+
+	def insert(self, key: str, etag: str, source: Path) -> Path:
+		"""Move a file into the cache as the given version of an object, replacing any other cached versions"""
+		path = self._path(key, etag)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with self._lock:
+			self._discard(key)
+			size = source.stat().st_size
+			os.replace(source, path)
+			self._bytes += size
+			if self._bytes > self.max_bytes:
+				self._evict(keep=path)
+		return path
+
+	def discard(self, key: str) -> None:
+		"""Remove every cached version of an object"""
+		with self._lock:
+			self._discard(key)
+
+	def _discard(self, key: str) -> None:
+		path = self.path / key
+		for cached in path.parent.glob(f"{path.name}.*"):
+			self._unlink(cached)
+
+	def _evict(self, keep: Path) -> None:
+		files = sorted(self._files(), key=lambda file: file.stat().st_mtime)
+		for file in files:
+			if self._bytes <= self.max_bytes:
+				break
+			if file != keep:
+				debug(f"Evicting {file} from the S3 partition cache")
+				self._unlink(file)
+				metrics.incr("s3.cache_evictions")
+
+	def _unlink(self, path: Path) -> None:
+		try:
+			size = path.stat().st_size
+			path.unlink()
+			self._bytes -= size
+		except FileNotFoundError:
+			pass
+
+	def _files(self) -> List[Path]:
+		return [path for path in self.path.rglob("*") if path.is_file() and ".staging" not in path.parts]
+
+	def _path(self, key: str, etag: str) -> Path:
+		return self.path / f"{key}.{etag.strip(chr(34))}"
+
+
+class S3BarsDataStore(BarsDataStore):
+	"""Data store that keeps monthly Parquet partitions in an S3 bucket (or any S3-compatible store), under
+	[PREFIX]/symbol/[YEAR]/[MONTH].parquet. Partitions are pruned by key before anything is fetched. Whole partitions
+	are downloaded into a bounded local cache, validated against the ETags returned when listing them, while queries for
+	a subset of columns on uncached partitions use ranged GETs to fetch only those columns. Writes are uploaded in
+	parallel parts."""
+
+	def __init__(self, timeframe: TimeFrame, bucket: str, prefix: str = "", cache_dir: str = "/tmp/traitor-s3",
+	             cache_bytes: int = 512 * 1024 * 1024, client=None, endpoint_url: str = None, workers: int = 8):
+		super().__init__(timeframe)
+		info(f"Initializing new S3 datastore on a {timeframe} timeframe at s3://{bucket}/{prefix}")
+		self.bucket = bucket
+		self.prefix = prefix.strip("/") + "/" if prefix.strip("/") != "" else ""
+		self.endpoint_url = endpoint_url
+		self.workers = workers
+		self.client = client or boto3.client("s3", endpoint_url=endpoint_url)
+		self.cache = PartitionCache(Path(cache_dir) / bucket, cache_bytes)
+		self.transfer_config = TransferConfig(multipart_threshold=MULTIPART_CHUNK_SIZE,
+		                                      multipart_chunksize=MULTIPART_CHUNK_SIZE, max_concurrency=workers)
+
+	def __getstate__(self):
+		# boto3 clients can't be pickled, so each process creates its own
+		state = self.__dict__.copy()
+		del state["client"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.client = boto3.client("s3", endpoint_url=self.endpoint_url)
+
+	def __contains__(self, symbol: str) -> bool:
+		response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self._symbol_prefix(symbol), MaxKeys=1)
+		return response["KeyCount"] > 0
+
+	def symbols(self) -> Set[str]:
+		symbols = set()
+		paginator = self.client.get_paginator("list_objects_v2")
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter="/"):
+			for common_prefix in page.get("CommonPrefixes", []):
+				symbols.add(common_prefix["Prefix"][len(self.prefix):].strip("/"))
+		return symbols
+
+	@metrics.timed("store.bars")
+	def bars(self, symbol: str, start: datetime.date = None,
+	         end: datetime.date = None, columns: List[str] = None, compact: bool = False) -> pd.DataFrame:
+		symbol = symbol.upper()
+		info("Retrieving stored bars for %s from %s to %s", symbol, start, end)
+		partitions = [partition for partition in self._partitions(symbol)
+		              if partition_in_range(*self._year_month(partition["Key"]), start, end)]
+		filters = partition_bounds(start, end) or None
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			dfs = list(executor.map(lambda partition: self._read_partition(partition, columns, filters), partitions))
+		df = pd.concat(dfs) if len(dfs) > 0 else self._empty_bars(columns)
+		df.sort_index(inplace=True)
+		metrics.incr("store.rows_returned", len(df))
+		return to_compact(df) if compact else df
+
+	def remove(self, symbol: str) -> None:
+		warn(f"Deleting all data for {symbol}")
+		symbol = symbol.upper()
+		partitions = self._partitions(symbol)
+		if len(partitions) == 0:
+			raise ValueError(f"Symbol {symbol} not found in store")
+		# Objects can only be deleted 1000 at a time
+		for i in range(0, len(partitions), 1000):
+			objects = [{"Key": partition["Key"]} for partition in partitions[i:i + 1000]]
+			self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+		for partition in partitions:
+			self.cache.discard(partition["Key"])
+
+	def last(self, symbol: str) -> pd.DataFrame:
+		# Only the most recent month's partition needs to be read to find the last row
+		symbol = symbol.upper()
+		partitions = self._partitions(symbol)
+		if len(partitions) == 0:
+			raise ValueError(f"Symbol {symbol} not found in store")
+		df = self._read_partition(partitions[-1])
+		df.sort_index(inplace=True)
+		return df.tail(n=1)
+
+	def partitions(self, symbol: str) -> Dict[str, int]:
+		"""Row counts are read from each partition's footer, by ranged GETs unless the partition is cached"""
+		counts = {}
+		for partition in self._partitions(symbol):
+			source = self.cache.open(partition["Key"], partition["ETag"]) or \
+			         S3RangeFile(self.client, self.bucket, partition["Key"], partition["Size"])
+			with source:
+				counts[partition["Key"][len(self._symbol_prefix(symbol)):]] = pq.read_metadata(source).num_rows
+		return counts
+
+	@metrics.timed("store.update")
+	def update(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		info("Updating symbol %s with %d potentially new rows", symbol, len(data))
+		partitions = {self._year_month(partition["Key"]): partition for partition in self._partitions(symbol)}
+		if len(partitions) == 0:
+			raise ValueError(f"Symbol {symbol} not found in store")
+
+		# Only months touched by the new data are rewritten. Duplicates are overridden by the new data.
+		data = data.sort_index()
+		chunks = []
+		for (year, month), new in data.groupby([data.index.year, data.index.month]):
+			if (year, month) in partitions:
+				new = pd.concat([self._read_partition(partitions[(year, month)]), new])
+				new = new[~new.index.duplicated(keep="last")]
+				new.sort_index(inplace=True)
+			chunks.append((self._partition_key(symbol, year, month), new))
+		self._write_partitions(chunks)
+
+	def get_out_of_date_symbols(self, threshold: datetime.timedelta = datetime.timedelta(days=3)) -> Dict[
+		str, datetime.timedelta]:
+		out_of_date_symbols: Dict[str, datetime.timedelta] = {}
+		now = pd.Timestamp("now", tz=pytz.utc)
+		for symbol in self.symbols():
+			last = self.last_timestamp(symbol)
+			if now - last > threshold:
+				out_of_date_symbols[symbol] = now - last
+		return out_of_date_symbols
+
+	def add(self, symbol: str, client: REST = None) -> pd.DataFrame:
+		symbol = symbol.upper()
+		if symbol in self:
+			raise ValueError(f"Attempting to add duplicate symbol {symbol}, use flush_updates or update_symbol data instead")
+		info(f"Adding {symbol} to store")
+		data = pd.DataFrame()
+		chunks = self._stream_symbol_history(symbol, client=client)
+		try:
+			for month, data in self._complete_partitions(chunks, lambda index: index.year * 100 + index.month):
+				self._save_in_month_chunks(symbol, data)
+		except BaseException:
+			# Partial history would look complete to readers, so a failed add leaves nothing behind
+			warn(f"Failed to add {symbol}, removing its partial history")
+			if symbol in self:
+				self.remove(symbol)
+			raise
+		return data.tail(n=1)
+
+	def put(self, symbol: str, data: pd.DataFrame) -> None:
+		symbol = symbol.upper()
+		if symbol in self:
+			raise ValueError(f"Attempting to put duplicate symbol {symbol}, use update instead")
+		info(f"Putting {len(data)} rows for {symbol} into store")
+		self._save_in_month_chunks(symbol, data.sort_index())
+
+	def _symbol_prefix(self, symbol: str) -> str:
+		return f"{self.prefix}{symbol.upper()}/"
+
+	def _partition_key(self, symbol: str, year: int, month: int) -> str:
+		return f"{self._symbol_prefix(symbol)}{year}/{month:02d}.parquet"
+
+	@staticmethod
+	def _year_month(key: str) -> Tuple[int, int]:
+		year, month = key.split("/")[-2:]
+		return int(year), int(month.split(".")[0])
+
+	def _partitions(self, symbol: str) -> List[dict]:
+		"""List all partitions of a symbol in chronological order, along with their ETags and sizes"""
+		partitions = []
+		paginator = self.client.get_paginator("list_objects_v2")
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=self._symbol_prefix(symbol)):
+			partitions += [partition for partition in page.get("Contents", []) if partition["Key"].endswith(".parquet")]
+		metrics.incr("s3.list_requests")
+		return sorted(partitions, key=lambda partition: self._year_month(partition["Key"]))
+
+	def _read_partition(self, partition: dict, columns: List[str] = None,
+	                    filters: List[tuple] = None) -> pd.DataFrame:
+		"""Read a single listed partition from the local cache, by ranged GETs of the needed columns, or by downloading
+		it into the cache, in that order of preference"""
+		source = self.cache.open(partition["Key"], partition["ETag"])
+		if source is None and columns is not None:
+			source = S3RangeFile(self.client, self.bucket, partition["Key"], partition["Size"])
+		elif source is None:
+			source = self._download(partition["Key"])
+		with source:
+			table = pq.read_table(source, columns=columns, filters=filters, use_pandas_metadata=True)
+			# Bytes actually transferred for ranged reads, otherwise the size of the local file read
+			read_bytes = source.bytes_read if isinstance(source, S3RangeFile) else os.fstat(source.fileno()).st_size
+		if metrics.enabled():
+			metrics.incr("store.partitions_read")
+			metrics.incr("store.read_bytes", read_bytes, metrics.BYTES)
+		return table.to_pandas()
+
+	def _download(self, key: str) -> BinaryIO:
+		"""Download an object into the cache and open it. The cached copy is keyed by the ETag of what was actually
+		downloaded, which may be newer than what was listed."""
+		staging = self.cache.staging_path()
+		response = self.client.get_object(Bucket=self.bucket, Key=key)
+		with open(staging, "wb") as file:
+			for chunk in response["Body"].iter_chunks(MULTIPART_CHUNK_SIZE):
+				file.write(chunk)
+		if metrics.enabled():
+			metrics.incr("s3.gets")
+			metrics.incr("s3.read_bytes", staging.stat().st_size, metrics.BYTES)
+		file = open(staging, "rb")
+		self.cache.insert(key, response["ETag"], staging)
+		return file
+
+	def _save_in_month_chunks(self, symbol: str, data: pd.DataFrame):
+		"""Save a dataframe under a given symbol in month-size chunks"""
+		self._write_partitions([(self._partition_key(symbol, year, month), df)
+		                        for (year, month), df in data.groupby([data.index.year, data.index.month])])
+
+	def _write_partitions(self, chunks: List[Tuple[str, pd.DataFrame]]) -> None:
+		"""Upload many partitions in parallel"""
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			list(executor.map(lambda chunk: self._write_partition(*chunk), chunks))
+
+	def _write_partition(self, key: str, df: pd.DataFrame) -> None:
+		"""Write a partition locally, upload it, then keep the local copy in the cache so that it needn't be fetched
+		back"""
+		staging = self.cache.staging_path()
+		try:
+			df.rename_axis(INDEX_NAME).to_parquet(str(staging), engine="pyarrow", row_group_size=ROW_GROUP_SIZE)
+			size = staging.stat().st_size
+			self.client.upload_file(str(staging), self.bucket, key, Config=self.transfer_config)
+			etag = self.client.head_object(Bucket=self.bucket, Key=key)["ETag"]
+			self.cache.insert(key, etag, staging)
+		finally:
+			staging.unlink(missing_ok=True)
+		if metrics.enabled():
+			metrics.incr("store.partitions_written")
+			metrics.incr("store.written_bytes", size, metrics.BYTES)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
+	store = S3BarsDataStore(TimeFrame.Day, os.environ["TRAITOR_DATA_BUCKET"], "history/daily")
+
+	print(f"All stored symbols: {store.symbols()}")
+
+	print("Last GME data point:")
+	print(store.last("gme"))
+
+	print("GME closes for the last week:")
+	print(store.bars("gme", start=datetime.date.today() - datetime.timedelta(days=7), columns=["close"]))
@@ -14,7 +14,32 @@
 #  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-from lmbda.store.BarsDataStore import BarsDataStore
-from lmbda.store.api_client import uses_alpaca_client
+import importlib
+import sys
+import types
 
-__all__ = [BarsDataStore, uses_alpaca_client]
+# Re-exports are imported on first access, so that handlers importing a light submodule (e.g. metadata) don't pay for
+# pandas and the Alpaca client
+_exports = {"BarsDataStore": "lmbda.store.BarsDataStore", "uses_alpaca_client": "lmbda.store.api_client"}
+
+__all__ = list(_exports)
+
+
+class _Package(types.ModuleType):
+	def __setattr__(self, name, value):
+		# Importing a submodule binds it on the package under its own name, which for BarsDataStore is also the name
+		# of the class, so the class is bound in its place
+		if name in _exports and isinstance(value, types.ModuleType):
+			value = getattr(value, name)
+		super().__setattr__(name, value)
+
+
+def __getattr__(name: str):
+	if name not in _exports:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	value = getattr(importlib.import_module(_exports[name]), name)
+	globals()[name] = value
+	return value
+
+
+sys.modules[__name__].__class__ = _Package
@@ -46,23 +46,32 @@
 #  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
 #
 import functools
+import time
 from logging import debug
 from typing import Callable
 
 from alpaca_trade_api.common import URL
 from alpaca_trade_api.rest import REST
 
+from lmbda import metrics
+
 APCA_API_BASE_URL = URL("https://api.alpaca.markets")
 APCA_API_PAPER_URL = URL("https://paper-api.alpaca.markets")
 
 
 def uses_alpaca_client(func: Callable, paper_trading: bool = True) -> Callable:
-	"""Annotation for any function that needs an Alpaca client"""
+	"""Annotation for any function that needs an Alpaca client. Callers may supply their own client (e.g. a rate
+	limited or fake one) by passing it as the client keyword argument."""
 
 	@functools.wraps(func)
 	def wrapper(*args, **kwargs):
-		debug(f"Generating new Alpaca client for {func.__name__}")
-		return func(*args, client=_get_alpaca_client(paper_trading), **kwargs)
+		if kwargs.get("client") is None:
+			debug(f"Generating new Alpaca client for {func.__name__}")
+			kwargs["client"] = _get_alpaca_client(paper_trading)
+		# Decorated functions calling each other pass the already instrumented client along
+		if metrics.enabled() and not isinstance(kwargs["client"], _InstrumentedClient):
+			kwargs["client"] = _InstrumentedClient(kwargs["client"])
+		return func(*args, **kwargs)
 
 	return wrapper
 
@@ -71,3 +80,29 @@ def uses_alpaca_client(func: Callable, paper_trading: bool = True) -> Callable:
 def _get_alpaca_client(paper_trading: bool = True):
 	"""Cacheable helper for getting an alpaca client"""
 	return REST(base_url=APCA_API_PAPER_URL if paper_trading else APCA_API_BASE_URL)
+
+
+class _InstrumentedClient:
+	"""Proxy around an Alpaca client recording the number and latency of API calls"""
+
+	def __init__(self, client):
+		self._client = client
+
+	def __getattr__(self, item):
+		attr = getattr(self._client, item)
+		if not callable(attr):
+			return attr
+
+		@functools.wraps(attr)
+		def call(*args, **kwargs):
+			metrics.incr(f"alpaca.{item}.calls")
+			start = time.perf_counter()
+			try:
+				return attr(*args, **kwargs)
+			except Exception:
+				metrics.incr(f"alpaca.{item}.errors")
+				raise
+			finally:
+				metrics.incr(f"alpaca.{item}.latency", time.perf_counter() - start, metrics.SECONDS)
+
+		return call
@@ -0,0 +1,362 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+from logging import debug, info, warning
+from typing import Dict, Iterable, List, Set, Union
+
+import aiohttp
+import pandas as pd
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.bulk_download import DEFAULT_REQUESTS_PER_SECOND
+
+# Defaults match the environment variables read by alpaca_trade_api, so one set of settings configures both clients
+DATA_URL = "https://data.alpaca.markets"
+STREAM_URL = "wss://stream.data.alpaca.markets"
+
+# Alpaca's v2 bar fields, mapped to the columns of the dataframes returned by the REST client
+BAR_COLUMNS = {
+	"o": "open",
+	"h": "high",
+	"l": "low",
+	"c": "close",
+	"v": "volume",
+	"n": "trade_count",
+	"vw": "vwap"
+}
+
+Timestamp = Union[str, datetime.date, pd.Timestamp]
+
+
+def bars_frame(bars: List[dict]) -> pd.DataFrame:
+	"""Convert v2 bar objects into a dataframe shaped like the REST client's, indexed by UTC timestamp. Later bars
+	with the same timestamp (such as corrected bars from the stream) override earlier ones."""
+	if len(bars) == 0:
+		return pd.DataFrame(columns=list(BAR_COLUMNS.values()),
+		                    index=pd.DatetimeIndex([], tz="UTC", name="timestamp"))
+	df = pd.DataFrame.from_records(bars).rename(columns=BAR_COLUMNS)
+	df.index = pd.DatetimeIndex(pd.to_datetime(df["t"], utc=True), name="timestamp")
+	df = df[[column for column in BAR_COLUMNS.values() if column in df.columns]]
+	df = df[~df.index.duplicated(keep="last")]
+	return df.sort_index()
+
+
+def _format_time(value: Timestamp) -> str:
+	if isinstance(value, pd.Timestamp):
+		return value.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%SZ") if value.tzinfo else value.isoformat() + "Z"
+	return str(value)
+
+
+class AsyncTokenBucket:
+	"""Token bucket rate limiter for coroutines, refilling continuously at the given rate up to capacity"""
+
+	def __init__(self, rate: float, capacity: float = None):
+		self.rate = rate
+		self.capacity = capacity if capacity is not None else max(1.0, rate)
+		self._tokens = self.capacity
+		self._last = time.monotonic()
+
+	async def acquire(self, tokens: float = 1.0) -> None:
+		while True:
+			now = time.monotonic()
+			self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+			self._last = now
+			if self._tokens >= tokens:
+				self._tokens -= tokens
+				return
+			await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class AsyncDataClient:
+	"""
+	asyncio client for Alpaca's v2 market data API. Requests share one pooled session, so connections are kept alive
+	and reused, and any number of requests can be in flight at once up to the pool size, all under a shared rate
+	limit. Use as an async context manager, or call open and close.
+	:param key_id: API key, defaulting to APCA_API_KEY_ID
+	:param secret_key: API secret, defaulting to APCA_API_SECRET_KEY
+	:param data_url: Base URL of the REST data API, defaulting to APCA_API_DATA_URL or Alpaca's
+	:param stream_url: Base URL of the streaming data API, defaulting to APCA_API_STREAM_URL or Alpaca's
+	:param feed: Data feed to stream, iex or sip
+	:param connections: Most connections kept open, and so requests in flight, at once
+	:param requests_per_second: Maximum REST requests per second
+	:param retries: Number of times to retry a request that fails or is rate limited"""
+
+	def __init__(self,
+	             key_id: str = None,
+	             secret_key: str = None,
+	             data_url: str = None,
+	             stream_url: str = None,
+	             feed: str = "iex",
+	             connections: int = 16,
+	             requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+	             retries: int = 5,
+	             backoff: float = 1.0,
+	             max_backoff: float = 60.0,
+	             timeout: float = 30.0):
+		self.key_id = key_id or os.environ.get("APCA_API_KEY_ID", "")
+		self.secret_key = secret_key or os.environ.get("APCA_API_SECRET_KEY", "")
+		self.data_url = (data_url or os.environ.get("APCA_API_DATA_URL", DATA_URL)).rstrip("/")
+		stream_url = (stream_url or os.environ.get("APCA_API_STREAM_URL", STREAM_URL)).rstrip("/")
+		self.stream_url = f"{stream_url.replace('https://', 'wss://').replace('http://', 'ws://')}/v2/{feed}"
+		self.connections = connections
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+		self._bucket = AsyncTokenBucket(requests_per_second)
+		self.session: aiohttp.ClientSession = None
+
+	async def __aenter__(self) -> "AsyncDataClient":
+		await self.open()
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.close()
+
+	async def open(self) -> None:
+		if self.session is None:
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.connections, ttl_dns_cache=300),
+				headers={"APCA-API-KEY-ID": self.key_id, "APCA-API-SECRET-KEY": self.secret_key},
+				timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+	async def close(self) -> None:
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def get_bars(self, symbol: str, timeframe: TimeFrame, start: Timestamp, end: Timestamp = None,
+	                   limit: int = 10000) -> pd.DataFrame:
+		"""Fetch a symbol's bars from start to end, following pagination through to the last page"""
+		bars: List[dict] = []
+		params = {"timeframe": timeframe.value, "start": _format_time(start), "limit": limit}
+		if end is not None:
+			params["end"] = _format_time(end)
+		while True:
+			page = await self._get(f"/v2/stocks/{symbol.upper()}/bars", params)
+			bars += page.get("bars") or []
+			if not page.get("next_page_token"):
+				return bars_frame(bars)
+			params["page_token"] = page["next_page_token"]
+
+	async def get_multi_bars(self, symbols: List[str], timeframe: TimeFrame, start: Timestamp, end: Timestamp = None,
+	                         limit: int = 10000) -> Dict[str, pd.DataFrame]:
+		"""Fetch bars for several symbols through the multi-symbol endpoint, following pagination, split by symbol"""
+		bars: Dict[str, List[dict]] = {}
+		params = {"symbols": ",".join(symbol.upper() for symbol in symbols), "timeframe": timeframe.value,
+		          "start": _format_time(start), "limit": limit}
+		if end is not None:
+			params["end"] = _format_time(end)
+		while True:
+			page = await self._get("/v2/stocks/bars", params)
+			for symbol, symbol_bars in (page.get("bars") or {}).items():
+				bars.setdefault(symbol, []).extend(symbol_bars)
+			if not page.get("next_page_token"):
+				return {symbol: bars_frame(symbol_bars) for symbol, symbol_bars in bars.items()}
+			params["page_token"] = page["next_page_token"]
+
+	async def gather_bars(self, symbols: Iterable[str], timeframe: TimeFrame, start: Timestamp, end: Timestamp = None,
+	                      batch_size: int = 100) -> Dict[str, pd.DataFrame]:
+		"""Fetch bars for many symbols, batch_size symbols per request chain, with every batch in flight at once"""
+		symbols = sorted(symbol.upper() for symbol in symbols)
+		batches = await asyncio.gather(*(self.get_multi_bars(symbols[i:i + batch_size], timeframe, start, end)
+		                                 for i in range(0, len(symbols), batch_size)))
+		return {symbol: df for batch in batches for symbol, df in batch.items()}
+
+	async def _get(self, path: str, params: Dict) -> Dict:
+		"""Make a rate limited GET request, retrying with jittered exponential backoff on rate limiting, server errors
+		and dropped connections"""
+		for attempt in range(self.retries + 1):
+			await self._bucket.acquire()
+			try:
+				async with self.session.get(self.data_url + path, params=params) as response:
+					metrics.incr("async_client.requests")
+					if response.status == 429 or response.status >= 500:
+						raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+						                                  message=await response.text())
+					if response.status >= 400:
+						raise ValueError(f"Request for {path} failed with {response.status}: {await response.text()}")
+					return await response.json()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				if attempt == self.retries:
+					raise
+				delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+				warning(f"Request for {path} failed ({e}), retrying in {delay:.2f}s")
+				metrics.incr("async_client.retries")
+				await asyncio.sleep(delay)
+
+
+def fetch_bars(symbols: Iterable[str], timeframe: TimeFrame, start: Timestamp, end: Timestamp = None,
+               batch_size: int = 100, **kwargs) -> Dict[str, pd.DataFrame]:
+	"""Fetch bars for many symbols concurrently from synchronous code, returning each symbol's bars. Keyword arguments
+	configure the AsyncDataClient."""
+
+	async def fetch() -> Dict[str, pd.DataFrame]:
+		async with AsyncDataClient(**kwargs) as client:
+			return await client.gather_bars(symbols, timeframe, start, end, batch_size=batch_size)
+
+	return asyncio.run(fetch())
+
+
+class BarStream:
+	"""
+	Subscribes to live minute bars over Alpaca's websocket stream and ingests them into a store. Incoming bars are
+	buffered per symbol and written in micro-batches, so each symbol gets one update (and so one write) per flush no
+	matter how many bars arrived, rather than one per bar. Writes run on a worker thread so the stream keeps being read
+	while they happen, and dropped connections are re-established with backoff.
+	:param store: BarsDataStore to write bars into. Symbols not yet in the store are put there.
+	:param symbols: Symbols to subscribe to
+	:param client: AsyncDataClient providing the session, credentials and stream URL
+	:param flush_interval: Seconds between flushes
+	:param max_pending: Number of buffered bars for a single symbol that triggers an early flush
+	:param updated_bars: Whether to also subscribe to bars corrected after late trades, which replace the originals"""
+
+	def __init__(self,
+	             store: BarsDataStore,
+	             symbols: Iterable[str],
+	             client: AsyncDataClient,
+	             flush_interval: float = 5.0,
+	             max_pending: int = 1000,
+	             updated_bars: bool = True,
+	             max_backoff: float = 60.0):
+		self.store = store
+		self.symbols = sorted(symbol.upper() for symbol in symbols)
+		self.client = client
+		self.flush_interval = flush_interval
+		self.max_pending = max_pending
+		self.updated_bars = updated_bars
+		self.max_backoff = max_backoff
+		self.bars_received = 0
+		self.flushes = 0
+		self._pending: Dict[str, List[dict]] = {}
+		self._early_flushes: Set[asyncio.Task] = set()
+		self._flush_lock: asyncio.Lock = None
+		self._stopping = False
+		self._ws: aiohttp.ClientWebSocketResponse = None
+
+	async def run(self) -> None:
+		"""Stream bars until stopped, flushing whatever is buffered on the way out"""
+		self._flush_lock = asyncio.Lock()
+		self._stopping = False
+		await self.client.open()
+		flusher = asyncio.create_task(self._flush_periodically())
+		attempt = 0
+		try:
+			while not self._stopping:
+				try:
+					await self._consume()
+					attempt = 0
+				except (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError) as e:
+					if self._stopping:
+						break
+					delay = min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+					warning(f"Bar stream disconnected ({e}), reconnecting in {delay:.2f}s")
+					attempt += 1
+					await asyncio.sleep(delay)
+		finally:
+			flusher.cancel()
+			await asyncio.gather(*self._early_flushes)
+			await self.flush()
+
+	async def stop(self) -> None:
+		self._stopping = True
+		if self._ws is not None:
+			await self._ws.close()
+
+	async def flush(self) -> None:
+		"""Write every buffered bar to the store, one update per symbol"""
+		async with self._flush_lock:
+			pending, self._pending = self._pending, {}
+			if len(pending) == 0:
+				return
+			updates = {symbol: bars_frame(bars) for symbol, bars in pending.items()}
+			await asyncio.get_running_loop().run_in_executor(None, self._write, updates)
+			self.flushes += 1
+			metrics.incr("stream.flushes")
+			metrics.incr("stream.rows_written", sum(len(df) for df in updates.values()))
+
+	def _write(self, updates: Dict[str, pd.DataFrame]) -> None:
+		for symbol in [symbol for symbol in updates if symbol not in self.store]:
+			info(f"Adding streamed symbol {symbol} to store")
+			self.store.put(symbol, updates.pop(symbol))
+		for symbol, e in self.store.update_many(updates).items():
+			warning(f"Dropped {len(updates[symbol])} streamed bars for {symbol}: {e}")
+
+	async def _flush_periodically(self) -> None:
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			await self._try_flush()
+
+	async def _try_flush(self) -> None:
+		"""Flush from a background task, logging failures since nothing awaits the result"""
+		try:
+			await self.flush()
+		except Exception as e:
+			warning(f"Failed to flush streamed bars: {e}")
+
+	async def _consume(self) -> None:
+		async with self.client.session.ws_connect(self.client.stream_url, heartbeat=30) as ws:
+			self._ws = ws
+			await self._expect(ws, "connected")
+			await ws.send_json({"action": "auth", "key": self.client.key_id, "secret": self.client.secret_key})
+			await self._expect(ws, "authenticated")
+			subscription = {"action": "subscribe", "bars": self.symbols}
+			if self.updated_bars:
+				subscription["updatedBars"] = self.symbols
+			await ws.send_json(subscription)
+			info(f"Streaming bars for {len(self.symbols)} symbols from {self.client.stream_url}")
+
+			async for message in ws:
+				if message.type == aiohttp.WSMsgType.TEXT:
+					for item in json.loads(message.data):
+						if item.get("T") in ("b", "u"):
+							self._on_bar(item)
+						elif item.get("T") == "error":
+							warning(f"Bar stream error {item.get('code')}: {item.get('msg')}")
+				elif message.type == aiohttp.WSMsgType.ERROR:
+					raise ConnectionError(ws.exception())
+			self._ws = None
+			if not self._stopping:
+				raise ConnectionError("Stream closed by server")
+
+	def _on_bar(self, bar: dict) -> None:
+		self.bars_received += 1
+		metrics.incr("stream.bars")
+		pending = self._pending.setdefault(bar["S"], [])
+		pending.append(bar)
+		if len(pending) >= self.max_pending and not self._flush_lock.locked():
+			debug(f"Flushing early, {len(pending)} bars pending for {bar['S']}")
+			# The event loop only holds weak references to tasks, so early flushes are kept until they finish
+			task = asyncio.ensure_future(self._try_flush())
+			self._early_flushes.add(task)
+			task.add_done_callback(self._early_flushes.discard)
+
+	@staticmethod
+	async def _expect(ws: aiohttp.ClientWebSocketResponse, status: str) -> None:
+		"""Wait for a control message, failing if the server reports an error instead"""
+		for item in await ws.receive_json():
+			if item.get("T") == "success" and item.get("msg") == status:
+				return
+			if item.get("T") == "error":
+				raise ValueError(f"Bar stream refused connection with {item.get('code')}: {item.get('msg')}")
+		raise ConnectionError(f"Expected {status} from bar stream")
@@ -0,0 +1,168 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging import info, warning
+from pathlib import Path
+from typing import Dict, Iterable, Set
+
+from lmbda.store import BarsDataStore
+from lmbda.store.api_client import _get_alpaca_client
+
+# Alpaca's data API allows 200 requests per minute on the free plan
+DEFAULT_REQUESTS_PER_SECOND = 200 / 60
+
+
+class TokenBucket:
+	"""Thread-safe token bucket rate limiter. Tokens refill continuously at the given rate, up to capacity."""
+
+	def __init__(self, rate: float, capacity: float = None):
+		self.rate = rate
+		self.capacity = capacity if capacity is not None else max(1.0, rate)
+		self._tokens = self.capacity
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self, tokens: float = 1.0) -> None:
+		"""Block until the requested number of tokens are available, then take them"""
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+				self._last = now
+				if self._tokens >= tokens:
+					self._tokens -= tokens
+					return
+				wait = (tokens - self._tokens) / self.rate
+			time.sleep(wait)
+
+
+class RateLimitedClient:
+	"""Wraps an Alpaca REST client (or a fake of one) so that every get_bars request waits on a shared token bucket
+	and is retried with jittered exponential backoff on failure. Other attributes pass straight through."""
+
+	def __init__(self, client, bucket: TokenBucket, retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0):
+		self.client = client
+		self.bucket = bucket
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+
+	def __getattr__(self, item):
+		return getattr(self.client, item)
+
+	def get_bars(self, *args, **kwargs):
+		for attempt in range(self.retries + 1):
+			self.bucket.acquire()
+			try:
+				return self.client.get_bars(*args, **kwargs)
+			except Exception as e:
+				if attempt == self.retries:
+					raise
+				delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+				warning(f"Bars request failed ({e}), retrying in {delay:.2f}s")
+				time.sleep(delay)
+
+
+class DownloadCheckpoint:
+	"""Resumable record of which symbols a bulk download has completed or given up on, stored as JSON"""
+
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self.completed: Set[str] = set()
+		self.failed: Dict[str, str] = {}
+		self._lock = threading.Lock()
+		if self.path.exists():
+			with open(self.path, "r") as file:
+				checkpoint = json.load(file)
+			self.completed = set(checkpoint["completed"])
+			self.failed = checkpoint["failed"]
+			info(f"Resuming from checkpoint with {len(self.completed)} completed symbols")
+
+	def __contains__(self, symbol: str) -> bool:
+		return symbol.upper() in self.completed
+
+	def complete(self, symbol: str) -> None:
+		with self._lock:
+			self.completed.add(symbol.upper())
+			self.failed.pop(symbol.upper(), None)
+			self._save()
+
+	def fail(self, symbol: str, reason: str) -> None:
+		with self._lock:
+			self.failed[symbol.upper()] = reason
+			self._save()
+
+	def _save(self) -> None:
+		tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+		with open(tmp_path, "w") as file:
+			json.dump({"completed": sorted(self.completed), "failed": self.failed}, file)
+		os.replace(tmp_path, self.path)
+
+
+class BulkDownloader:
+	"""Adds many symbols to a store at once, fanning the downloads out over a thread pool while keeping the combined
+	request rate under Alpaca's quota"""
+
+	def __init__(self, store: BarsDataStore, client=None, workers: int = 8,
+	             requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND, retries: int = 5,
+	             checkpoint: Path = None):
+		self.store = store
+		self.workers = workers
+		self.client = RateLimitedClient(client if client is not None else _get_alpaca_client(),
+		                                TokenBucket(requests_per_second), retries=retries)
+		self.checkpoint = DownloadCheckpoint(checkpoint) if checkpoint is not None else None
+
+	def run(self, symbols: Iterable[str]) -> Dict[str, Exception]:
+		"""Download every symbol not already completed, returning the symbols that failed. With a checkpoint, only the
+		checkpoint says what's complete: a symbol in the store but not the checkpoint may have been cut short by an
+		interrupted run, so it's removed and downloaded again. Without one, every symbol in the store is skipped."""
+		pending = []
+		for symbol in symbols:
+			symbol = symbol.upper()
+			if self.checkpoint is None:
+				if symbol not in self.store:
+					pending.append(symbol)
+				continue
+			if symbol in self.checkpoint:
+				continue
+			if symbol in self.store:
+				warning(f"{symbol} is stored but was never completed, downloading it again")
+				self.store.remove(symbol)
+			pending.append(symbol)
+		info(f"Downloading {len(pending)} symbols with {self.workers} workers")
+
+		failures: Dict[str, Exception] = {}
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			futures = {executor.submit(self.store.add, symbol, client=self.client): symbol for symbol in pending}
+			for i, future in enumerate(as_completed(futures)):
+				symbol = futures[future]
+				try:
+					future.result()
+					if self.checkpoint is not None:
+						self.checkpoint.complete(symbol)
+				except Exception as e:
+					warning(f"Failed to download data for {symbol}: {e}")
+					failures[symbol] = e
+					if self.checkpoint is not None:
+						self.checkpoint.fail(symbol, str(e))
+				if i % 100 == 0:
+					info(f"Downloaded {i + 1}/{len(pending)} symbols ({100 * (i + 1) / len(pending):.2f}% complete)")
+		return failures
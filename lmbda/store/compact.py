@@ -0,0 +1,88 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import numpy as np
+import pandas as pd
+
+# Compact dtype of each bar column. float32 keeps about 7 significant digits, which holds cent-precision prices
+# exactly below $100,000.
+COMPACT_DTYPES = {
+	"open": np.float32,
+	"high": np.float32,
+	"low": np.float32,
+	"close": np.float32,
+	"vwap": np.float32,
+	"volume": np.int64,
+	"trade_count": np.int32
+}
+
+# Dtype of each bar column as returned by Alpaca, restored when expanding a compact frame
+FULL_DTYPES = {
+	"open": np.float64,
+	"high": np.float64,
+	"low": np.float64,
+	"close": np.float64,
+	"vwap": np.float64,
+	"volume": np.int64,
+	"trade_count": np.int64
+}
+
+INDEX_NAME = "timestamp"
+
+
+def to_epoch_ns(index: pd.DatetimeIndex) -> np.ndarray:
+	"""Convert a timestamp index into int64 nanoseconds since the epoch, UTC"""
+	return np.asarray(index.values, dtype="datetime64[ns]").view(np.int64)
+
+
+def from_epoch_ns(values: np.ndarray) -> pd.DatetimeIndex:
+	"""Convert int64 nanoseconds since the epoch back into a UTC timestamp index"""
+	return pd.DatetimeIndex(pd.to_datetime(np.asarray(values, dtype=np.int64), unit="ns", utc=True), name=INDEX_NAME)
+
+
+def is_compact(df: pd.DataFrame) -> bool:
+	"""Whether bars are in the compact schema, which is told apart by its integer index"""
+	return not isinstance(df.index, pd.DatetimeIndex)
+
+
+def to_compact(df: pd.DataFrame) -> pd.DataFrame:
+	"""Convert bars into the compact schema: float32 prices, integer volumes and trade counts, an int64 epoch-ns index
+	and a categorical symbol column, if there is one. Columns outside the schema are left alone. Timestamps, counts and
+	symbols convert losslessly; prices are rounded to float32."""
+	if is_compact(df):
+		return df
+	columns = {}
+	for column in df.columns:
+		if column in COMPACT_DTYPES:
+			if np.issubdtype(COMPACT_DTYPES[column], np.integer) and df[column].isna().any():
+				raise ValueError(f"Column {column} has missing values, which can't be stored as integers")
+			columns[column] = df[column].to_numpy(dtype=COMPACT_DTYPES[column])
+		elif column == "symbol":
+			columns[column] = pd.Categorical(df[column].to_numpy())
+		else:
+			columns[column] = df[column].to_numpy()
+	return pd.DataFrame(columns, index=pd.Index(to_epoch_ns(df.index), name=INDEX_NAME))
+
+
+def from_compact(df: pd.DataFrame) -> pd.DataFrame:
+	"""Expand compact bars back into the schema returned by Alpaca, with a UTC timestamp index, float64 prices and
+	a plain string symbol column"""
+	if not is_compact(df):
+		return df
+	out = df.astype({column: FULL_DTYPES[column] for column in df.columns if column in FULL_DTYPES})
+	if "symbol" in out.columns:
+		out["symbol"] = out["symbol"].astype(str)
+	out.index = from_epoch_ns(df.index.to_numpy())
+	return out
@@ -0,0 +1,126 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import threading
+import zlib
+from typing import List, Set, Union
+
+import numpy as np
+import pandas as pd
+import pytz
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.resample import EXCHANGE_TZ
+
+
+def _synthetic_price(minutes: np.ndarray, phase: int) -> np.ndarray:
+	"""A deterministic, wandering price for each minute since the epoch"""
+	minutes = minutes.astype(np.float64) + phase
+	return 100.0 + 20.0 * np.sin(minutes / 50_000.0) + 5.0 * np.sin(minutes / 977.0) + np.sin(minutes * 12.9898)
+
+
+def synthetic_bars(symbol: str, timeframe: TimeFrame, start: str, end: str) -> pd.DataFrame:
+	"""Generate deterministic bars for a symbol, shaped like the dataframes returned by Alpaca. Daily bars land on
+	weekdays, intraday bars within regular session hours. Prices only depend on the symbol and timestamp, so
+	overlapping requests return identical bars."""
+	start = pd.Timestamp(start, tz=pytz.utc).normalize()
+	end = pd.Timestamp(end, tz=pytz.utc).normalize() + pd.Timedelta(days=1)
+	if timeframe.value == TimeFrame.Day.value:
+		index = pd.date_range(start, end, freq="B") + pd.Timedelta(hours=4)
+		length = 24 * 60
+	else:
+		hourly = timeframe.value == TimeFrame.Hour.value
+		index = pd.date_range(start, end, freq="1h" if hourly else "1min")
+		index = index[(index.dayofweek < 5)
+		              & (index.hour * 60 + index.minute >= 14 * 60 + 30)
+		              & (index.hour < 21)]
+		length = 60 if hourly else 1
+	index = index[index < end].rename("timestamp")
+
+	phase = zlib.crc32(symbol.encode()) % 100_000
+	minutes = np.asarray((index - pd.Timestamp(0, tz=pytz.utc)) // pd.Timedelta(minutes=1), dtype=np.int64)
+	close = _synthetic_price(minutes, phase)
+	open_ = _synthetic_price(minutes - length, phase)
+	return pd.DataFrame({
+		"open": open_,
+		"high": np.maximum(open_, close) * 1.001,
+		"low": np.minimum(open_, close) * 0.999,
+		"close": close,
+		"volume": (minutes % 10_000 + 100).astype(np.int64),
+		"trade_count": (minutes % 100 + 1).astype(np.int64),
+		"vwap": (open_ + close) / 2.0
+	}, index=index)
+
+
+class FakeBars:
+	"""Stand-in for the bars entity returned by the Alpaca REST client"""
+
+	def __init__(self, df: pd.DataFrame):
+		self.df = df
+
+
+class FakeCalendar:
+	"""Stand-in for the calendar entity returned by the Alpaca REST client, with open and close in exchange time"""
+
+	def __init__(self, date: pd.Timestamp, open: datetime.time, close: datetime.time):
+		self.date = date
+		self.open = open
+		self.close = close
+
+
+def synthetic_calendar(start: str, end: str) -> List[FakeCalendar]:
+	"""Generate trading sessions consistent with synthetic_bars: every weekday, from 14:30 to 21:00 UTC"""
+	dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize(), freq="B")
+	opens = (dates + pd.Timedelta(hours=14, minutes=30)).tz_localize(pytz.utc).tz_convert(EXCHANGE_TZ)
+	closes = (dates + pd.Timedelta(hours=21)).tz_localize(pytz.utc).tz_convert(EXCHANGE_TZ)
+	return [FakeCalendar(date, open.time(), close.time()) for date, open, close in zip(dates, opens, closes)]
+
+
+class FakeRESTClient:
+	"""Local stand-in for the Alpaca REST client's get_bars and get_calendar endpoints, for exercising store and downloader code
+	without network access. Optionally fails the first few requests for a symbol to exercise retries, or every request
+	after the first fail_after to exercise downloads cut short."""
+
+	def __init__(self, failures_per_symbol: int = 0, fail_symbols: Set[str] = None, fail_after: int = None):
+		self.failures_per_symbol = failures_per_symbol
+		self.fail_symbols = fail_symbols or set()
+		self.fail_after = fail_after
+		self.requests = 0
+		self._failures = {}
+		self._lock = threading.Lock()
+
+	def get_bars(self, symbol: Union[str, List[str]], timeframe: TimeFrame, start: str = None, end: str = None,
+	             **kwargs) -> FakeBars:
+		symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+		with self._lock:
+			self.requests += 1
+			if self.fail_after is not None and self.requests > self.fail_after:
+				raise ConnectionError(f"Simulated failure after {self.fail_after} requests")
+			for s in symbols:
+				if s in self.fail_symbols:
+					raise ConnectionError(f"Simulated permanent failure for {s}")
+				if self._failures.get(s, 0) < self.failures_per_symbol:
+					self._failures[s] = self._failures.get(s, 0) + 1
+					raise ConnectionError(f"Simulated transient failure for {s}")
+
+		if isinstance(symbol, str):
+			return FakeBars(synthetic_bars(symbol, timeframe, start, end))
+		return FakeBars(pd.concat([synthetic_bars(s, timeframe, start, end).assign(symbol=s) for s in symbols]))
+
+	def get_calendar(self, start: str = None, end: str = None) -> List[FakeCalendar]:
+		with self._lock:
+			self.requests += 1
+		return synthetic_calendar(start, end)
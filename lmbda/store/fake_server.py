@@ -0,0 +1,153 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+from typing import Dict, List, Optional, Set
+
+import pandas as pd
+from aiohttp import WSMsgType, web
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.async_client import BAR_COLUMNS
+from lmbda.store.fake_client import synthetic_bars
+
+TIMEFRAMES = {timeframe.value: timeframe for timeframe in [TimeFrame.Minute, TimeFrame.Hour, TimeFrame.Day]}
+
+
+def bar_objects(symbol: str, df: pd.DataFrame, kind: str = None) -> List[dict]:
+	"""Convert bars into v2 bar objects, tagged with their type and symbol as the stream sends them when kind is
+	given"""
+	fields = {column: field for field, column in BAR_COLUMNS.items()}
+	records = df[[column for column in fields if column in df.columns]].rename(columns=fields).to_dict("records")
+	timestamps = df.index.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%SZ")
+	bars = [dict(record, t=timestamp) for record, timestamp in zip(records, timestamps)]
+	if kind is not None:
+		bars = [dict(bar, T=kind, S=symbol) for bar in bars]
+	return bars
+
+
+class FakeAlpacaServer:
+	"""Local stand-in for Alpaca's v2 market data REST API and bar stream, for exercising the async client and bar
+	ingestion without network access. REST requests are answered with synthetic bars, paginated like the real API, and
+	bars given to publish are pushed to every authenticated subscriber. Requests can be made to fail with a given
+	status to exercise retries."""
+
+	def __init__(self, page_size: int = 1000, key_id: str = "key", secret_key: str = "secret"):
+		self.page_size = page_size
+		self.key_id = key_id
+		self.secret_key = secret_key
+		self.requests = 0
+		self.fail_next: List[int] = []
+		self.url: str = None
+		self._subscribers: Dict[web.WebSocketResponse, Set[str]] = {}
+		self._runner: web.AppRunner = None
+
+		self.app = web.Application()
+		self.app.router.add_get("/v2/stocks/bars", self._multi_bars)
+		self.app.router.add_get("/v2/stocks/{symbol}/bars", self._bars)
+		self.app.router.add_get("/v2/{feed}", self._stream)
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+		"""Start serving, returning the base URL to point both data_url and stream_url at"""
+		self._runner = web.AppRunner(self.app)
+		await self._runner.setup()
+		site = web.TCPSite(self._runner, host, port)
+		await site.start()
+		self.url = f"http://{host}:{site._server.sockets[0].getsockname()[1]}"
+		return self.url
+
+	async def stop(self) -> None:
+		for ws in list(self._subscribers):
+			await ws.close()
+		await self._runner.cleanup()
+
+	async def publish(self, symbol: str, df: pd.DataFrame, kind: str = "b") -> None:
+		"""Push bars for a symbol to every client subscribed to it"""
+		bars = bar_objects(symbol.upper(), df, kind)
+		for ws, symbols in list(self._subscribers.items()):
+			if symbol.upper() in symbols:
+				await ws.send_json(bars)
+
+	def subscribed(self, symbol: str) -> int:
+		"""Count the authenticated clients subscribed to a symbol's bars"""
+		return sum(symbol.upper() in symbols for symbols in self._subscribers.values())
+
+	async def disconnect(self) -> None:
+		"""Drop every stream connection, as happens when Alpaca restarts"""
+		for ws in list(self._subscribers):
+			await ws.close()
+
+	def _check(self, request: web.Request) -> Optional[web.Response]:
+		"""Get the failure to respond with instead of bars, if any"""
+		self.requests += 1
+		if len(self.fail_next) > 0:
+			return web.json_response({"message": "Simulated failure"}, status=self.fail_next.pop(0))
+		if request.headers.get("APCA-API-KEY-ID") != self.key_id:
+			return web.json_response({"message": "forbidden"}, status=403)
+		return None
+
+	def _page(self, request: web.Request, bars: List[tuple]) -> tuple:
+		"""Slice a list of (symbol, bar) pairs into the requested page, returning it along with the next page token"""
+		offset = int(request.query.get("page_token", 0))
+		limit = min(int(request.query.get("limit", self.page_size)), self.page_size)
+		token = str(offset + limit) if offset + limit < len(bars) else None
+		return bars[offset:offset + limit], token
+
+	def _synthetic(self, request: web.Request, symbol: str) -> List[dict]:
+		start = pd.Timestamp(request.query["start"])
+		end = pd.Timestamp(request.query.get("end", pd.Timestamp.now(tz="UTC")))
+		start, end = [time.tz_localize("UTC") if time.tzinfo is None else time for time in (start, end)]
+		df = synthetic_bars(symbol, TIMEFRAMES[request.query["timeframe"]], str(start.date()), str(end.date()))
+		return bar_objects(symbol, df[(df.index >= start) & (df.index <= end)])
+
+	async def _bars(self, request: web.Request) -> web.Response:
+		failure = self._check(request)
+		if failure is not None:
+			return failure
+		symbol = request.match_info["symbol"]
+		page, token = self._page(request, [(symbol, bar) for bar in self._synthetic(request, symbol)])
+		return web.json_response({"symbol": symbol, "bars": [bar for _, bar in page], "next_page_token": token})
+
+	async def _multi_bars(self, request: web.Request) -> web.Response:
+		failure = self._check(request)
+		if failure is not None:
+			return failure
+		symbols = request.query["symbols"].split(",")
+		page, token = self._page(request, [(symbol, bar) for symbol in sorted(symbols)
+		                                   for bar in self._synthetic(request, symbol)])
+		bars: Dict[str, List[dict]] = {}
+		for symbol, bar in page:
+			bars.setdefault(symbol, []).append(bar)
+		return web.json_response({"bars": bars, "next_page_token": token})
+
+	async def _stream(self, request: web.Request) -> web.WebSocketResponse:
+		ws = web.WebSocketResponse()
+		await ws.prepare(request)
+		await ws.send_json([{"T": "success", "msg": "connected"}])
+		async for message in ws:
+			if message.type != WSMsgType.TEXT:
+				continue
+			action = message.json()
+			if action.get("action") == "auth":
+				if action.get("key") != self.key_id or action.get("secret") != self.secret_key:
+					await ws.send_json([{"T": "error", "code": 402, "msg": "auth failed"}])
+					await ws.close()
+					break
+				self._subscribers[ws] = set()
+				await ws.send_json([{"T": "success", "msg": "authenticated"}])
+			elif action.get("action") == "subscribe" and ws in self._subscribers:
+				self._subscribers[ws].update(action.get("bars", []))
+				await ws.send_json([{"T": "subscription", "bars": sorted(self._subscribers[ws])}])
+		self._subscribers.pop(ws, None)
+		return ws
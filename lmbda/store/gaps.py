@@ -0,0 +1,284 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging import info, warning
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pytz
+from alpaca_trade_api.rest import REST, TimeFrame
+
+from lmbda import metrics
+from lmbda.store import BarsDataStore
+from lmbda.store.api_client import _get_alpaca_client, uses_alpaca_client
+from lmbda.store.bulk_download import DEFAULT_REQUESTS_PER_SECOND, RateLimitedClient, TokenBucket
+from lmbda.store.compact import from_epoch_ns, to_epoch_ns
+from lmbda.store.locking import atomic_path
+from lmbda.store.resample import EXCHANGE_TZ
+
+GAP_INDEX_VERSION = 1
+MINUTE_NS = 60 * 10 ** 9
+HOUR_NS = 60 * MINUTE_NS
+
+# A range of missing bars, from the first missing bar's timestamp through the last's
+Gap = Tuple[pd.Timestamp, pd.Timestamp]
+
+
+class TradingCalendar:
+	"""Exchange trading sessions, each a date along with its open and close as UTC epoch nanoseconds. Early closes and
+	holidays come from the calendar itself, so they're never mistaken for missing data."""
+
+	def __init__(self, dates: pd.DatetimeIndex, opens: np.ndarray, closes: np.ndarray):
+		order = np.argsort(opens)
+		self.dates = pd.DatetimeIndex(dates)[order]
+		self.opens = np.asarray(opens, dtype=np.int64)[order]
+		self.closes = np.asarray(closes, dtype=np.int64)[order]
+
+	def __len__(self) -> int:
+		return len(self.opens)
+
+	@classmethod
+	def from_sessions(cls, sessions: Iterable) -> "TradingCalendar":
+		"""Build a calendar from Alpaca calendar entities, or anything else with a date along with open and close
+		times in exchange time"""
+		sessions = list(sessions)
+		dates = pd.DatetimeIndex([pd.Timestamp(session.date).normalize() for session in sessions])
+
+		def localize(times: List[datetime.time]) -> np.ndarray:
+			local = pd.DatetimeIndex([pd.Timestamp.combine(date, time) for date, time in zip(dates, times)])
+			return to_epoch_ns(local.tz_localize(EXCHANGE_TZ).tz_convert(pytz.utc))
+
+		return cls(dates.tz_localize(pytz.utc), localize([session.open for session in sessions]),
+		           localize([session.close for session in sessions]))
+
+	@classmethod
+	@uses_alpaca_client
+	def from_alpaca(cls, start: datetime.date, end: datetime.date, client: REST) -> "TradingCalendar":
+		"""Fetch the exchange calendar from Alpaca for every session from start to end"""
+		info(f"Fetching trading calendar from {start} to {end}")
+		return cls.from_sessions(client.get_calendar(str(start), str(end)))
+
+	def last_close(self, now: pd.Timestamp = None) -> Optional[pd.Timestamp]:
+		"""Get the close of the last session completed by now, or None if none has"""
+		now = to_epoch_ns(pd.DatetimeIndex([now or pd.Timestamp.now(tz=pytz.utc)]))[0]
+		position = np.searchsorted(self.closes, now, side="right")
+		return from_epoch_ns(self.closes[position - 1:position])[0] if position > 0 else None
+
+	def expected(self, timeframe: TimeFrame, start: pd.Timestamp = None, end: pd.Timestamp = None) -> np.ndarray:
+		"""Get the timestamp of every bar expected within regular session hours, as sorted epoch nanoseconds. Daily bars
+		are keyed by their UTC date, intraday bars by the minute or hour they start at."""
+		if timeframe.value == TimeFrame.Day.value:
+			expected = to_epoch_ns(self.dates)
+		else:
+			# Every minute from each session's open up to its close, built in one pass over all sessions
+			counts = (self.closes - self.opens) // MINUTE_NS
+			offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+			expected = np.repeat(self.opens, counts) + offsets * MINUTE_NS
+			if timeframe.value == TimeFrame.Hour.value:
+				expected = expected[expected % HOUR_NS == 0]
+		lower = 0 if start is None else np.searchsorted(expected, bar_keys(pd.DatetimeIndex([start]), timeframe)[0])
+		upper = len(expected) if end is None else \
+			np.searchsorted(expected, bar_keys(pd.DatetimeIndex([end]), timeframe)[0], side="right")
+		return expected[lower:upper]
+
+
+def bar_keys(index: pd.DatetimeIndex, timeframe: TimeFrame) -> np.ndarray:
+	"""Key stored timestamps the same way as TradingCalendar.expected, so the two can be compared directly"""
+	keys = to_epoch_ns(index)
+	if timeframe.value == TimeFrame.Day.value:
+		return keys - keys % (24 * HOUR_NS)
+	return keys - keys % (HOUR_NS if timeframe.value == TimeFrame.Hour.value else MINUTE_NS)
+
+
+def find_gaps(index: pd.DatetimeIndex, calendar: TradingCalendar, timeframe: TimeFrame, min_gap: int = 1,
+              start: pd.Timestamp = None, end: pd.Timestamp = None) -> List[Gap]:
+	"""
+	Find runs of bars the calendar expects but that are missing from a symbol's stored timestamps. Every expected bar
+	is checked at once with a sorted search rather than a loop over sessions.
+	:param index: Stored timestamps of a symbol's bars
+	:param calendar: Trading calendar covering the stored history
+	:param timeframe: Timeframe of the stored bars
+	:param min_gap: Fewest consecutive missing bars reported as a gap. Thinly traded symbols have no minute bars
+	for minutes without trades, so minute stores usually want a larger threshold.
+	:param start: Start of the range to check, defaulting to the first stored bar
+	:param end: End of the range to check, defaulting to the close of the calendar's last completed session, so that
+	bars missing after the last stored one are found too
+	:return: Each gap's first and last missing bar timestamps"""
+	if len(index) == 0:
+		return []
+	have = np.unique(bar_keys(index, timeframe))
+	if end is None:
+		end = calendar.last_close()
+	expected = calendar.expected(timeframe, index.min() if start is None else start,
+	                             index.max() if end is None else end)
+	if len(expected) == 0:
+		return []
+
+	positions = np.minimum(np.searchsorted(have, expected), len(have) - 1)
+	missing = np.flatnonzero(have[positions] != expected)
+	if len(missing) == 0:
+		return []
+	# Consecutive missing positions form a run, even across sessions, since a failed request loses whole windows
+	breaks = np.flatnonzero(np.diff(missing) != 1) + 1
+	firsts = missing[np.r_[0, breaks]]
+	lasts = missing[np.r_[breaks - 1, len(missing) - 1]]
+	keep = lasts - firsts + 1 >= min_gap
+	return list(zip(from_epoch_ns(expected[firsts[keep]]), from_epoch_ns(expected[lasts[keep]])))
+
+
+class GapIndex:
+	"""Persistent JSON record of each symbol's missing ranges, along with the ranges already backfilled. Whatever is
+	still missing from a backfilled range wasn't available from Alpaca either (a halt, or minutes without trades), so
+	gaps within them aren't reported again."""
+
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self._lock = threading.Lock()
+		self._symbols: Dict[str, Dict[str, List[List[str]]]] = {}
+		if self.path.exists():
+			with open(self.path, "r") as file:
+				index = json.load(file)
+			if index.get("version") == GAP_INDEX_VERSION:
+				self._symbols = index["symbols"]
+
+	def symbols(self) -> List[str]:
+		"""Symbols with outstanding gaps"""
+		return sorted(symbol for symbol, entry in self._symbols.items() if len(entry["missing"]) > 0)
+
+	def missing(self, symbol: str) -> List[Gap]:
+		return self._ranges(symbol, "missing")
+
+	def checked(self, symbol: str) -> List[Gap]:
+		return self._ranges(symbol, "checked")
+
+	def record(self, symbol: str, gaps: List[Gap]) -> List[Gap]:
+		"""Replace a symbol's missing ranges with freshly detected ones, dropping any within an already backfilled
+		range. Returns the gaps kept."""
+		checked = self.checked(symbol)
+		gaps = [gap for gap in gaps if not any(start <= gap[0] and gap[1] <= end for start, end in checked)]
+		self._set(symbol, "missing", gaps)
+		return gaps
+
+	def resolve(self, symbol: str, gap: Gap) -> None:
+		"""Mark a gap as backfilled"""
+		with self._lock:
+			entry = self._entry(symbol)
+			encoded = [gap[0].isoformat(), gap[1].isoformat()]
+			entry["missing"] = [missing for missing in entry["missing"] if missing != encoded]
+			entry["checked"].append(encoded)
+
+	def save(self) -> None:
+		with self._lock, atomic_path(self.path) as tmp_path, open(tmp_path, "w") as file:
+			json.dump({"version": GAP_INDEX_VERSION, "symbols": self._symbols}, file)
+
+	def _ranges(self, symbol: str, kind: str) -> List[Gap]:
+		return [(pd.Timestamp(start), pd.Timestamp(end))
+		        for start, end in self._symbols.get(symbol.upper(), {}).get(kind, [])]
+
+	def _set(self, symbol: str, kind: str, gaps: List[Gap]) -> None:
+		with self._lock:
+			self._entry(symbol)[kind] = [[start.isoformat(), end.isoformat()] for start, end in gaps]
+
+	def _entry(self, symbol: str) -> Dict[str, List[List[str]]]:
+		return self._symbols.setdefault(symbol.upper(), {"missing": [], "checked": []})
+
+
+def scan_gaps(store: BarsDataStore, calendar: TradingCalendar, index: GapIndex, symbols: Iterable[str] = None,
+              min_gap: int = 1, workers: int = 8) -> Dict[str, List[Gap]]:
+	"""Check every stored symbol (or just the given ones) against the calendar, recording their gaps in the index.
+	Only timestamps are needed, so a single column is read per symbol."""
+	symbols = sorted(symbol.upper() for symbol in (store.symbols() if symbols is None else symbols))
+	info(f"Scanning {len(symbols)} symbols for gaps")
+
+	def scan(symbol: str) -> List[Gap]:
+		return find_gaps(store.bars(symbol, columns=["close"]).index, calendar, store.timeframe, min_gap)
+
+	found: Dict[str, List[Gap]] = {}
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(scan, symbol): symbol for symbol in symbols}
+		for future in as_completed(futures):
+			symbol = futures[future]
+			try:
+				gaps = index.record(symbol, future.result())
+			except Exception as e:
+				warning(f"Failed to scan {symbol} for gaps: {e}")
+				continue
+			if len(gaps) > 0:
+				found[symbol] = gaps
+	index.save()
+	metrics.incr("gaps.found", sum(len(gaps) for gaps in found.values()))
+	info(f"Found {sum(len(gaps) for gaps in found.values())} gaps in {len(found)} symbols")
+	return found
+
+
+def backfill_gaps(store: BarsDataStore, index: GapIndex, symbols: Iterable[str] = None, client=None, workers: int = 8,
+                  requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND) -> Dict[str, Exception]:
+	"""
+	Fetch just the missing ranges recorded in the index and write them into the store, rather than re-downloading
+	whole histories. Each gap is one request covering the gap alone.
+	:param store: BarsDataStore the gaps were found in
+	:param index: GapIndex holding the gaps, updated as they're filled
+	:param symbols: Symbols to repair, defaulting to every symbol with outstanding gaps
+	:param client: Alpaca client, or a fake of one, defaulting to the shared client
+	:param workers: Number of concurrent requests
+	:param requests_per_second: Maximum API requests per second
+	:return: The symbols that failed to repair, mapped to the error raised"""
+	client = RateLimitedClient(client if client is not None else _get_alpaca_client(), TokenBucket(requests_per_second))
+	bar_length = pd.Timedelta(days=1) if store.timeframe.value == TimeFrame.Day.value else \
+		pd.Timedelta(hours=1) if store.timeframe.value == TimeFrame.Hour.value else pd.Timedelta(minutes=1)
+	symbols = index.symbols() if symbols is None else sorted(symbol.upper() for symbol in symbols)
+	requests = [(symbol, gap) for symbol in symbols for gap in index.missing(symbol)]
+	info(f"Backfilling {len(requests)} gaps in {len(symbols)} symbols")
+
+	def fetch(symbol: str, gap: Gap) -> pd.DataFrame:
+		end = gap[1] + bar_length
+		if store.timeframe.value == TimeFrame.Day.value:
+			df = client.get_bars(symbol, store.timeframe, str(gap[0].date()), str(gap[1].date())).df
+		else:
+			df = client.get_bars(symbol, store.timeframe, gap[0].isoformat(), end.isoformat()).df
+		return df[(df.index >= gap[0]) & (df.index < end)]
+
+	fetched: Dict[str, List[pd.DataFrame]] = {}
+	failures: Dict[str, Exception] = {}
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(fetch, symbol, gap): (symbol, gap) for symbol, gap in requests}
+		for future in as_completed(futures):
+			symbol, gap = futures[future]
+			try:
+				df = future.result()
+			except Exception as e:
+				warning(f"Failed to fetch {symbol} from {gap[0]} to {gap[1]}: {e}")
+				failures[symbol] = e
+				continue
+			if len(df) > 0:
+				fetched.setdefault(symbol, []).append(df)
+			else:
+				info(f"No bars available for {symbol} from {gap[0]} to {gap[1]}")
+
+	failures.update(store.update_many({symbol: pd.concat(frames) for symbol, frames in fetched.items()},
+	                                  workers=workers))
+	for symbol, gap in requests:
+		if symbol not in failures:
+			index.resolve(symbol, gap)
+	index.save()
+	metrics.incr("gaps.backfilled", sum(1 for symbol, gap in requests if symbol not in failures))
+	metrics.incr("gaps.rows_backfilled", sum(len(df) for frames in fetched.values() for df in frames))
+	return failures
@@ -0,0 +1,114 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from logging import warning
+from pathlib import Path
+from typing import Dict, Iterator
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Process-local locks used in place of advisory file locks where fcntl isn't available
+_fallback_locks: Dict[str, threading.Lock] = {}
+_fallback_guard = threading.Lock()
+
+
+@contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+	"""Yield a temporary path next to the given one to write to, then atomically rename it into place once the block
+	completes. Readers see either the old file or the new one in full, and a crash mid-write leaves the old file
+	untouched. Temporary files are hidden and end in .tmp, so they never match a partition glob, which means writers
+	can't infer a format from their suffix."""
+	path = Path(path)
+	tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+	try:
+		yield tmp_path
+		with open(tmp_path, "rb") as file:
+			os.fsync(file.fileno())
+		os.replace(tmp_path, path)
+	finally:
+		if tmp_path.exists():
+			tmp_path.unlink()
+
+
+class FileLock:
+	"""Exclusive advisory lock on a file, held across processes and threads alike. Reentrant within a thread, so a
+	locked operation can call another which takes the same lock. Where fcntl isn't available, only threads of the
+	same process are excluded."""
+
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self._local = threading.local()
+
+	def __getstate__(self):
+		return {"path": self.path}
+
+	def __setstate__(self, state):
+		self.__init__(state["path"])
+
+	def __enter__(self):
+		depth = getattr(self._local, "depth", 0)
+		if depth == 0:
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			if fcntl is not None:
+				self._local.file = open(self.path, "a")
+				fcntl.flock(self._local.file.fileno(), fcntl.LOCK_EX)
+			else:
+				with _fallback_guard:
+					lock = _fallback_locks.setdefault(str(self.path), threading.Lock())
+				lock.acquire()
+		self._local.depth = depth + 1
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._local.depth -= 1
+		if self._local.depth == 0:
+			if fcntl is not None:
+				fcntl.flock(self._local.file.fileno(), fcntl.LOCK_UN)
+				self._local.file.close()
+				del self._local.file
+			else:
+				_fallback_locks[str(self.path)].release()
+
+
+class SymbolLocks:
+	"""Per-symbol advisory locks kept as lock files under a directory, so that writers in different processes never
+	modify the same symbol at once while writes to different symbols proceed in parallel"""
+
+	def __init__(self, lock_dir: Path):
+		self.lock_dir = Path(lock_dir)
+		self._locks: Dict[str, FileLock] = {}
+		self._guard = threading.Lock()
+		if fcntl is None:
+			warning("fcntl is unavailable, so symbols are only locked against writers in this process")
+
+	def __getstate__(self):
+		return {"lock_dir": self.lock_dir}
+
+	def __setstate__(self, state):
+		self.__init__(state["lock_dir"])
+
+	def __call__(self, symbol: str) -> FileLock:
+		symbol = symbol.upper()
+		with self._guard:
+			if symbol not in self._locks:
+				self._locks[symbol] = FileLock(self.lock_dir / f"{symbol}.lock")
+			return self._locks[symbol]
@@ -0,0 +1,177 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import math
+import numbers
+import time
+from logging import warning
+from typing import Dict, Iterable, NamedTuple, Optional
+
+import boto3
+
+from lmbda import metrics
+
+# DynamoDB's limits on keys per BatchGetItem request and items per BatchWriteItem request
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+
+class SymbolMetadata(NamedTuple):
+	"""What the metadata table knows about one symbol of one dataset, as of its last write"""
+	symbol: str
+	dataset: str
+	last_timestamp: datetime.datetime
+	last_bar: Dict[str, float]
+	rows: int
+	partitions: Dict[str, int]
+	updated_at: datetime.datetime
+
+	def age(self, now: datetime.datetime = None) -> datetime.timedelta:
+		"""Time since the symbol's last bar"""
+		return (now or datetime.datetime.now(datetime.timezone.utc)) - self.last_timestamp
+
+
+class SymbolMetadataTable:
+	"""
+	DynamoDB table holding each symbol's last bar, row count and partition list, so request handlers can answer
+	"what's the latest bar" or "which symbols are stale" with a single GetItem or BatchGetItem instead of opening any
+	data. Items are keyed by symbol and dataset, so stores of several timeframes or locations can share a table.
+	:param table_name: Name of the table
+	:param dataset: Name of the dataset these symbols belong to, usually the store's timeframe
+	:param client: DynamoDB client to use, created if not given
+	:param endpoint_url: Endpoint to create the client against, for DynamoDB Local
+	"""
+
+	def __init__(self, table_name: str, dataset: str = "Day", client=None, endpoint_url: str = None):
+		self.table_name = table_name
+		self.dataset = dataset
+		self.endpoint_url = endpoint_url
+		self.client = client or boto3.client("dynamodb", endpoint_url=endpoint_url)
+
+	def __getstate__(self):
+		# boto3 clients can't be pickled, so each process creates its own
+		state = self.__dict__.copy()
+		del state["client"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.client = boto3.client("dynamodb", endpoint_url=self.endpoint_url)
+
+	def create(self) -> None:
+		"""Create the table on demand, as the CDK stack does. Meant for DynamoDB Local and tests."""
+		self.client.create_table(TableName=self.table_name,
+		                         KeySchema=[{"AttributeName": "symbol", "KeyType": "HASH"},
+		                                    {"AttributeName": "dataset", "KeyType": "RANGE"}],
+		                         AttributeDefinitions=[{"AttributeName": "symbol", "AttributeType": "S"},
+		                                               {"AttributeName": "dataset", "AttributeType": "S"}],
+		                         BillingMode="PAY_PER_REQUEST")
+		self.client.get_waiter("table_exists").wait(TableName=self.table_name)
+
+	@metrics.timed("metadata.record")
+	def record(self, symbol: str, last_bar, partitions: Dict[str, int], rows: int = None) -> None:
+		"""
+		Write a symbol's metadata, replacing whatever was there
+		:param symbol: Symbol to record
+		:param last_bar: Single-row dataframe of the symbol's last bar
+		:param partitions: Each partition's name mapped to its row count
+		:param rows: Number of bars stored for the symbol, defaulting to the sum of its partitions' row counts, which
+		overcounts for stores whose partitions overlap
+		"""
+		self.client.put_item(TableName=self.table_name, Item=self._item(symbol, last_bar, partitions, rows))
+
+	@metrics.timed("metadata.record_many")
+	def record_many(self, records: Iterable[tuple], removed: Iterable[str] = (), max_attempts: int = 5) -> None:
+		"""Write many symbols' metadata and remove others', 25 to a request. Items DynamoDB leaves unprocessed are
+		retried with backoff.
+		:param records: (symbol, last_bar, partitions, rows) tuples, each taking the same arguments as record
+		:param removed: Symbols whose metadata to remove
+		:param max_attempts: Requests made for each batch before giving up on its unprocessed items"""
+		writes = [{"PutRequest": {"Item": self._item(*record)}} for record in records] + \
+		         [{"DeleteRequest": {"Key": self._key(symbol)}} for symbol in removed]
+		for i in range(0, len(writes), BATCH_WRITE_SIZE):
+			request = {self.table_name: writes[i:i + BATCH_WRITE_SIZE]}
+			for attempt in range(max_attempts):
+				request = self.client.batch_write_item(RequestItems=request).get("UnprocessedItems") or {}
+				if len(request) == 0:
+					break
+				time.sleep(0.05 * 2 ** attempt)
+			else:
+				warning(f"Gave up on {len(request[self.table_name])} unprocessed metadata writes")
+
+	@metrics.timed("metadata.get")
+	def get(self, symbol: str) -> Optional[SymbolMetadata]:
+		"""Get a symbol's metadata, or None if it has none"""
+		response = self.client.get_item(TableName=self.table_name, Key=self._key(symbol))
+		return self._parse(response["Item"]) if "Item" in response else None
+
+	@metrics.timed("metadata.batch_get")
+	def batch_get(self, symbols: Iterable[str], max_attempts: int = 5) -> Dict[str, SymbolMetadata]:
+		"""Get metadata for many symbols, 100 to a request. Symbols without metadata are left out of the result. Keys
+		DynamoDB leaves unprocessed are retried with backoff."""
+		keys = [self._key(symbol) for symbol in sorted({symbol.upper() for symbol in symbols})]
+		found = {}
+		for i in range(0, len(keys), BATCH_GET_SIZE):
+			request = {self.table_name: {"Keys": keys[i:i + BATCH_GET_SIZE]}}
+			for attempt in range(max_attempts):
+				response = self.client.batch_get_item(RequestItems=request)
+				for item in response["Responses"].get(self.table_name, []):
+					metadata = self._parse(item)
+					found[metadata.symbol] = metadata
+				request = response.get("UnprocessedKeys") or {}
+				if len(request) == 0:
+					break
+				time.sleep(0.05 * 2 ** attempt)
+			else:
+				warning(f"Gave up on {len(request[self.table_name]['Keys'])} unprocessed metadata keys")
+		return found
+
+	def remove(self, symbol: str) -> None:
+		self.client.delete_item(TableName=self.table_name, Key=self._key(symbol))
+
+	def stale(self, symbols: Iterable[str], threshold: datetime.timedelta = datetime.timedelta(days=3),
+	          now: datetime.datetime = None) -> Dict[str, datetime.timedelta]:
+		"""Get symbols whose last bar is older than the threshold, and how old it is, from their metadata alone.
+		Symbols with no metadata aren't included."""
+		now = now or datetime.datetime.now(datetime.timezone.utc)
+		ages = {symbol: metadata.age(now) for symbol, metadata in self.batch_get(symbols).items()}
+		return {symbol: age for symbol, age in ages.items() if age > threshold}
+
+	def _key(self, symbol: str) -> Dict[str, dict]:
+		return {"symbol": {"S": symbol.upper()}, "dataset": {"S": self.dataset}}
+
+	def _item(self, symbol: str, last_bar, partitions: Dict[str, int], rows: int = None) -> Dict[str, dict]:
+		bar = {column: {"N": repr(float(value))} for column, value in last_bar.iloc[-1].items()
+		       if isinstance(value, numbers.Real) and math.isfinite(value)}
+		return {
+			"symbol": {"S": symbol.upper()},
+			"dataset": {"S": self.dataset},
+			"last_timestamp": {"S": last_bar.index[-1].isoformat()},
+			"last_bar": {"M": bar},
+			"rows": {"N": str(sum(partitions.values()) if rows is None else rows)},
+			"partitions": {"M": {name: {"N": str(count)} for name, count in partitions.items()}},
+			"updated_at": {"S": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+		}
+
+	@staticmethod
+	def _parse(item: dict) -> SymbolMetadata:
+		return SymbolMetadata(symbol=item["symbol"]["S"],
+		                      dataset=item["dataset"]["S"],
+		                      last_timestamp=datetime.datetime.fromisoformat(item["last_timestamp"]["S"]),
+		                      last_bar={column: float(value["N"]) for column, value in item["last_bar"]["M"].items()},
+		                      rows=int(item["rows"]["N"]),
+		                      partitions={name: int(rows["N"]) for name, rows in item["partitions"]["M"].items()},
+		                      updated_at=datetime.datetime.fromisoformat(item["updated_at"]["S"]))
@@ -0,0 +1,84 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import numpy as np
+import pandas as pd
+import pytz
+
+# Sessions are defined in exchange time, so bins follow daylight savings rather than fixed UTC offsets
+EXCHANGE_TZ = "America/New_York"
+SESSION_OPEN_MINUTE = 9 * 60 + 30
+SESSION_CLOSE_MINUTE = 16 * 60
+
+# Target timeframes derivable from minute bars, mapped to their pandas frequencies
+RULES = {
+	"5Min": "5min",
+	"15Min": "15min",
+	"1Hour": "1h",
+	"1Day": "1D"
+}
+
+# How each bar column combines across a bin. vwap is handled separately, as it has to be weighted by volume.
+AGGREGATIONS = {
+	"open": "first",
+	"high": "max",
+	"low": "min",
+	"close": "last",
+	"volume": "sum",
+	"trade_count": "sum"
+}
+
+
+def session_bins(index: pd.DatetimeIndex, rule: str) -> pd.DatetimeIndex:
+	"""Get the UTC start of the bin each timestamp falls into. Bins are aligned to the clock in exchange time, so they
+	never span two sessions. Daily bins start at exchange midnight, as Alpaca's daily bars do."""
+	local = index.tz_convert(EXCHANGE_TZ).tz_localize(None)
+	starts = local.normalize() if RULES[rule] == "1D" else local.floor(RULES[rule])
+	return starts.tz_localize(EXCHANGE_TZ, ambiguous="NaT", nonexistent="shift_forward").tz_convert(pytz.utc)
+
+
+def regular_session(df: pd.DataFrame) -> pd.DataFrame:
+	"""Filter bars down to those within regular trading hours"""
+	local = df.index.tz_convert(EXCHANGE_TZ)
+	minutes = local.hour * 60 + local.minute
+	return df[(minutes >= SESSION_OPEN_MINUTE) & (minutes < SESSION_CLOSE_MINUTE)]
+
+
+def resample_bars(df: pd.DataFrame, rule: str, regular_hours: bool = True) -> pd.DataFrame:
+	"""Aggregate bars into a coarser timeframe, taking the first open, highest high, lowest low and last close of each
+	bin, summing volume and trade counts and weighting vwap by volume. Only columns present are aggregated.
+	:param df: Bars to aggregate, indexed by UTC timestamp
+	:param rule: Target timeframe, one of RULES
+	:param regular_hours: Whether to drop pre- and post-market bars before aggregating
+	:return: Aggregated bars indexed by the UTC start of each bin"""
+	if rule not in RULES:
+		raise ValueError(f"Unknown resampling rule {rule}, expected one of {', '.join(RULES)}")
+	if regular_hours:
+		df = regular_session(df)
+	if len(df) == 0:
+		return df.iloc[:0]
+
+	bins = session_bins(df.index, rule).rename(df.index.name)
+	grouped = df.groupby(bins, sort=True)
+	out = grouped.agg({column: how for column, how in AGGREGATIONS.items() if column in df.columns})
+	if "vwap" in df.columns:
+		if "volume" in df.columns:
+			volume = grouped["volume"].sum()
+			weighted = (df["vwap"] * df["volume"]).groupby(bins, sort=True).sum()
+			# Bins without any volume fall back to the plain mean
+			out["vwap"] = np.where(volume > 0, weighted / volume.where(volume > 0, 1), grouped["vwap"].mean())
+		else:
+			out["vwap"] = grouped["vwap"].mean()
+	return out[[column for column in df.columns if column in out.columns]]
@@ -0,0 +1,211 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+import threading
+from logging import debug
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import pandas as pd
+
+from lmbda.store.locking import atomic_path
+
+INDEX_VERSION = 2
+
+
+class SymbolIndex:
+	"""Persistent manifest of the symbols in a store, sharded into one small JSON file per symbol under a directory.
+	Each shard records the symbol's partitions along with their row counts and first/last timestamps, so that
+	membership and staleness queries never need to touch the data files. Saving a symbol rewrites only its own shard,
+	so the cost of a save doesn't grow with the store and writers of different symbols never wait on each other.
+	Writers must hold the symbol's lock while saving it. Several processes may share a manifest: refresh re-reads only
+	the shards other processes have changed since they were last read."""
+
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self._lock = threading.RLock()
+		self._symbols: Dict[str, Dict[str, dict]] = {}
+		# Symbols changed since they were last saved, and whether the whole manifest was cleared
+		self._dirty: Set[str] = set()
+		self._cleared = False
+		# Modification time and size of each shard, and of the directory holding them, when last read or written
+		self._stamps: Dict[str, Tuple[int, int]] = {}
+		self._stamp: Optional[Tuple[int, int]] = None
+		self.loaded = self.load()
+
+	def __contains__(self, symbol: str) -> bool:
+		return len(self._symbols.get(symbol.upper(), {})) > 0
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.RLock()
+
+	def load(self) -> bool:
+		"""Load every shard from disk, returning whether or not a manifest was found"""
+		if not self.path.is_dir():
+			return False
+		with self._lock:
+			self._symbols, self._stamps, self._stamp = {}, {}, None
+			self._dirty, self._cleared = set(), False
+			self._scan()
+		debug(f"Loaded index of {len(self._symbols)} symbols from {self.path}")
+		return True
+
+	def refresh(self, symbol: str = None) -> None:
+		"""Pick up changes saved by other processes, keeping any unsaved changes made here. Refreshing a single symbol
+		takes one stat, and refreshing them all only a stat of the directory when nothing has changed."""
+		if self._cleared:
+			return
+		if symbol is not None:
+			symbol = symbol.upper()
+			with self._lock:
+				self._refresh_shard(symbol, self._stat(self._shard_path(symbol)))
+			return
+		stamp = self._stat(self.path)
+		if stamp is None or stamp == self._stamp:
+			return
+		with self._lock:
+			self._scan()
+
+	def save(self, symbols: Iterable[str] = None) -> None:
+		"""Atomically write the shards of the given symbols, or every symbol changed since the last save"""
+		with self._lock:
+			if self._cleared:
+				# Shards of symbols forgotten by the clear are removed along with the symbols' own changes
+				self._dirty |= {path.name[:-len(".json")] for path in self.path.glob("*.json")}
+				self._cleared, symbols = False, None
+			symbols = set(self._dirty) if symbols is None else {symbol.upper() for symbol in symbols} & self._dirty
+			shards = {symbol: dict(self._symbols.get(symbol, {})) for symbol in symbols}
+			self._dirty -= symbols
+		self.path.mkdir(parents=True, exist_ok=True)
+		for symbol, partitions in shards.items():
+			path = self._shard_path(symbol)
+			if partitions:
+				with atomic_path(path) as tmp_path, open(tmp_path, "w") as file:
+					json.dump({"version": INDEX_VERSION, "partitions": partitions}, file)
+			elif path.exists():
+				path.unlink()
+			with self._lock:
+				self._stamps[symbol] = self._stat(path)
+		self.loaded = True
+
+	def clear(self) -> None:
+		"""Forget every symbol. The next save removes the shards of symbols that weren't recorded again since."""
+		with self._lock:
+			self._symbols = {}
+			self._dirty = set()
+			self._cleared = True
+
+	def _scan(self) -> None:
+		"""Re-read every shard that changed on disk since it was last read, and drop those that were removed"""
+		self._stamp = self._stat(self.path)
+		found = set()
+		for path in self.path.glob("*.json"):
+			symbol = path.name[:-len(".json")]
+			found.add(symbol)
+			self._refresh_shard(symbol, self._stat(path))
+		for symbol in set(self._stamps) - found:
+			self._refresh_shard(symbol, None)
+
+	def _refresh_shard(self, symbol: str, stamp: Optional[Tuple[int, int]]) -> None:
+		if symbol in self._dirty or stamp == self._stamps.get(symbol):
+			return
+		partitions = self._read(symbol) if stamp is not None else None
+		if partitions is None:
+			self._symbols.pop(symbol, None)
+			self._stamps.pop(symbol, None)
+		else:
+			self._symbols[symbol], self._stamps[symbol] = partitions, stamp
+
+	def _read(self, symbol: str) -> Optional[Dict[str, dict]]:
+		try:
+			with open(self._shard_path(symbol), "r") as file:
+				shard = json.load(file)
+		except FileNotFoundError:
+			return None
+		return shard["partitions"] if shard.get("version") == INDEX_VERSION else None
+
+	def _shard_path(self, symbol: str) -> Path:
+		return self.path / f"{symbol}.json"
+
+	@staticmethod
+	def _stat(path: Path) -> Optional[Tuple[int, int]]:
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			return None
+		return stat.st_mtime_ns, stat.st_size
+
+	def symbols(self) -> Set[str]:
+		with self._lock:
+			return {symbol for symbol, partitions in self._symbols.items() if len(partitions) > 0}
+
+	def partitions(self, symbol: str) -> Dict[str, dict]:
+		"""Get the partition name -> {rows, first, last} mapping for a symbol"""
+		with self._lock:
+			return dict(self._symbols.get(symbol.upper(), {}))
+
+	def rows(self, symbol: str) -> int:
+		return sum(partition["rows"] for partition in self.partitions(symbol).values())
+
+	def first(self, symbol: str) -> Optional[pd.Timestamp]:
+		partitions = self.partitions(symbol)
+		if len(partitions) == 0:
+			return None
+		return min(pd.Timestamp(partition["first"]) for partition in partitions.values())
+
+	def last(self, symbol: str) -> Optional[pd.Timestamp]:
+		partition = self.last_partition(symbol)
+		if partition is None:
+			return None
+		return pd.Timestamp(self.partitions(symbol)[partition]["last"])
+
+	def last_partition(self, symbol: str) -> Optional[str]:
+		"""Get the name of the partition holding a symbol's most recent data point"""
+		partitions = self.partitions(symbol)
+		if len(partitions) == 0:
+			return None
+		return max(partitions, key=lambda name: pd.Timestamp(partitions[name]["last"]))
+
+	def record(self, symbol: str, partition: str, df: pd.DataFrame) -> None:
+		"""Record (or overwrite) the statistics of a partition from the data written to it"""
+		if len(df) == 0:
+			return self.discard(symbol, partition)
+		with self._lock:
+			self._dirty.add(symbol.upper())
+			self._symbols.setdefault(symbol.upper(), {})[partition] = {
+				"rows": len(df),
+				"first": df.index.min().isoformat(),
+				"last": df.index.max().isoformat()
+			}
+
+	def discard(self, symbol: str, partition: str = None) -> None:
+		"""Forget a single partition of a symbol, or the whole symbol if no partition is given"""
+		symbol = symbol.upper()
+		with self._lock:
+			self._dirty.add(symbol)
+			if partition is None:
+				self._symbols.pop(symbol, None)
+				return
+			self._symbols.get(symbol, {}).pop(partition, None)
+			if len(self._symbols.get(symbol, {})) == 0:
+				self._symbols.pop(symbol, None)
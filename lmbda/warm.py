@@ -0,0 +1,72 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import threading
+from typing import Dict, Tuple
+
+# Pool of opened stores kept at module level, so they survive across invocations of a warm Lambda container. Only
+# the standard library is imported here; pandas and the Alpaca client are imported on first use.
+_stores: Dict[Tuple[str, str, str], object] = {}
+_tables: Dict[Tuple[str, str], object] = {}
+_lock = threading.Lock()
+
+DEFAULT_DATA_DIR = "/tmp/traitor"
+
+
+def client(paper_trading: bool = True):
+	"""Get the process-wide Alpaca REST client, creating it on first use"""
+	from lmbda.store.api_client import _get_alpaca_client
+	return _get_alpaca_client(paper_trading)
+
+
+def store(timeframe: str = "Day", data_dir: str = None, backend: str = "pandas"):
+	"""Get an opened bars datastore from the pool, opening it on first use. The data directory defaults to the
+	TRAITOR_DATA_DIR environment variable. For the S3 backend it is instead [BUCKET]/[PREFIX], defaulting to the
+	TRAITOR_DATA_BUCKET environment variable."""
+	if data_dir is None and backend == "s3":
+		data_dir = os.environ["TRAITOR_DATA_BUCKET"]
+	data_dir = data_dir or os.environ.get("TRAITOR_DATA_DIR", DEFAULT_DATA_DIR)
+	key = (backend, timeframe, data_dir)
+	with _lock:
+		if key not in _stores:
+			_stores[key] = _open_store(backend, timeframe, data_dir)
+		return _stores[key]
+
+
+def metadata(dataset: str = "Day", table_name: str = None):
+	"""Get a symbol metadata table from the pool, so its client and connections are reused across invocations. The
+	table name defaults to the TRAITOR_METADATA_TABLE environment variable."""
+	table_name = table_name or os.environ["TRAITOR_METADATA_TABLE"]
+	with _lock:
+		if (table_name, dataset) not in _tables:
+			from lmbda.store.metadata import SymbolMetadataTable
+			_tables[(table_name, dataset)] = SymbolMetadataTable(table_name, dataset)
+		return _tables[(table_name, dataset)]
+
+
+def _open_store(backend: str, timeframe: str, data_dir: str):
+	from alpaca_trade_api.rest import TimeFrame
+	if backend == "pandas":
+		from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+		return PandasBarsDataStore(getattr(TimeFrame, timeframe), data_dir)
+	elif backend == "parquet":
+		from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+		return ParquetBarsDataStore(getattr(TimeFrame, timeframe), data_dir)
+	elif backend == "s3":
+		from lmbda.store.S3BarsDataStore import S3BarsDataStore
+		bucket, _, prefix = data_dir.partition("/")
+		return S3BarsDataStore(getattr(TimeFrame, timeframe), bucket, prefix)
+	raise ValueError(f"Unknown datastore backend {backend}")
@@ -0,0 +1,186 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import datetime
+import json
+import logging
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from contextlib import contextmanager
+from logging import warning
+from typing import Callable, Dict, List
+
+import pandas as pd
+import pytz
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.labellers.constant_fraction_discrimination import cfd_events
+from lmbda.store import BarsDataStore
+from lmbda.store.CachedBarsDataStore import CachedBarsDataStore
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.fake_client import FakeBars, synthetic_bars
+
+STORES: Dict[str, Callable[[TimeFrame, str], BarsDataStore]] = {
+	"pandas": lambda timeframe, data_dir: PandasBarsDataStore(timeframe, data_dir),
+	"parquet": lambda timeframe, data_dir: ParquetBarsDataStore(timeframe, data_dir),
+	"cached-pandas": lambda timeframe, data_dir: CachedBarsDataStore(PandasBarsDataStore(timeframe, data_dir)),
+	"cached-parquet": lambda timeframe, data_dir: CachedBarsDataStore(ParquetBarsDataStore(timeframe, data_dir))
+}
+
+# Tracing allocations slows down Python-heavy code far more than native code, so it can be turned off for timing
+TRACE_MEMORY = True
+
+
+class ReplayClient:
+	"""Serves pre-generated synthetic bars in place of the Alpaca REST client, so that timings only measure the store"""
+
+	def __init__(self, bars: Dict[str, pd.DataFrame]):
+		self.bars = bars
+
+	def get_bars(self, symbol, timeframe, start, end, **kwargs) -> FakeBars:
+		start = pd.Timestamp(start, tz=pytz.utc)
+		end = pd.Timestamp(end, tz=pytz.utc) + pd.Timedelta(days=1)
+		if isinstance(symbol, str):
+			df = self.bars[symbol]
+			return FakeBars(df[(df.index >= start) & (df.index < end)])
+		return FakeBars(pd.concat([self.get_bars(s, timeframe, str(start.date()), str(end.date())).df.assign(symbol=s)
+		                           for s in symbol]))
+
+
+@contextmanager
+def measure(results: Dict[str, dict], key: str, repeat: int = 1):
+	"""Record the wall time (per repetition) and peak traced memory of the enclosed block"""
+	if TRACE_MEMORY:
+		tracemalloc.start()
+	start = time.perf_counter()
+	peak = 0
+	try:
+		yield
+		elapsed = (time.perf_counter() - start) / repeat
+		if TRACE_MEMORY:
+			_, peak = tracemalloc.get_traced_memory()
+	finally:
+		# Tracing left running after a failed benchmark would slow down and skew every later measurement
+		if TRACE_MEMORY:
+			tracemalloc.stop()
+	results[key] = {"seconds": elapsed, "peak_bytes": peak}
+	print(f"{key:<60} {elapsed * 1000:10.2f}ms {peak / 1e6:10.2f}MB peak")
+
+
+def benchmark(store_name: str, timeframe: TimeFrame, n_symbols: int, years: int, repeat: int) -> Dict[str, dict]:
+	"""Time each store operation and the labeller against a freshly generated synthetic dataset"""
+	prefix = f"{store_name}/{timeframe.value}/{n_symbols}x{years}y"
+	results: Dict[str, dict] = {}
+	today = datetime.date.today()
+	symbols = [f"SYM{i:04d}" for i in range(n_symbols)]
+	history_end = today - datetime.timedelta(days=8)
+	history = {symbol: synthetic_bars(symbol, timeframe, str(today - datetime.timedelta(days=365 * years)),
+	                                  str(history_end))
+	           for symbol in symbols}
+	latest = {symbol: synthetic_bars(symbol, timeframe, str(history_end), str(today)) for symbol in symbols}
+
+	with tempfile.TemporaryDirectory() as data_dir:
+		store = STORES[store_name](timeframe, data_dir)
+		client = ReplayClient(history)
+		with measure(results, f"{prefix}/add"):
+			for symbol in symbols:
+				store.add(symbol, client=client)
+
+		week = (history_end - datetime.timedelta(days=7), history_end)
+		with measure(results, f"{prefix}/bars", repeat):
+			for _ in range(repeat):
+				for symbol in symbols:
+					store.bars(symbol)
+		with measure(results, f"{prefix}/bars_week_close", repeat):
+			for _ in range(repeat):
+				for symbol in symbols:
+					store.bars(symbol, *week, columns=["close"])
+		with measure(results, f"{prefix}/last", repeat):
+			for _ in range(repeat):
+				for symbol in symbols:
+					store.last(symbol)
+		with measure(results, f"{prefix}/get_out_of_date_symbols", repeat):
+			for _ in range(repeat):
+				store.get_out_of_date_symbols()
+		with measure(results, f"{prefix}/cfd_events", repeat):
+			for _ in range(repeat):
+				for symbol in symbols:
+					cfd_events(store.bars(symbol, columns=["close"]), datetime.timedelta(days=3), back_history=30,
+					           pct_change_threshold=1.0)
+		with measure(results, f"{prefix}/update"):
+			for symbol in symbols:
+				store.update(symbol, latest[symbol])
+		with measure(results, f"{prefix}/flush_updates"):
+			store.flush_updates(set(symbols), client=ReplayClient(latest))
+	return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+	"""Compare results against a baseline, returning the keys which regressed by more than the tolerance"""
+	regressions = []
+	for key, result in sorted(results.items()):
+		if key not in baseline:
+			continue
+		ratio = result["seconds"] / max(baseline[key]["seconds"], 1e-9)
+		memory_ratio = result["peak_bytes"] / max(baseline[key]["peak_bytes"], 1) if result["peak_bytes"] > 0 else 1.0
+		print(f"{key:<60} {ratio:6.2f}x time {memory_ratio:6.2f}x memory")
+		if ratio > 1 + tolerance or memory_ratio > 1 + tolerance:
+			regressions.append(key)
+	return regressions
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Benchmarks datastore operations and labelling against synthetic bar datasets")
+	parser.add_argument("-s", "--stores", type=str, nargs="+", default=["pandas", "parquet"], choices=STORES.keys(),
+	                    help="Datastore implementations to benchmark")
+	parser.add_argument("-t", "--timeframes", type=str, nargs="+", default=["Day", "Minute"],
+	                    choices=["Minute", "Hour", "Day"], help="Bar timeframes to generate")
+	parser.add_argument("-n", "--symbols", type=int, nargs="+", default=[10, 100], help="Dataset sizes in symbols")
+	parser.add_argument("-y", "--years", type=int, nargs="+", default=[1, 5], help="Dataset sizes in years")
+	parser.add_argument("-r", "--repeat", type=int, default=3, help="Repetitions of each read benchmark")
+	parser.add_argument("-o", "--output", type=str, default=None, help="File to write results to")
+	parser.add_argument("-b", "--baseline", type=str, default=None, help="Results file to compare against")
+	parser.add_argument("--no-memory", action="store_true", help="Skip peak memory tracing for more accurate timings")
+	parser.add_argument("--tolerance", type=float, default=0.2,
+	                    help="Fractional slowdown or memory growth over the baseline considered a regression")
+	args = parser.parse_args()
+	# Stores log every call at INFO, which would drown out the results
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+	warnings.simplefilter("ignore")
+	TRACE_MEMORY = not args.no_memory
+
+	results: Dict[str, dict] = {}
+	for store_name in args.stores:
+		for timeframe in args.timeframes:
+			for n_symbols in args.symbols:
+				for years in args.years:
+					results.update(benchmark(store_name, getattr(TimeFrame, timeframe), n_symbols, years, args.repeat))
+
+	if args.output is not None:
+		with open(args.output, "w") as file:
+			json.dump(results, file, indent=2, sort_keys=True)
+	if args.baseline is not None:
+		with open(args.baseline, "r") as file:
+			regressions = compare(results, json.load(file), args.tolerance)
+		if len(regressions) > 0:
+			warning(f"{len(regressions)} benchmarks regressed: {', '.join(regressions)}")
+			sys.exit(1)
@@ -50,20 +50,28 @@ import argparse
 import csv
 import logging
 from logging import info, warning
+from pathlib import Path
 
 from alpaca_trade_api.rest import TimeFrame
 
 from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.bulk_download import BulkDownloader, DEFAULT_REQUESTS_PER_SECOND
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(
 		description="Downloads 5 year daily historical data for all symbols in a set of CSV files")
 	parser.add_argument("-d", "--datastore", type=str, default=".", help="Directory to store data")
+	parser.add_argument("-w", "--workers", type=int, default=8, help="Number of concurrent downloads")
+	parser.add_argument("-r", "--rate", type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+	                    help="Maximum API requests per second")
+	parser.add_argument("-c", "--checkpoint", type=str, default=None,
+	                    help="Checkpoint file used to resume an interrupted download (default: in the datastore)")
 	parser.add_argument("files", type=argparse.FileType("r"), nargs="+")
 	args = parser.parse_args()
 	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
 	store = PandasBarsDataStore(data_dir=args.datastore, timeframe=TimeFrame.Minute)
+	symbols = []
 	for file in args.files:
 		info(f"Processing {file.name}")
 		reader = csv.DictReader(file)
@@ -72,12 +80,9 @@ if __name__ == '__main__':
 			if "^" in symbol or "/" in symbol:
 				warning(f"Invalid symbol {symbol}, skipping!")
 				continue
-			if symbol in store:
-				info(f"{symbol} already in store, skipping!")
-				continue
-			info(f"Downloading historical data for {symbol}")
-			try:
-				store.add(symbol)
-			except:
-				warning(f"Failed to download data for {symbol}, skipping!")
-				continue
+			symbols.append(symbol)
+
+	checkpoint = Path(args.checkpoint) if args.checkpoint is not None else store.data_dir / "download_checkpoint.json"
+	downloader = BulkDownloader(store, workers=args.workers, requests_per_second=args.rate, checkpoint=checkpoint)
+	failures = downloader.run(symbols)
+	info(f"Finished downloading, {len(failures)} symbols failed")
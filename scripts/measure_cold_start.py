@@ -0,0 +1,95 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+MARKER = "COLD_START_RESULT "
+
+# Run inside a fresh interpreter, so that nothing is imported ahead of the handler module
+PROBE = f"""
+import importlib, json, sys, time
+module_name, function_name = sys.argv[1].rsplit(".", 1)
+event = json.loads(sys.argv[2])
+start = time.perf_counter()
+handler = getattr(importlib.import_module(module_name), function_name)
+imported = time.perf_counter()
+handler(event, None)
+invoked = time.perf_counter()
+handler(event, None)
+warm = time.perf_counter()
+print({MARKER!r} + json.dumps({{
+	"import_ms": 1000 * (imported - start),
+	"first_invoke_ms": 1000 * (invoked - imported),
+	"warm_invoke_ms": 1000 * (warm - invoked)
+}}))
+"""
+
+
+def measure(handler: str, event: dict) -> Dict[str, float]:
+	"""Time the import and first two invocations of a handler in a fresh interpreter"""
+	output = subprocess.run([sys.executable, "-c", PROBE, handler, json.dumps(event)], cwd=ROOT,
+	                        env=dict(os.environ, PYTHONPATH=str(ROOT)), capture_output=True, text=True, check=True)
+	line = next(line for line in output.stdout.splitlines() if line.startswith(MARKER))
+	return json.loads(line[len(MARKER):])
+
+
+def import_profile(handler: str, top: int) -> List[str]:
+	"""Get the slowest cumulative imports of a handler's module, as reported by -X importtime"""
+	module_name = handler.rsplit(".", 1)[0]
+	output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"], cwd=ROOT,
+	                        env=dict(os.environ, PYTHONPATH=str(ROOT)), capture_output=True, text=True, check=True)
+	imports = []
+	for line in output.stderr.splitlines():
+		parts = line.split("|")
+		if len(parts) == 3 and parts[1].strip().isdigit():
+			imports.append((int(parts[1]), parts[2].strip()))
+	return [f"{cumulative / 1000:10.2f}ms  {name}" for cumulative, name in sorted(imports, reverse=True)[:top]]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Measures Lambda handler cold starts: import plus first invocation")
+	parser.add_argument("handlers", type=str, nargs="*", default=["lmbda.hello.handler"],
+	                    help="Dotted paths of handler functions")
+	parser.add_argument("-e", "--event", type=str, default='{"path": "/"}', help="JSON event passed to each handler")
+	parser.add_argument("-n", "--runs", type=int, default=5, help="Fresh interpreters to measure per handler")
+	parser.add_argument("-b", "--budget-ms", type=float, default=None,
+	                    help="Fail if a handler's median import plus first invocation exceeds this many milliseconds")
+	parser.add_argument("-p", "--import-profile", type=int, default=0, help="Show this many of the slowest imports")
+	args = parser.parse_args()
+
+	over_budget = []
+	for handler in args.handlers:
+		runs = [measure(handler, json.loads(args.event)) for _ in range(args.runs)]
+		medians = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+		cold = medians["import_ms"] + medians["first_invoke_ms"]
+		print(f"{handler}: cold start {cold:.2f}ms (import {medians['import_ms']:.2f}ms, "
+		      f"first invocation {medians['first_invoke_ms']:.2f}ms), warm invocation {medians['warm_invoke_ms']:.2f}ms")
+		if args.import_profile > 0:
+			print("\n".join(import_profile(handler, args.import_profile)))
+		if args.budget_ms is not None and cold > args.budget_ms:
+			over_budget.append(handler)
+
+	if len(over_budget) > 0:
+		print(f"Over the {args.budget_ms}ms cold start budget: {', '.join(over_budget)}", file=sys.stderr)
+		sys.exit(1)
@@ -0,0 +1,62 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import datetime
+import logging
+from logging import info, warning
+
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore, segment_key
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+
+
+def migrate(source: PandasBarsDataStore, destination: ParquetBarsDataStore, symbol: str) -> None:
+	"""Copy a symbol's bars into the parquet store one year at a time, so only a single year is ever held in memory.
+	Years are read through the source store so that delta segments are merged over their year files, as any other
+	reader would see them."""
+	for year in sorted({segment_key(name)[0] for name in source.partitions(symbol)}):
+		try:
+			df = source.bars(symbol, datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+			destination._save_in_month_chunks(symbol, df)
+		except Exception as e:
+			warning(f"Failed to migrate {symbol} for {year}: {e}")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Migrates a pickle-backed bars datastore into a partitioned parquet datastore")
+	parser.add_argument("source", type=str, help="Directory of the existing pickle datastore")
+	parser.add_argument("destination", type=str, help="Directory to store parquet data")
+	parser.add_argument("-t", "--timeframe", type=str, default="Minute", choices=["Minute", "Hour", "Day"],
+	                    help="Timeframe of the stored bars")
+	parser.add_argument("-f", "--force", action="store_true", help="Re-migrate symbols already in the destination")
+	args = parser.parse_args()
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+	timeframe = getattr(TimeFrame, args.timeframe)
+	source = PandasBarsDataStore(data_dir=args.source, timeframe=timeframe)
+	destination = ParquetBarsDataStore(data_dir=args.destination, timeframe=timeframe)
+	symbols = sorted(source.symbols())
+	for i, symbol in enumerate(symbols):
+		if symbol in destination:
+			if not args.force:
+				info(f"{symbol} already migrated, skipping!")
+				continue
+			destination.remove(symbol)
+		info(f"Migrating {symbol} ({100 * i / len(symbols):.2f}% complete)")
+		migrate(source, destination, symbol)
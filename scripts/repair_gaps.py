@@ -0,0 +1,62 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import argparse
+import datetime
+import logging
+from logging import info
+from pathlib import Path
+
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.bulk_download import DEFAULT_REQUESTS_PER_SECOND
+from lmbda.store.gaps import GapIndex, TradingCalendar, backfill_gaps, scan_gaps
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Finds holes in stored history against the exchange calendar and backfills just those ranges")
+	parser.add_argument("-d", "--datastore", type=str, default=".", help="Directory of stored data")
+	parser.add_argument("-p", "--parquet", action="store_true", help="Datastore is parquet rather than pickle backed")
+	parser.add_argument("-t", "--timeframe", type=str, default="Minute", choices=["Minute", "Hour", "Day"],
+	                    help="Timeframe of the stored bars")
+	parser.add_argument("-g", "--min-gap", type=int, default=1,
+	                    help="Fewest consecutive missing bars to treat as a gap")
+	parser.add_argument("-i", "--index", type=str, default=None,
+	                    help="Gap index file (default: gaps.json in the datastore)")
+	parser.add_argument("-s", "--scan-only", action="store_true", help="Record gaps without backfilling them")
+	parser.add_argument("-y", "--years", type=int, default=6, help="Years of trading calendar to check against")
+	parser.add_argument("-w", "--workers", type=int, default=8, help="Number of concurrent scans and downloads")
+	parser.add_argument("-r", "--rate", type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+	                    help="Maximum API requests per second")
+	parser.add_argument("symbols", type=str, nargs="*", help="Symbols to check (default: every stored symbol)")
+	args = parser.parse_args()
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+	timeframe = getattr(TimeFrame, args.timeframe)
+	store = ParquetBarsDataStore(timeframe, args.datastore) if args.parquet else PandasBarsDataStore(timeframe,
+	                                                                                                 args.datastore)
+	symbols = args.symbols or sorted(store.symbols())
+	calendar = TradingCalendar.from_alpaca(datetime.date.today() - datetime.timedelta(days=365 * args.years),
+	                                       datetime.date.today())
+	index = GapIndex(Path(args.index) if args.index is not None else store.data_dir / "gaps.json")
+
+	found = scan_gaps(store, calendar, index, symbols, min_gap=args.min_gap, workers=args.workers)
+	for symbol, gaps in sorted(found.items()):
+		info(f"{symbol}: {len(gaps)} gaps, first from {gaps[0][0]} to {gaps[0][1]}")
+	if not args.scan_only:
+		failures = backfill_gaps(store, index, workers=args.workers, requests_per_second=args.rate)
+		info(f"Finished backfilling, {len(failures)} symbols failed")
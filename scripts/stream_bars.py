@@ -0,0 +1,49 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import argparse
+import asyncio
+import logging
+import signal
+
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.async_client import AsyncDataClient, BarStream
+
+
+async def stream(args: argparse.Namespace) -> None:
+	store = ParquetBarsDataStore(TimeFrame.Minute, args.datastore) if args.parquet else \
+		PandasBarsDataStore(TimeFrame.Minute, args.datastore)
+	async with AsyncDataClient(feed=args.feed) as client:
+		bar_stream = BarStream(store, args.symbols or store.symbols(), client, flush_interval=args.interval)
+		loop = asyncio.get_running_loop()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, lambda: asyncio.ensure_future(bar_stream.stop()))
+		await bar_stream.run()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Streams live minute bars into a datastore, writing each symbol's new bars in micro-batches")
+	parser.add_argument("-d", "--datastore", type=str, default=".", help="Directory of stored minute data")
+	parser.add_argument("-p", "--parquet", action="store_true", help="Datastore is parquet rather than pickle backed")
+	parser.add_argument("-f", "--feed", type=str, default="iex", choices=["iex", "sip"], help="Data feed to stream")
+	parser.add_argument("-i", "--interval", type=float, default=5.0, help="Seconds between writes to the datastore")
+	parser.add_argument("symbols", type=str, nargs="*", help="Symbols to stream (default: every stored symbol)")
+	args = parser.parse_args()
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+	asyncio.run(stream(args))
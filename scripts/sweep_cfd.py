@@ -0,0 +1,66 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import csv
+import datetime
+import logging
+import sys
+
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.backtest.engine import sweep
+from lmbda.backtest.strategies import CfdSignalStrategy
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description="Sweeps the CFD signal strategy over a grid of edge widths and thresholds across stored symbols")
+	parser.add_argument("-d", "--datastore", type=str, default=".", help="Directory of stored data")
+	parser.add_argument("-p", "--parquet", action="store_true", help="Datastore is parquet rather than pickle backed")
+	parser.add_argument("-t", "--timeframe", type=str, default="Day", choices=["Minute", "Hour", "Day"],
+	                    help="Timeframe of the stored bars")
+	parser.add_argument("-e", "--edge-widths", type=float, nargs="+", default=[1, 3, 5],
+	                    help="Edge widths to sweep, in days")
+	parser.add_argument("-c", "--thresholds", type=float, nargs="+", default=[0.5, 1.0, 2.0],
+	                    help="Percent change thresholds to sweep")
+	parser.add_argument("-b", "--back-history", type=int, default=0, help="Bars of back-history for each edge")
+	parser.add_argument("-s", "--start", type=datetime.date.fromisoformat, default=None, help="First date to replay")
+	parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes")
+	parser.add_argument("--commission", type=float, default=0.0, help="Commission per share")
+	parser.add_argument("--slippage-bps", type=float, default=0.0, help="Slippage in basis points")
+	parser.add_argument("symbols", type=str, nargs="*", help="Symbols to trade (default: every stored symbol)")
+	args = parser.parse_args()
+	logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+	store_class = ParquetBarsDataStore if args.parquet else PandasBarsDataStore
+	store = store_class(getattr(TimeFrame, args.timeframe), args.datastore)
+	grid = {
+		"edge_width": [datetime.timedelta(days=days) for days in args.edge_widths],
+		"pct_change_threshold": args.thresholds,
+		"back_history": [args.back_history]
+	}
+	results = sweep(store, CfdSignalStrategy, grid, args.symbols or store.symbols(), start=args.start,
+	                workers=args.workers, commission=args.commission, slippage_bps=args.slippage_bps)
+
+	writer = csv.writer(sys.stdout)
+	writer.writerow(["edge_width_days", "pct_change_threshold", "symbols", "pnl", "return_pct", "trades",
+	                 "commissions", "worst_drawdown_pct"])
+	for params, totals in sorted(results, key=lambda result: -result[1]["return_pct"]):
+		writer.writerow([params["edge_width"].total_seconds() / 86400, params["pct_change_threshold"], totals["symbols"],
+		                 f"{totals['pnl']:.2f}", f"{totals['return_pct']:.4f}", totals["trades"],
+		                 f"{totals['commissions']:.2f}", f"{totals['worst_drawdown_pct']:.2f}"])
@@ -0,0 +1,44 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import contextlib
+import os
+
+import pytest
+
+try:
+	from moto import mock_aws
+
+	def _mock_services():
+		return mock_aws()
+except ImportError:
+	# moto before 5 mocks each service separately
+	from moto import mock_dynamodb2, mock_s3
+
+	def _mock_services():
+		stack = contextlib.ExitStack()
+		stack.enter_context(mock_s3())
+		stack.enter_context(mock_dynamodb2())
+		return stack
+
+
+@pytest.fixture
+def aws(monkeypatch):
+	"""Mock S3 and DynamoDB with moto, with dummy credentials so nothing can reach real AWS"""
+	for name, value in {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+	                    "AWS_SESSION_TOKEN": "testing", "AWS_DEFAULT_REGION": "us-east-1"}.items():
+		monkeypatch.setenv(name, value)
+	with _mock_services():
+		yield
@@ -0,0 +1,203 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import asyncio
+import math
+from typing import Callable
+
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.async_client import AsyncDataClient, BarStream
+from lmbda.store.fake_client import synthetic_bars
+from lmbda.store.fake_server import FakeAlpacaServer
+
+START = pd.Timestamp("2021-01-04", tz="UTC")
+END = pd.Timestamp("2021-01-06", tz="UTC")
+
+
+async def until(condition: Callable[[], bool], timeout: float = 10.0) -> None:
+	"""Wait for a condition to hold, polling the event loop"""
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + timeout
+	while not condition():
+		if loop.time() > deadline:
+			raise TimeoutError("Condition never held")
+		await asyncio.sleep(0.01)
+
+
+def with_server(scenario, page_size: int = 100):
+	"""Run a scenario coroutine against a fake server and a client pointed at it"""
+
+	async def run():
+		server = FakeAlpacaServer(page_size=page_size)
+		url = await server.start()
+		client = AsyncDataClient(key_id="key", secret_key="secret", data_url=url, stream_url=url,
+		                         requests_per_second=1000, backoff=0.01)
+		try:
+			async with client:
+				return await scenario(server, client)
+		finally:
+			await server.stop()
+
+	return asyncio.run(run())
+
+
+def expected_bars(symbol: str) -> pd.DataFrame:
+	df = synthetic_bars(symbol, TimeFrame.Minute, str(START.date()), str(END.date()))
+	return df[(df.index >= START) & (df.index <= END)]
+
+
+def test_get_bars_follows_pagination():
+	async def scenario(server, client):
+		return await client.get_bars("AAPL", TimeFrame.Minute, START, END), server.requests
+
+	df, requests = with_server(scenario)
+	expected = expected_bars("AAPL")
+	assert requests == math.ceil(len(expected) / 100)
+	pd.testing.assert_index_equal(df.index, expected.index)
+	assert (df["close"].to_numpy() == expected["close"].to_numpy()).all()
+
+
+def test_gather_bars_splits_symbols():
+	async def scenario(server, client):
+		return await client.gather_bars(["msft", "AAPL", "TSLA"], TimeFrame.Minute, START, END, batch_size=2)
+
+	bars = with_server(scenario)
+	assert set(bars) == {"AAPL", "MSFT", "TSLA"}
+	for symbol, df in bars.items():
+		pd.testing.assert_index_equal(df.index, expected_bars(symbol).index)
+
+
+def test_retries_rate_limiting_and_server_errors():
+	async def scenario(server, client):
+		server.fail_next = [429, 503, 500]
+		return await client.get_bars("AAPL", TimeFrame.Minute, START, END), server.requests
+
+	df, requests = with_server(scenario)
+	assert len(df) == len(expected_bars("AAPL"))
+	assert requests == math.ceil(len(df) / 100) + 3
+
+
+def test_client_errors_are_not_retried():
+	async def scenario(server, client):
+		server.fail_next = [400]
+		with pytest.raises(ValueError):
+			await client.get_bars("AAPL", TimeFrame.Minute, START, END)
+		return server.requests
+
+	assert with_server(scenario) == 1
+
+
+def stream_scenario(store: PandasBarsDataStore, steps, **kwargs):
+	"""Run a bar stream into a store while the steps coroutine drives the fake server, then stop it"""
+
+	async def scenario(server, client):
+		stream = BarStream(store, ["AAPL"], client, max_backoff=0.05, **kwargs)
+		task = asyncio.create_task(stream.run())
+		await until(lambda: server.subscribed("AAPL") == 1)
+		await steps(server, stream)
+		await stream.stop()
+		await task
+		return stream
+
+	return with_server(scenario)
+
+
+@pytest.fixture
+def store(tmp_path) -> PandasBarsDataStore:
+	store = PandasBarsDataStore(TimeFrame.Minute, str(tmp_path))
+	store.put("AAPL", synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-05"))
+	return store
+
+
+def streamed_bars() -> pd.DataFrame:
+	return synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-06", "2021-01-06").iloc[:10]
+
+
+def test_stream_coalesces_bars_into_one_write(store):
+	bars = streamed_bars()
+
+	async def steps(server, stream):
+		for i in range(0, len(bars), 2):
+			await server.publish("AAPL", bars.iloc[i:i + 2])
+		await until(lambda: stream.bars_received == len(bars))
+
+	stream = stream_scenario(store, steps, flush_interval=3600)
+	assert stream.flushes == 1
+	assert len([name for name in store.partitions("AAPL") if "delta" in name]) == 1
+	assert store.last_timestamp("AAPL") == bars.index[-1]
+	stored = store.bars("AAPL").loc[bars.index, "close"]
+	assert (stored.to_numpy() == bars["close"].to_numpy()).all()
+
+
+def test_stream_flushes_early_when_many_bars_are_pending(store):
+	bars = streamed_bars()
+
+	async def steps(server, stream):
+		await server.publish("AAPL", bars)
+		await until(lambda: stream.flushes == 1)
+
+	stream = stream_scenario(store, steps, flush_interval=3600, max_pending=5)
+	assert store.last_timestamp("AAPL") == bars.index[-1]
+	assert stream.bars_received == len(bars)
+
+
+def test_stream_reconnects_after_disconnect(store):
+	bars = streamed_bars()
+
+	async def steps(server, stream):
+		await server.publish("AAPL", bars.iloc[:5])
+		await until(lambda: stream.bars_received == 5)
+		await server.disconnect()
+		await until(lambda: server.subscribed("AAPL") == 0)
+		await until(lambda: server.subscribed("AAPL") == 1)
+		await server.publish("AAPL", bars.iloc[5:])
+		await until(lambda: stream.bars_received == len(bars))
+
+	stream_scenario(store, steps, flush_interval=3600)
+	assert store.last_timestamp("AAPL") == bars.index[-1]
+	assert len(store.bars("AAPL").loc[bars.index[0]:]) == len(bars)
+
+
+def test_updated_bars_override_originals(store):
+	bars = streamed_bars()
+	corrected = bars.iloc[[3]].copy()
+	corrected["close"] += 1.0
+
+	async def steps(server, stream):
+		await server.publish("AAPL", bars)
+		await server.publish("AAPL", corrected, kind="u")
+		await until(lambda: stream.bars_received == len(bars) + 1)
+
+	stream_scenario(store, steps, flush_interval=3600)
+	stored = store.bars("AAPL")
+	assert stored.loc[corrected.index[0], "close"] == corrected["close"].iloc[0]
+	assert stored.loc[bars.index[4], "close"] == bars["close"].iloc[4]
+
+
+def test_stream_puts_new_symbols(tmp_path):
+	store = PandasBarsDataStore(TimeFrame.Minute, str(tmp_path))
+	bars = streamed_bars()
+
+	async def steps(server, stream):
+		await server.publish("AAPL", bars)
+		await until(lambda: stream.bars_received == len(bars))
+
+	stream_scenario(store, steps, flush_interval=3600)
+	assert "AAPL" in store
+	assert len(store.bars("AAPL")) == len(bars)
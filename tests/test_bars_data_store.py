@@ -0,0 +1,80 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.fake_client import FakeRESTClient, synthetic_bars
+
+
+@pytest.fixture(params=[PandasBarsDataStore, ParquetBarsDataStore])
+def store_type(request):
+	return request.param
+
+
+def test_add_daily_history_in_one_request(store_type, tmp_path):
+	store = store_type(TimeFrame.Day, str(tmp_path))
+	client = FakeRESTClient()
+	last = store.add("AAPL", client=client)
+	assert client.requests == 1
+
+	end = datetime.date.today() - datetime.timedelta(days=1)
+	expected = synthetic_bars("AAPL", TimeFrame.Day, str(end - datetime.timedelta(days=365 * 5)), str(end))
+	df = store.bars("AAPL")
+	pd.testing.assert_index_equal(df.index, expected.index)
+	# Only the last bar is returned, the rest is read back from the store
+	pd.testing.assert_frame_equal(last, df.tail(1), check_freq=False)
+
+
+def test_add_minute_history_in_windows(store_type, tmp_path):
+	store = store_type(TimeFrame.Minute, str(tmp_path))
+	client = FakeRESTClient()
+	store._fetch_all_symbol_history("AAPL", client=client, delta=datetime.timedelta(days=89))
+	assert client.requests == 3
+
+
+def test_failed_add_leaves_nothing_behind(store_type, tmp_path):
+	store = store_type(TimeFrame.Minute, str(tmp_path))
+	with pytest.raises(ConnectionError):
+		store.add("AAPL", client=FakeRESTClient(fail_after=3))
+	assert "AAPL" not in store
+	assert store.symbols() == set()
+
+	# Nothing left over gets in the way of adding the symbol again
+	store._stream_symbol_history = lambda symbol, client: iter([synthetic_bars(symbol, TimeFrame.Minute,
+	                                                                           "2021-01-04", "2021-01-08")])
+	store.add("AAPL", client=FakeRESTClient())
+	assert len(store.bars("AAPL")) == len(synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-08"))
+
+
+def test_update_and_compact(store_type, tmp_path):
+	store = store_type(TimeFrame.Minute, str(tmp_path))
+	store.put("AAPL", synthetic_bars("AAPL", TimeFrame.Minute, "2020-12-28", "2021-01-08"))
+	update = synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-06", "2021-01-12")
+	update["close"] += 1.0
+	store.update("AAPL", update)
+	store.compact("AAPL")
+
+	expected = synthetic_bars("AAPL", TimeFrame.Minute, "2020-12-28", "2021-01-12")
+	expected.loc[update.index, "close"] += 1.0
+	df = store.bars("AAPL")
+	pd.testing.assert_index_equal(df.index, expected.index)
+	assert (df["close"].to_numpy() == expected["close"].to_numpy()).all()
+	assert store.rows("AAPL") == len(expected)
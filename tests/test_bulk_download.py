@@ -0,0 +1,113 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import json
+import time
+
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.bulk_download import BulkDownloader, TokenBucket
+from lmbda.store.fake_client import FakeRESTClient, synthetic_bars
+
+SYMBOLS = ["AAPL", "MSFT", "TSLA"]
+
+
+def downloader(store, client: FakeRESTClient, **kwargs) -> BulkDownloader:
+	downloader = BulkDownloader(store, client=client, workers=3, requests_per_second=1000, **kwargs)
+	# Retry quickly, the fake client's failures don't need time to clear
+	downloader.client.backoff = 0.001
+	return downloader
+
+
+@pytest.fixture
+def store(tmp_path) -> PandasBarsDataStore:
+	return PandasBarsDataStore(TimeFrame.Day, str(tmp_path / "data"))
+
+
+def requests_per_symbol(tmp_path) -> int:
+	client = FakeRESTClient()
+	downloader(PandasBarsDataStore(TimeFrame.Day, str(tmp_path / "baseline")), client).run(["SPY"])
+	return client.requests
+
+
+def test_downloads_every_symbol(store):
+	assert downloader(store, FakeRESTClient()).run(SYMBOLS) == {}
+	assert store.symbols() == set(SYMBOLS)
+
+
+def test_skips_symbols_already_in_store(store):
+	client = FakeRESTClient()
+	downloader(store, client).run(["AAPL"])
+	requests = client.requests
+	downloader(store, client).run(["aapl"])
+	assert client.requests == requests
+
+
+def test_retries_transient_failures(store, tmp_path):
+	client = FakeRESTClient(failures_per_symbol=2)
+	assert downloader(store, client, retries=2).run(SYMBOLS) == {}
+	assert store.symbols() == set(SYMBOLS)
+	assert client.requests == len(SYMBOLS) * (requests_per_symbol(tmp_path) + 2)
+
+
+def test_gives_up_after_retries(store):
+	failures = downloader(store, FakeRESTClient(failures_per_symbol=3), retries=2).run(SYMBOLS)
+	assert set(failures) == set(SYMBOLS)
+	assert all(isinstance(e, ConnectionError) for e in failures.values())
+	assert len(store.symbols()) == 0
+
+
+def test_resumes_from_checkpoint(store, tmp_path):
+	checkpoint = tmp_path / "checkpoint.json"
+	failures = downloader(store, FakeRESTClient(fail_symbols={"TSLA"}), retries=1, checkpoint=checkpoint).run(SYMBOLS)
+	assert set(failures) == {"TSLA"}
+	with open(checkpoint) as file:
+		saved = json.load(file)
+	assert saved["completed"] == ["AAPL", "MSFT"]
+	assert set(saved["failed"]) == {"TSLA"}
+
+	# A fresh store resuming from the checkpoint only downloads what didn't complete
+	resumed = PandasBarsDataStore(TimeFrame.Day, str(tmp_path / "resumed"))
+	client = FakeRESTClient()
+	assert downloader(resumed, client, checkpoint=checkpoint).run(SYMBOLS) == {}
+	assert resumed.symbols() == {"TSLA"}
+	assert client.requests == requests_per_symbol(tmp_path)
+	with open(checkpoint) as file:
+		saved = json.load(file)
+	assert saved["completed"] == SYMBOLS and saved["failed"] == {}
+
+
+def test_redownloads_symbols_cut_short(store, tmp_path):
+	checkpoint = tmp_path / "checkpoint.json"
+	downloader(store, FakeRESTClient(), checkpoint=checkpoint).run(["MSFT"])
+	# A run killed partway through AAPL leaves some of its history stored, but never marks it complete
+	store.put("AAPL", synthetic_bars("AAPL", TimeFrame.Day, "2020-01-01", "2020-06-30"))
+
+	client = FakeRESTClient()
+	assert downloader(store, client, checkpoint=checkpoint).run(["AAPL", "MSFT"]) == {}
+	assert client.requests == requests_per_symbol(tmp_path)
+	assert store.bars("AAPL").index.equals(store.bars("MSFT").index)
+	with open(checkpoint) as file:
+		assert json.load(file)["completed"] == ["AAPL", "MSFT"]
+
+
+def test_token_bucket_limits_rate():
+	bucket = TokenBucket(rate=100, capacity=1)
+	start = time.monotonic()
+	for _ in range(11):
+		bucket.acquire()
+	assert time.monotonic() - start >= 0.09
@@ -0,0 +1,138 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+from datetime import timedelta
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+from scipy.stats import zscore
+
+from lmbda.labellers.constant_fraction_discrimination import cfd_events, perform_cfd
+from lmbda.labellers.streaming import StreamingCfdLabeller
+from lmbda.store.fake_client import synthetic_bars
+
+
+def reference_cfd(df: pd.DataFrame, edge_width: timedelta, back_history: int = 0, pct_change_threshold=0.05,
+                  outlier_zscore_threshold=3.0) -> List[Tuple[float, List[float]]]:
+	"""The original row-by-row implementation, with crossings located in the bars by timestamp rather than by their
+	position in the CFD series, which the vectorized labeller must match exactly"""
+	cfd = df["close"] \
+		.to_frame() \
+		.rename({"close": "delayed"}, axis=1) \
+		.shift(freq=edge_width) \
+		.join(-df["close"]
+		      .to_frame()
+		      .rename({"close": "inverse"}, axis=1), on="timestamp", how="inner") \
+		.dropna(axis=0)
+
+	cfd_results = cfd["delayed"] + cfd["inverse"]
+	crossings = np.asarray(np.where(np.diff(np.sign(cfd_results))))[0]
+	crossings = df.index.get_indexer(cfd_results.index[crossings])
+
+	df_deltas = pd.DataFrame({
+		"idx": crossings,
+		"start": df.iloc[crossings]["close"].array,
+		"end": df.iloc[crossings + 1]["close"].array
+	}, index=df.iloc[crossings].index).dropna().iloc[1:]
+
+	df_deltas["diff"] = df_deltas.start - df_deltas.end
+	df_deltas["pct_diff"] = 100.0 * df_deltas["diff"] / df_deltas.start
+	df_deltas = df_deltas[(np.abs(zscore(df_deltas.pct_diff)) < outlier_zscore_threshold)
+	                      & (df_deltas.pct_diff.abs() >= pct_change_threshold)]
+
+	trailing_histories: List[Tuple[float, List[float]]] = []
+	for index, row in df_deltas.iterrows():
+		if row.idx - 1 - back_history < 0 or row.idx + 1 > len(df):
+			continue
+		slice_start = int(row.idx - 1 - back_history)
+		slice_end = int(row.idx) + 1
+		trailing_histories.append((row.pct_diff, list(df.iloc[slice_start:slice_end]["close"].array)))
+	return trailing_histories
+
+
+def gappy_bars() -> pd.DataFrame:
+	"""Minute bars with some bars missing and some closes missing, so many bars lack a partner"""
+	rng = np.random.default_rng(7)
+	df = synthetic_bars("TSLA", TimeFrame.Minute, "2021-02-01", "2021-02-26")[["close"]]
+	df = df[rng.random(len(df)) > 0.05].copy()
+	df.loc[rng.random(len(df)) < 0.01, "close"] = np.nan
+	return df
+
+
+FIXTURES = {
+	"day": (synthetic_bars("AAPL", TimeFrame.Day, "2016-01-01", "2020-12-31")[["close"]], timedelta(days=5)),
+	"minute": (synthetic_bars("MSFT", TimeFrame.Minute, "2021-01-04", "2021-01-29")[["close"]], timedelta(minutes=15))
+}
+# The reference keeps windows with missing closes, which cfd_events drops, so gaps are only replayed against the latter
+STREAMING_FIXTURES = {**FIXTURES, "gappy": (gappy_bars(), timedelta(minutes=15))}
+
+
+@pytest.mark.parametrize("back_history", [0, 5, 30])
+@pytest.mark.parametrize("fixture", list(FIXTURES))
+def test_perform_cfd_matches_reference(fixture, back_history):
+	df, edge_width = FIXTURES[fixture]
+	expected = reference_cfd(df, edge_width, back_history)
+	assert len(expected) > 0
+	assert perform_cfd(df, edge_width, back_history) == [(pct_diff, list(map(float, history)))
+	                                                      for pct_diff, history in expected]
+
+
+@pytest.mark.parametrize("fixture", list(FIXTURES))
+def test_cfd_events_timestamps_and_shape(fixture):
+	df, edge_width = FIXTURES[fixture]
+	timestamps, pct_diffs, windows = cfd_events(df, edge_width, back_history=5)
+	assert len(timestamps) == len(pct_diffs) == len(windows)
+	assert windows.shape[1] == 7
+	assert windows.flags["C_CONTIGUOUS"]
+	# Each window ends on the close at the edge itself
+	np.testing.assert_array_equal(windows[:, -1], df["close"].reindex(pd.DatetimeIndex(timestamps, tz="UTC")).to_numpy())
+
+
+def test_cfd_events_on_short_series():
+	df, edge_width = FIXTURES["day"]
+	timestamps, pct_diffs, windows = cfd_events(df.head(3), edge_width, back_history=30)
+	assert len(timestamps) == 0 and windows.shape == (0, 32)
+
+
+@pytest.mark.parametrize("back_history", [0, 5, 30])
+@pytest.mark.parametrize("fixture", list(FIXTURES))
+def test_streaming_matches_cfd_events(fixture, back_history):
+	df, edge_width = STREAMING_FIXTURES[fixture]
+	expected = cfd_events(df, edge_width, back_history, outlier_zscore_threshold=np.inf)
+	assert len(expected[0]) > 0
+
+	labeller = StreamingCfdLabeller(edge_width, back_history, outlier_zscore_threshold=None)
+	bounds = np.linspace(0, len(df), 8).astype(int)
+	events = [labeller.update("AAPL", df.iloc[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+	for i, array in enumerate(expected):
+		np.testing.assert_array_equal(np.concatenate([chunk[i] for chunk in events]), array)
+
+
+@pytest.mark.parametrize("fixture", list(STREAMING_FIXTURES))
+def test_streaming_state_is_bounded(fixture):
+	df, edge_width = STREAMING_FIXTURES[fixture]
+	labeller = StreamingCfdLabeller(edge_width, back_history=30, outlier_zscore_threshold=None)
+	# Bars within one edge_width of each other, which may all lack a partner
+	per_edge = int(df.index.to_series().rolling(edge_width).count().max())
+	largest = 0
+	for timestamp, close in df["close"].items():
+		labeller.push("AAPL", timestamp, close)
+		state = labeller._state("AAPL")
+		largest = max(largest, len(state.closes), len(state.partners))
+	assert largest <= 30 + 2 + per_edge
+
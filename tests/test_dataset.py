@@ -0,0 +1,96 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import pickle
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lmbda.labellers.dataset import CfdWindowSequence
+from lmbda.labellers.pipeline import LabelCache
+
+SYMBOLS = 12
+
+
+@pytest.fixture
+def cache(tmp_path) -> LabelCache:
+	"""Labels whose windows and targets all hold the window's unique id, so every window can be traced"""
+	cache = LabelCache(str(tmp_path), {"labeller": "cfd"})
+	ids = 0
+	for i in range(SYMBOLS):
+		n = 100 + 37 * i
+		targets = np.arange(ids, ids + n, dtype=np.float64)
+		cache.put(f"S{i:02d}", pd.Timestamp("2021-01-04", tz="UTC"),
+		          (np.zeros(n, dtype="datetime64[ns]"), targets, np.stack([targets] * 4, axis=1)))
+		ids += n
+	return cache
+
+
+def total(cache: LabelCache) -> int:
+	return sum(len(cache[symbol][1]) for symbol in cache.symbols())
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_every_window_once_per_epoch(cache, shuffle):
+	sequence = CfdWindowSequence(cache, batch_size=16, shuffle=shuffle, shuffle_buffer=64, prefetch=2, workers=3,
+	                             seed=1)
+	assert len(sequence) == -(-total(cache) // 16)
+	epochs = []
+	for _ in range(2):
+		batches = list(sequence)
+		assert all(features.dtype == np.float32 and (features[:, 0] == targets).all() for features, targets in batches)
+		targets = np.concatenate([targets for _, targets in batches])
+		np.testing.assert_array_equal(np.sort(targets), np.arange(total(cache)))
+		epochs.append(targets)
+	if shuffle:
+		assert not (epochs[0] == epochs[1]).all()
+	else:
+		np.testing.assert_array_equal(epochs[0], np.arange(total(cache)))
+
+
+def test_loads_stay_bounded(cache):
+	loaded = []
+	lock = threading.Lock()
+
+	class CountingSequence(CfdWindowSequence):
+		def _load(self, symbol):
+			with lock:
+				loaded.append(symbol)
+			return super()._load(symbol)
+
+	sequence = CountingSequence(cache, batch_size=16, shuffle_buffer=64, prefetch=1, workers=2, seed=1)
+	sequence[0]
+	time.sleep(0.2)
+	# The symbol being consumed and one in flight per worker
+	assert len(loaded) <= 3
+	sequence.close()
+
+
+def test_shards_split_symbols(cache):
+	shards = [CfdWindowSequence(cache, shard=(i, 3)) for i in range(3)]
+	assert sorted(symbol for shard in shards for symbol in shard.symbols) == sorted(cache.symbols())
+	assert sum(shard.count for shard in shards) == total(cache)
+
+
+def test_pickled_sequences_stream_afresh(cache):
+	sequence = CfdWindowSequence(cache, batch_size=16, shuffle_buffer=64, seed=1)
+	sequence[0]
+	copy = pickle.loads(pickle.dumps(sequence))
+	sequence.close()
+	targets = np.concatenate([targets for _, targets in copy])
+	np.testing.assert_array_equal(np.sort(targets), np.arange(total(cache)))
@@ -0,0 +1,54 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.fake_client import synthetic_bars, synthetic_calendar
+from lmbda.store.gaps import TradingCalendar, find_gaps
+
+
+@pytest.fixture
+def calendar() -> TradingCalendar:
+	return TradingCalendar.from_sessions(synthetic_calendar("2021-01-04", "2021-01-29"))
+
+
+def test_complete_history_has_no_gaps(calendar):
+	index = synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-29").index
+	assert find_gaps(index, calendar, TimeFrame.Minute) == []
+
+
+def test_finds_interior_gap(calendar):
+	index = synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-29").index
+	missing = (index >= pd.Timestamp("2021-01-12 15:00", tz="UTC")) & (index < pd.Timestamp("2021-01-12 16:00", tz="UTC"))
+	assert find_gaps(index[~missing], calendar, TimeFrame.Minute) == [
+		(pd.Timestamp("2021-01-12 15:00", tz="UTC"), pd.Timestamp("2021-01-12 15:59", tz="UTC"))]
+
+
+@pytest.mark.parametrize("timeframe, last", [(TimeFrame.Minute, "2021-01-29 20:59"), (TimeFrame.Day, "2021-01-29")])
+def test_finds_missing_tail(calendar, timeframe, last):
+	# History that stops early, as when updates stopped, is missing everything up to the last completed session
+	index = synthetic_bars("AAPL", timeframe, "2021-01-04", "2021-01-21").index
+	gaps = find_gaps(index, calendar, timeframe)
+	assert gaps == [(pd.Timestamp("2021-01-22 14:30" if timeframe == TimeFrame.Minute else "2021-01-22", tz="UTC"),
+	                 pd.Timestamp(last, tz="UTC"))]
+	# An explicit end still bounds the check
+	assert find_gaps(index, calendar, timeframe, end=index.max()) == []
+
+
+def test_sessions_in_progress_are_not_expected(calendar):
+	assert calendar.last_close(pd.Timestamp("2021-01-15 18:00", tz="UTC")) == pd.Timestamp("2021-01-14 21:00", tz="UTC")
+	assert calendar.last_close(pd.Timestamp("2021-01-01", tz="UTC")) is None
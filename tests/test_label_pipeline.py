@@ -0,0 +1,68 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+
+import numpy as np
+import pandas as pd
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.labellers.constant_fraction_discrimination import cfd_events
+from lmbda.labellers.pipeline import LabelCache, label_symbols
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.fake_client import synthetic_bars
+
+PARAMS = {"labeller": "cfd", "edge_width": datetime.timedelta(days=5), "back_history": 5,
+          "pct_change_threshold": 0.05, "outlier_zscore_threshold": 3.0}
+
+
+def events(n: int):
+	return (np.arange(n).astype("datetime64[ns]"), np.arange(n, dtype=np.float64), np.ones((n, 7)))
+
+
+def test_put_and_get(tmp_path):
+	cache = LabelCache(str(tmp_path), PARAMS)
+	last = pd.Timestamp("2021-01-04", tz="UTC")
+	cache.put("aapl", last, events(3))
+	assert cache.symbols() == {"AAPL"}
+	assert "AAPL" in cache and cache.is_fresh("AAPL", last)
+	timestamps, pct_diffs, windows = cache["AAPL"]
+	assert (pct_diffs == np.arange(3)).all() and windows.shape == (3, 7)
+
+
+def test_temporary_files_are_not_cached_symbols(tmp_path):
+	cache = LabelCache(str(tmp_path), PARAMS)
+	cache.put("AAPL", pd.Timestamp("2021-01-04", tz="UTC"), events(3))
+	# As left behind by an interrupted put
+	(cache.path / ".MSFT.npz.0123abcd.tmp").write_bytes(b"")
+	assert cache.symbols() == {"AAPL"}
+	assert list(cache.path.glob("*.npz")) == [cache.path / "AAPL.npz"]
+
+
+def test_label_symbols_caches_and_skips_fresh_symbols(tmp_path):
+	store = ParquetBarsDataStore(TimeFrame.Day, str(tmp_path / "data"))
+	for symbol in ["AAPL", "MSFT"]:
+		store.put(symbol, synthetic_bars(symbol, TimeFrame.Day, "2018-01-01", "2020-12-31"))
+	params = {key: value for key, value in PARAMS.items() if key != "labeller"}
+	cache = label_symbols(store, ["AAPL", "MSFT"], str(tmp_path / "labels"), workers=2, **params)
+	assert cache.symbols() == {"AAPL", "MSFT"}
+
+	expected = cfd_events(store.bars("AAPL", columns=["close"]), params["edge_width"], params["back_history"])
+	for array, expected_array in zip(cache["AAPL"], expected):
+		np.testing.assert_array_equal(array, expected_array)
+
+	modified = (cache.path / "AAPL.npz").stat().st_mtime_ns
+	label_symbols(store, ["AAPL"], str(tmp_path / "labels"), workers=2, **params)
+	assert (cache.path / "AAPL.npz").stat().st_mtime_ns == modified
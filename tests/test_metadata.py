@@ -0,0 +1,156 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+import pickle
+
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.MetadataBarsDataStore import MetadataBarsDataStore
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.fake_client import FakeRESTClient, synthetic_bars
+from lmbda.store.metadata import SymbolMetadataTable
+
+UTC = datetime.timezone.utc
+
+
+@pytest.fixture
+def table(aws) -> SymbolMetadataTable:
+	table = SymbolMetadataTable("symbol-metadata", "Minute")
+	table.create()
+	return table
+
+
+@pytest.fixture(params=[PandasBarsDataStore, ParquetBarsDataStore])
+def store(request, table, tmp_path) -> MetadataBarsDataStore:
+	return MetadataBarsDataStore(request.param(TimeFrame.Minute, str(tmp_path)), table)
+
+
+def last_bar(symbol: str, day: str) -> pd.DataFrame:
+	return synthetic_bars(symbol, TimeFrame.Minute, day, day).tail(1)
+
+
+def test_record_and_get(table):
+	bar = last_bar("AAPL", "2021-01-04")
+	table.record("aapl", bar, {"2021/01.parquet": 390, "2021/02.parquet": 10})
+	metadata = table.get("AAPL")
+	assert metadata.symbol == "AAPL" and metadata.dataset == "Minute"
+	assert metadata.last_timestamp == bar.index[0].to_pydatetime()
+	assert metadata.last_bar["close"] == bar["close"].iloc[0]
+	assert metadata.last_bar["volume"] == bar["volume"].iloc[0]
+	assert metadata.rows == 400
+	assert metadata.partitions == {"2021/01.parquet": 390, "2021/02.parquet": 10}
+	assert table.get("MSFT") is None
+
+
+def test_datasets_are_kept_apart(table):
+	table.record("AAPL", last_bar("AAPL", "2021-01-04"), {"all": 1})
+	other = SymbolMetadataTable(table.table_name, "Day", client=table.client)
+	assert other.get("AAPL") is None
+
+
+def test_batch_get_more_than_one_request(table):
+	bar = last_bar("AAPL", "2021-01-04")
+	symbols = [f"S{i:03d}" for i in range(250)]
+	for symbol in symbols:
+		table.record(symbol, bar, {"all": 1})
+	found = table.batch_get(symbols + ["MISSING"])
+	assert set(found) == set(symbols)
+	assert all(metadata.last_timestamp == bar.index[0].to_pydatetime() for metadata in found.values())
+
+
+def test_stale(table):
+	table.record("AAPL", last_bar("AAPL", "2021-01-04"), {"all": 1})
+	table.record("MSFT", last_bar("MSFT", "2021-01-08"), {"all": 1})
+	now = datetime.datetime(2021, 1, 9, tzinfo=UTC)
+	stale = table.stale(["AAPL", "MSFT", "TSLA"], datetime.timedelta(days=3), now=now)
+	assert set(stale) == {"AAPL"}
+	assert stale["AAPL"] > datetime.timedelta(days=4)
+
+
+def test_record_many_more_than_one_request(table):
+	bar = last_bar("AAPL", "2021-01-04")
+	table.record("GONE", bar, {"all": 1})
+	symbols = [f"S{i:03d}" for i in range(60)]
+	table.record_many([(symbol, bar, {"all": i}, None) for i, symbol in enumerate(symbols)], removed=["GONE"])
+	found = table.batch_get(symbols + ["GONE"])
+	assert set(found) == set(symbols)
+	assert [found[symbol].rows for symbol in symbols] == list(range(60))
+
+
+def test_table_pickles(table):
+	table.record("AAPL", last_bar("AAPL", "2021-01-04"), {"all": 1})
+	assert pickle.loads(pickle.dumps(table)).get("AAPL") is not None
+
+
+def test_write_through_on_put_and_update(store, table, monkeypatch):
+	store.put("AAPL", synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-08"))
+	metadata = table.get("AAPL")
+	assert metadata.rows == len(store.bars("AAPL"))
+	assert metadata.last_timestamp == store.store.last_timestamp("AAPL").to_pydatetime()
+
+	# Writes only sum partition row counts, rather than reading bars back to count them exactly
+	update = synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-07", "2021-02-02")
+	with monkeypatch.context() as patch:
+		patch.setattr(store.store, "rows", lambda symbol: pytest.fail("Counted rows on update"))
+		store.update("AAPL", update)
+	metadata = table.get("AAPL")
+	assert metadata.rows == sum(store.partitions("AAPL").values())
+	assert metadata.last_timestamp == update.index[-1].to_pydatetime()
+	assert metadata.last_bar["close"] == update["close"].iloc[-1]
+	assert store.last_timestamp("AAPL") == update.index[-1]
+
+	# Overlapping updates replace bars rather than adding them, which the count reflects once compacted
+	store.compact("AAPL")
+	assert table.get("AAPL").rows == len(store.bars("AAPL"))
+
+
+def test_write_through_on_update_many(store, table):
+	for symbol in ["AAPL", "MSFT"]:
+		store.put(symbol, synthetic_bars(symbol, TimeFrame.Minute, "2021-01-04", "2021-01-05"))
+	updates = {symbol: synthetic_bars(symbol, TimeFrame.Minute, "2021-01-06", "2021-01-06") for symbol in ["AAPL", "MSFT"]}
+	assert store.update_many(updates, workers=2) == {}
+	for symbol, df in updates.items():
+		assert table.get(symbol).last_timestamp == df.index[-1].to_pydatetime()
+
+
+def test_write_through_on_add_and_remove(table, tmp_path):
+	store = MetadataBarsDataStore(PandasBarsDataStore(TimeFrame.Day, str(tmp_path)),
+	                              SymbolMetadataTable(table.table_name, "Day", client=table.client))
+	store.add("AAPL", client=FakeRESTClient())
+	metadata = store.table.get("AAPL")
+	assert metadata.rows == len(store.bars("AAPL"))
+	assert metadata.last_timestamp == store.store.last_timestamp("AAPL").to_pydatetime()
+
+	store.remove("AAPL")
+	assert store.table.get("AAPL") is None
+
+
+def test_out_of_date_symbols_fall_back_to_the_store(store, table):
+	store.put("AAPL", synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-01-05"))
+	# Written around the wrapper, so the table knows nothing about it
+	store.store.put("MSFT", synthetic_bars("MSFT", TimeFrame.Minute, "2021-01-04", "2021-01-05"))
+	assert set(store.get_out_of_date_symbols(datetime.timedelta(days=3))) == {"AAPL", "MSFT"}
+
+	store.sync()
+	assert table.get("MSFT").rows == len(store.bars("MSFT"))
+
+	# Symbols gone from the store lose their metadata
+	store.store.remove("AAPL")
+	store.sync(["AAPL", "MSFT"])
+	assert table.get("AAPL") is None and table.get("MSFT") is not None
@@ -0,0 +1,56 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import io
+import json
+from typing import Dict, List
+
+from lmbda import metrics
+
+
+def emitted(stream: io.StringIO) -> List[dict]:
+	return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_emf_keeps_every_value():
+	stream = io.StringIO()
+	sink = metrics.EmfSink(stream=stream)
+	for i in range(250):
+		sink.record("store.bars", float(i), metrics.SECONDS)
+	sink.record("store.update", 1.0, metrics.SECONDS)
+	sink.flush()
+
+	documents = emitted(stream)
+	assert len(documents) == 3
+	values: Dict[str, List[float]] = {}
+	for document in documents:
+		declared = [metric["Name"] for metric in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+		for name in declared:
+			assert len(document[name]) <= 100
+			values.setdefault(name, []).extend(document[name])
+	assert values == {"store.bars": [float(i) for i in range(250)], "store.update": [1.0]}
+
+
+def test_emf_splits_many_metrics():
+	stream = io.StringIO()
+	sink = metrics.EmfSink(stream=stream)
+	for i in range(150):
+		sink.record(f"metric.{i:03d}", 1.0, metrics.COUNT)
+	sink.flush()
+
+	documents = emitted(stream)
+	assert [len(document["_aws"]["CloudWatchMetrics"][0]["Metrics"]) for document in documents] == [100, 50]
+	sink.flush()
+	assert len(emitted(stream)) == 2
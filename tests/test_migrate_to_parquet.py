@@ -0,0 +1,37 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import pandas as pd
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.ParquetBarsDataStore import ParquetBarsDataStore
+from lmbda.store.fake_client import synthetic_bars
+from scripts.migrate_to_parquet import migrate
+
+
+def test_migrates_delta_segments(tmp_path):
+	source = PandasBarsDataStore(TimeFrame.Day, str(tmp_path / "pickle"))
+	source.put("AAPL", synthetic_bars("AAPL", TimeFrame.Day, "2020-01-01", "2021-06-30"))
+	# One update revises bars already in a year file, the other adds months only found in delta segments
+	update = synthetic_bars("AAPL", TimeFrame.Day, "2021-06-01", "2021-08-31")
+	update["close"] += 1.0
+	source.update("AAPL", update)
+	source.update("AAPL", synthetic_bars("AAPL", TimeFrame.Day, "2021-09-01", "2022-01-31"))
+	assert any(".delta-" in name for name in source.partitions("AAPL"))
+
+	destination = ParquetBarsDataStore(TimeFrame.Day, str(tmp_path / "parquet"))
+	migrate(source, destination, "AAPL")
+	pd.testing.assert_frame_equal(destination.bars("AAPL"), source.bars("AAPL"), check_freq=False)
@@ -0,0 +1,135 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import datetime
+
+import boto3
+import pandas as pd
+import pytest
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda import metrics
+from lmbda.store.S3BarsDataStore import S3BarsDataStore
+from lmbda.store.fake_client import FakeRESTClient, synthetic_bars
+
+BUCKET = "traitor-test"
+
+
+@pytest.fixture
+def registry():
+	sink = metrics.RegistrySink()
+	metrics.set_sink(sink)
+	yield sink
+	metrics.set_sink(None)
+
+
+@pytest.fixture
+def store(aws, tmp_path) -> S3BarsDataStore:
+	boto3.client("s3").create_bucket(Bucket=BUCKET)
+	return S3BarsDataStore(TimeFrame.Minute, BUCKET, "history", cache_dir=str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def reader(store, tmp_path) -> S3BarsDataStore:
+	"""A second store over the same bucket with a cache of its own, since writing fills the writer's cache"""
+	return S3BarsDataStore(TimeFrame.Minute, BUCKET, "history", cache_dir=str(tmp_path / "reader"))
+
+
+@pytest.fixture
+def bars() -> pd.DataFrame:
+	return synthetic_bars("AAPL", TimeFrame.Minute, "2021-01-04", "2021-02-26")
+
+
+def counts(registry) -> dict:
+	return {name: metric["sum"] for name, metric in registry.snapshot().items()}
+
+
+def test_round_trip_and_partitions(store, bars):
+	store.put("AAPL", bars)
+	assert store.symbols() == {"AAPL"}
+	pd.testing.assert_frame_equal(store.bars("AAPL"), bars, check_freq=False)
+	assert store.partitions("AAPL") == {"2021/01.parquet": len(bars.loc[:"2021-01-31"]),
+	                                    "2021/02.parquet": len(bars.loc["2021-02-01":])}
+	assert store.last_timestamp("AAPL") == bars.index[-1]
+
+
+def test_column_reads_use_ranged_gets(store, reader, bars, registry):
+	store.put("AAPL", bars)
+	registry.reset()
+	df = reader.bars("AAPL", columns=["close"])
+	assert list(df.columns) == ["close"]
+	assert (df["close"].to_numpy() == bars["close"].to_numpy()).all()
+
+	recorded = counts(registry)
+	assert recorded["s3.range_gets"] > 0
+	assert "s3.gets" not in recorded
+	# Only the footer and the close column are transferred, a fraction of the objects
+	sizes = sum(partition["Size"] for partition in store._partitions("AAPL"))
+	assert recorded["s3.read_bytes"] < sizes / 2
+
+
+def test_date_ranges_prune_partitions(store, bars, registry):
+	store.put("AAPL", bars)
+	registry.reset()
+	df = store.bars("AAPL", start=datetime.date(2021, 2, 1), end=datetime.date(2021, 2, 5))
+	assert df.index.min() >= pd.Timestamp("2021-02-01", tz="UTC")
+	assert df.index.max() < pd.Timestamp("2021-02-06", tz="UTC")
+	assert counts(registry)["store.partitions_read"] == 1
+
+
+def test_full_reads_are_cached(store, reader, bars, registry):
+	store.put("AAPL", bars)
+	registry.reset()
+	reader.bars("AAPL")
+	assert counts(registry)["s3.gets"] == 2
+	registry.reset()
+	pd.testing.assert_frame_equal(reader.bars("AAPL"), bars, check_freq=False)
+	recorded = counts(registry)
+	assert recorded["s3.cache_hits"] == 2
+	assert "s3.gets" not in recorded and "s3.range_gets" not in recorded
+
+
+def test_cache_is_invalidated_by_changed_etags(store, reader, bars, registry):
+	store.put("AAPL", bars.loc[:"2021-01-29"])
+	reader.bars("AAPL")
+
+	# The writer replaces the partition the reader has cached
+	update = bars.loc["2021-01-29"].copy()
+	update["close"] += 1.0
+	store.update("AAPL", update)
+
+	registry.reset()
+	df = reader.bars("AAPL")
+	assert (df.loc[update.index, "close"].to_numpy() == update["close"].to_numpy()).all()
+	recorded = counts(registry)
+	assert recorded["s3.cache_misses"] == 1
+	assert recorded["s3.gets"] == 1
+
+
+def test_remove(store, bars):
+	store.put("AAPL", bars)
+	store.bars("AAPL")
+	store.remove("AAPL")
+	assert "AAPL" not in store
+	assert len(store.cache._files()) == 0
+	with pytest.raises(ValueError):
+		store.remove("AAPL")
+
+
+def test_failed_add_leaves_nothing_behind(store):
+	with pytest.raises(ConnectionError):
+		store.add("AAPL", client=FakeRESTClient(fail_after=3))
+	assert "AAPL" not in store
+	assert store.symbols() == set()
@@ -0,0 +1,82 @@
+#  This file is part of traitor.
+#
+#  traitor is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  traitor is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with traitor.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+
+from alpaca_trade_api.rest import TimeFrame
+
+from lmbda.store.PandasBarsDataStore import PandasBarsDataStore
+from lmbda.store.fake_client import FakeRESTClient, synthetic_bars
+from lmbda.store.symbol_index import SymbolIndex
+
+
+def put(store, symbol):
+	store.put(symbol, synthetic_bars(symbol, TimeFrame.Day, "2019-01-01", "2021-12-31"))
+
+
+def test_one_shard_per_symbol(tmp_path):
+	store = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	for symbol in ["AAPL", "MSFT", "GME"]:
+		put(store, symbol)
+	assert {path.name for path in (tmp_path / ".index").iterdir()} == {"AAPL.json", "MSFT.json", "GME.json"}
+
+	# Writing one symbol leaves every other shard untouched
+	stamps = {path.name: os.stat(path).st_mtime_ns for path in (tmp_path / ".index").iterdir()}
+	store.update("AAPL", synthetic_bars("AAPL", TimeFrame.Day, "2022-01-01", "2022-01-31"))
+	assert os.stat(tmp_path / ".index" / "MSFT.json").st_mtime_ns == stamps["MSFT.json"]
+	assert os.stat(tmp_path / ".index" / "GME.json").st_mtime_ns == stamps["GME.json"]
+
+	store.remove("GME")
+	assert not (tmp_path / ".index" / "GME.json").exists()
+
+
+def test_add_saves_once(tmp_path, monkeypatch):
+	store = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	saves = []
+	save = SymbolIndex.save
+	monkeypatch.setattr(SymbolIndex, "save", lambda index, symbols=None: saves.append(symbols) or save(index, symbols))
+	store.add("AAPL", client=FakeRESTClient())
+	assert saves == [["AAPL"]]
+	assert len(store.partitions("AAPL")) >= 5
+
+
+def test_other_processes_see_changes(tmp_path):
+	writer = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	reader = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	put(writer, "AAPL")
+	assert "AAPL" in reader
+	assert reader.symbols() == {"AAPL"}
+
+	writer.update("AAPL", synthetic_bars("AAPL", TimeFrame.Day, "2022-01-01", "2022-01-31"))
+	assert reader.last_timestamp("AAPL") == writer.last_timestamp("AAPL")
+
+	put(writer, "MSFT")
+	writer.remove("AAPL")
+	assert reader.symbols() == {"MSFT"}
+	assert "AAPL" not in reader
+
+
+def test_rebuild_missing_index(tmp_path):
+	store = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	put(store, "AAPL")
+	put(store, "MSFT")
+	partitions = store.partitions("AAPL")
+	for path in (tmp_path / ".index").iterdir():
+		path.unlink()
+	(tmp_path / ".index").rmdir()
+
+	rebuilt = PandasBarsDataStore(TimeFrame.Day, str(tmp_path))
+	assert rebuilt.symbols() == {"AAPL", "MSFT"}
+	assert rebuilt.partitions("AAPL") == partitions